@@ -0,0 +1,618 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+图片管理系统 - 性能基准测试
+生成合成图库（可配置文件数、标签数量与分布倾斜度、小尺寸 JPEG），
+在无界面的情况下对热点路径计时，并输出 JSON Lines 结果，便于跨提交对比。
+
+用法示例：
+    python benchmark.py --files 1000
+    python benchmark.py --files 100000 --tags 2000 --skew 1.2 --output bench.jsonl
+    python benchmark.py --files 1000000 --workdir D:/bench_1m --keep      # 大图库生成一次后复用
+    python benchmark.py --files 1000 --compare bench.jsonl                # 与上次结果对比
+    python benchmark.py --io-gb 10 --workdir D:/bench_io --keep --repeat 1  # 顺序读取 I/O 微基准（吞吐与峰值内存）
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from PIL import Image
+
+CATALOG_MARKER = "bench_catalog.json"
+ALL_OPS = ["save_files", "search_or", "search_and", "get_image_tags", "render_thumbnails", "download_zip",
+           "download_zip_stream", "download_zip_http", "tag_cooccur", "suggest_tags",
+           "tag_cooccur_delete", "timeline"]
+
+
+# -------------------------
+# 合成图库生成
+# -------------------------
+def make_jpeg_templates(count, size, seed):
+    """生成若干张不同颜色的小 JPEG，返回字节串列表（写文件时轮流复用，避免逐张编码）"""
+    rnd = random.Random(seed)
+    templates = []
+    for _ in range(count):
+        color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+        img = Image.new("RGB", size, color)
+        # 加一块不同颜色的矩形，避免解码时全是纯色块
+        img.paste((255 - color[0], 255 - color[1], 255 - color[2]),
+                  (0, 0, size[0] // 2, size[1] // 2))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=85)
+        templates.append(buf.getvalue())
+    return templates
+
+
+def zipf_weights(n, skew):
+    """第 k 个标签的权重为 1/k^skew，skew=0 为均匀分布"""
+    return [1.0 / ((k + 1) ** skew) for k in range(n)]
+
+
+def generate_catalog(app, args):
+    """直接批量写入数据库和 files 目录，返回生成耗时（秒）"""
+    start = time.perf_counter()
+    rnd = random.Random(args.seed)
+    conn, cursor = app.conn, app.cursor
+
+    # 标签：dims 个维度，标签平均分布到各维度
+    tag_ids = []
+    with conn:
+        for i in range(args.tags):
+            parent = f"dim{i % args.dims:03d}"
+            cursor.execute("INSERT INTO t_tags (parent, name) VALUES (?, ?)", (parent, f"tag{i:06d}"))
+            tag_ids.append(cursor.lastrowid)
+    weights = zipf_weights(len(tag_ids), args.skew)
+
+    templates = make_jpeg_templates(64, args.image_size, args.seed)
+    batch = 10000
+    for offset in range(0, args.files, batch):
+        n = min(batch, args.files - offset)
+        files = []
+        for i in range(offset, offset + n):
+            rel_path = os.path.join("files", f"bench_{i:08d}.jpg")
+            with open(os.path.join(app.BASE_DIR, rel_path), "wb") as f:
+                f.write(templates[i % len(templates)])
+            files.append((f"bench_{i:08d}.jpg", rel_path))
+        with conn:
+            cursor.execute("SELECT COALESCE(MAX(file_id), 0) FROM t_files")
+            first_id = cursor.fetchone()[0] + 1
+            cursor.executemany("INSERT INTO t_files (file_name, file_path) VALUES (?, ?)", files)
+            links = []
+            for file_id in range(first_id, first_id + n):
+                for tag_id in set(rnd.choices(tag_ids, weights, k=args.tags_per_file)):
+                    links.append((file_id, tag_id))
+            cursor.executemany("INSERT OR IGNORE INTO t_files_tags (file_id, tag_id) VALUES (?, ?)", links)
+        print(f"  已生成 {offset + n}/{args.files} 个文件", file=sys.stderr)
+    return time.perf_counter() - start
+
+
+def catalog_params(args):
+    return {
+        "files": args.files,
+        "tags": args.tags,
+        "dims": args.dims,
+        "skew": args.skew,
+        "tags_per_file": args.tags_per_file,
+        "image_size": list(args.image_size),
+        "seed": args.seed,
+    }
+
+
+# -------------------------
+# 计时
+# -------------------------
+def time_op(func, repeat):
+    """执行 repeat 次，返回 (每次耗时列表, 最后一次的返回值)"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+class CountingSink:
+    """只统计字节数的不可 seek 输出，记录第一次写入距开始的时间"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.first_byte_s = None
+        self._start = time.perf_counter()
+
+    def write(self, data):
+        if self.first_byte_s is None:
+            self.first_byte_s = time.perf_counter() - self._start
+        self.bytes += len(data)
+
+
+def throughput(size, times):
+    return round(size / 1024 / 1024 / statistics.median(times), 1) if times else None
+
+
+def popular_tags(app, count):
+    app.cursor.execute("""
+        SELECT tag_id FROM t_files_tags GROUP BY tag_id ORDER BY COUNT(*) DESC LIMIT ?
+    """, (count,))
+    return [r[0] for r in app.cursor.fetchall()]
+
+
+def remove_imported(app, file_ids):
+    """删除 save_files 导入的记录和文件，并把自增序列退回，使图库与计时前完全一致"""
+    conn, cursor = app.conn, app.cursor
+    paths = []
+    with conn:
+        for i in range(0, len(file_ids), 500):
+            chunk = file_ids[i:i + 500]
+            placeholder = ",".join("?" * len(chunk))
+            cursor.execute(f"SELECT file_path FROM t_files WHERE file_id IN ({placeholder})", chunk)
+            paths.extend(r[0] for r in cursor.fetchall())
+            cursor.execute(f"DELETE FROM t_files WHERE file_id IN ({placeholder})", chunk)
+        for table, key in (("t_files", "file_id"), ("t_files_tags", "id")):
+            cursor.execute(f"UPDATE sqlite_sequence SET seq = (SELECT COALESCE(MAX({key}), 0) FROM {table}) "
+                           "WHERE name = ?", (table,))
+    for path in paths:
+        with contextlib.suppress(OSError):
+            os.remove(app.resolve_path(path))
+
+
+def run_benchmarks(app, args, workdir):
+    """逐项计时，yield (op, times, extra)"""
+    ops = args.ops
+    rnd = random.Random(args.seed + 1)
+    top = popular_tags(app, 2)
+
+    if "save_files" in ops:
+        src_dir = os.path.join(workdir, "import_src")
+        os.makedirs(src_dir, exist_ok=True)
+        templates = make_jpeg_templates(8, args.image_size, args.seed + 2)
+        paths = []
+        for i in range(args.import_count):
+            p = os.path.join(src_dir, f"import_{i:05d}.jpg")
+            with open(p, "wb") as f:
+                f.write(templates[i % len(templates)])
+            paths.append(p)
+        app.cursor.execute("SELECT parent, name FROM t_tags WHERE tag_id IN (?, ?)", (top + top)[:2])
+        chosen = app.cursor.fetchall()
+        imported = []
+        times, _ = time_op(lambda: imported.extend(app.import_files(paths, chosen)), args.repeat)
+        # 复用的图库保持原样，否则后续各项（以及下次 --compare）的数据量会随每次运行增长
+        remove_imported(app, imported)
+        yield "save_files", times, {"files_per_call": len(paths)}
+
+    for mode in ("OR", "AND"):
+        op = f"search_{mode.lower()}"
+        if op in ops:
+            times, rows = time_op(lambda: app.search_files_by_tags(top, mode), args.repeat)
+            yield op, times, {"tag_ids": top, "results": len(rows)}
+
+    results = app.search_files_by_tags(top, "OR")[:args.render_count]
+    if "get_image_tags" in ops:
+        app.cursor.execute("SELECT MAX(file_id) FROM t_files")
+        max_id = app.cursor.fetchone()[0] or 1
+        sample = [rnd.randint(1, max_id) for _ in range(args.render_count)]
+        times, _ = time_op(lambda: [app.get_file_tags(fid) for fid in sample], args.repeat)
+        yield "get_image_tags", times, {"calls": len(sample)}
+
+    if "render_thumbnails" in ops:
+        # 冷：逐张解码；热：同一批结果再次渲染，命中解码缓存
+        cache = app.ImageLRUCache()
+
+        def render():
+            for file_id, path in results:
+                key = (file_id, app.THUMB_SIZE)
+                if cache.get(key) is None:
+                    cache.put(key, app.load_thumbnail(path))
+
+        cold, _ = time_op(render, 1)
+        warm, _ = time_op(render, args.repeat)
+        yield "render_thumbnails", cold, {"images": len(results), "phase": "cold"}
+        yield "render_thumbnails_cached", warm, {"images": len(results), "phase": "warm", **cache.stats()}
+
+    if "download_zip" in ops:
+        zip_path = os.path.join(workdir, "bench_export.zip")
+        paths = [p for _, p in results]
+        times, _ = time_op(lambda: app.export_zip(paths, zip_path), args.repeat)
+        size = os.path.getsize(zip_path)
+        yield "download_zip", times, {"files": len(paths), "bytes": size, "mb_per_s": throughput(size, times)}
+
+    if "download_zip_stream" in ops:
+        # 流式写入不可 seek 的管道式输出（只计数、不落盘），对比先写完整压缩包的 download_zip
+        paths = [p for _, p in results]
+
+        def stream():
+            sink = CountingSink()
+            app.export_zip_stream(paths, sink)
+            return sink
+
+        times, sink = time_op(stream, args.repeat)
+        yield "download_zip_stream", times, {"files": len(paths), "bytes": sink.bytes,
+                                             "mb_per_s": throughput(sink.bytes, times),
+                                             "first_byte_s": round(sink.first_byte_s or 0, 4)}
+
+    if "download_zip_http" in ops:
+        # 经本机 HTTP 服务下载（含生成 ZIP 布局、回环 socket 传输）
+        paths = [p for _, p in results]
+        server = app.ZipExportServer()
+
+        def fetch():
+            with urllib.request.urlopen(server.add(paths, "bench")) as resp:
+                n = 0
+                for chunk in iter(lambda: resp.read(1 << 20), b""):
+                    n += len(chunk)
+                return n
+
+        try:
+            times, size = time_op(fetch, args.repeat)
+        finally:
+            server.close()
+        yield "download_zip_http", times, {"files": len(paths), "bytes": size, "mb_per_s": throughput(size, times)}
+
+    if "tag_cooccur" in ops:
+        # 全量统计标签共现（有 NumPy 时向量化计数，否则为 SQL 自连接）
+        app.cursor.execute("SELECT COUNT(*) FROM t_files_tags")
+        links = app.cursor.fetchone()[0]
+        times, pairs = time_op(app.rebuild_tag_cooccurrence, args.repeat)
+        yield "tag_cooccur", times, {"links": links, "pairs": pairs, "numpy": app._numpy() is not None}
+
+    if "tag_cooccur_delete" in ops:
+        # 删除路径上的触发器开销：删除最常用标签的全部关联后回滚（不改动图库）
+        if not app.tag_cooccurrence_ready():
+            app.rebuild_tag_cooccurrence()
+
+        def remove():
+            app.cursor.execute("DELETE FROM t_files_tags WHERE tag_id = ?", (top[0],))
+            removed = app.cursor.rowcount
+            app.conn.rollback()
+            return removed
+
+        times, removed = time_op(remove, args.repeat)
+        yield "tag_cooccur_delete", times, {"tag_id": top[0], "links": removed}
+
+    if "suggest_tags" in ops:
+        if not app.tag_cooccurrence_ready():
+            app.rebuild_tag_cooccurrence()
+        times, suggestions = time_op(lambda: app.suggest_tags(top), args.repeat)
+        yield "suggest_tags", times, {"tag_ids": top, "suggestions": len(suggestions)}
+
+    if "timeline" in ops:
+        # 时间线汇总 + 在图片最多的时间段中连续翻 10 页
+        def browse():
+            _, start, end, count, _ = max(app.get_timeline(), key=lambda day: day[3])
+            after, pages = 0, 0
+            for _ in range(10):
+                rows = app.get_timeline_page(start, end, after)
+                if not rows:
+                    break
+                after, pages = rows[-1][0], pages + 1
+            return count, pages
+
+        times, (count, pages) = time_op(browse, args.repeat)
+        yield "timeline", times, {"bucket_files": count, "pages": pages}
+
+
+
+# -------------------------
+# 顺序读取 I/O 微基准：哈希与打包的不同读法，每种读法在独立子进程中运行以测峰值内存
+# -------------------------
+IO_METHODS = [
+    "sha256_read_whole",   # 整个文件 read() 后计算（旧的完整性校验）
+    "sha256_read_1mb",     # 每次 read(1 MB)（旧的备份哈希）
+    "sha256_readinto",     # iter_file_chunks：复用缓冲区的 readinto
+    "sha256_mmap",         # mapped_file：mmap 交给 hashlib
+    "zip_write",           # zipfile.ZipFile.write（旧的 ZIP 导出）
+    "zip_export",          # export_zip：readinto 大块写入
+    "zip_stream",          # export_zip_stream：流式 ZIP
+]
+IO_MARKER = "bench_io.json"
+
+
+def make_io_library(directory, size_gb, file_mb, seed):
+    """生成总大小约 size_gb 的随机内容文件（每个 file_mb），参数一致时复用"""
+    params = {"io_gb": size_gb, "file_mb": file_mb, "seed": seed}
+    marker = os.path.join(directory, IO_MARKER)
+    if os.path.exists(marker):
+        with open(marker, encoding="utf-8") as f:
+            if json.load(f) == params:
+                return params
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+    rnd = random.Random(seed)
+    # 内容不影响哈希和 STORED 打包的速度，复用一块随机数据，每个文件改写开头以区分
+    block = rnd.randbytes(file_mb * 1024 * 1024)
+    count = max(1, int(size_gb * 1024 / file_mb))
+    for i in range(count):
+        with open(os.path.join(directory, f"{i:06d}.bin"), "wb") as f:
+            f.write(i.to_bytes(8, "little"))
+            f.write(memoryview(block)[8:])
+        if (i + 1) % 50 == 0 or i + 1 == count:
+            print(f"\r  已生成 {i + 1}/{count} 个文件", end="", file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump(params, f)
+    return params
+
+
+def reset_peak_rss():
+    """Linux 上把峰值 RSS 清零（写 /proc/self/clear_refs），只统计之后的操作；其他系统上峰值包含导入模块"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def drop_page_cache(paths):
+    """丢弃这些文件的页缓存（不需要 root），让每种读法都从磁盘读起；不支持的系统上跳过"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for p in paths:
+        with open(p, "rb") as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def io_worker(method, directory):
+    """子进程：用 method 处理 directory 下全部文件，输出一行 JSON"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import hashlib
+    import zipfile
+    import imageApplication as app
+
+    paths = sorted(os.path.join(directory, n) for n in os.listdir(directory) if n.endswith(".bin"))
+    reset_peak_rss()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    total = 0
+    if method.startswith("sha256_"):
+        for p in paths:
+            digest = hashlib.sha256()
+            if method == "sha256_read_whole":
+                with open(p, "rb") as f:
+                    digest.update(f.read())
+            elif method == "sha256_read_1mb":
+                with open(p, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+            elif method == "sha256_readinto":
+                for chunk in app.iter_file_chunks(p):
+                    digest.update(chunk)
+            else:
+                with app.mapped_file(p) as m:
+                    digest.update(m)
+            total += os.path.getsize(p)
+    elif method == "zip_write":
+        with zipfile.ZipFile(os.devnull, "w") as zf:
+            for p in paths:
+                zf.write(p, os.path.basename(p))
+        total = sum(os.path.getsize(p) for p in paths)
+    elif method == "zip_export":
+        app.export_zip(paths, os.devnull)
+        total = sum(os.path.getsize(p) for p in paths)
+    elif method == "zip_stream":
+        with open(os.devnull, "wb") as out:
+            total = app.export_zip_stream(paths, out)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "bytes": total, "peak_rss_mb": peak_rss_mb(),
+                      "baseline_rss_mb": baseline}))
+    return 0
+
+
+def run_io_benchmark(args, workdir):
+    """生成（或复用）I/O 图库，逐个读法在子进程中运行 args.repeat 次，返回 (图库参数, [(op, 耗时列表, extra)])"""
+    directory = os.path.join(workdir, "io_files")
+    print(f"I/O 微基准图库: {directory}", file=sys.stderr)
+    params = make_io_library(directory, args.io_gb, args.io_file_mb, args.seed)
+    paths = [os.path.join(directory, n) for n in os.listdir(directory) if n.endswith(".bin")]
+    results = []
+    for method in args.io_methods:
+        runs = []
+        for _ in range(args.repeat):
+            drop_page_cache(paths)
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--io-worker", method, directory])
+            runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+        times = [r["seconds"] for r in runs]
+        size = runs[-1]["bytes"]
+        results.append((f"io_{method}", times, {
+            "bytes": size, "mb_per_s": throughput(size, times),
+            "peak_rss_mb": max((r["peak_rss_mb"] or 0) for r in runs) or None,
+            "baseline_rss_mb": runs[-1]["baseline_rss_mb"],
+        }))
+    return params, results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def summarize(times):
+    return {
+        "runs": len(times),
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "max_s": max(times),
+    }
+
+
+def load_previous(path):
+    """读取上次结果，取每个 (op, 图库参数) 最后一条记录"""
+    previous = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rec = json.loads(line)
+                previous[(rec["op"], json.dumps(rec["catalog"], sort_keys=True))] = rec
+    return previous
+
+
+def parse_size(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="图片管理系统性能基准测试")
+    parser.add_argument("--files", type=int, default=1000, help="合成图库的文件数（如 1000 / 100000 / 1000000）")
+    parser.add_argument("--tags", type=int, default=200, help="标签总数")
+    parser.add_argument("--dims", type=int, default=10, help="大维度数")
+    parser.add_argument("--skew", type=float, default=1.0, help="标签使用频率的 Zipf 倾斜度，0 为均匀")
+    parser.add_argument("--tags-per-file", type=int, default=3, help="每个文件抽取的标签数")
+    parser.add_argument("--image-size", type=parse_size, default=(64, 48), help="生成图片尺寸，如 64x48")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--ops", nargs="+", default=ALL_OPS, choices=ALL_OPS, help="要计时的操作")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数")
+    parser.add_argument("--import-count", type=int, default=200, help="save_files 每次导入的文件数")
+    parser.add_argument("--render-count", type=int, default=500, help="缩略图 / 标签查询 / 导出的样本数")
+    parser.add_argument("--workdir", help="图库目录（默认临时目录）；参数一致时复用已生成的图库")
+    parser.add_argument("--keep", action="store_true", help="结束后保留图库目录")
+    parser.add_argument("--output", help="把结果追加写入该 JSONL 文件（默认输出到标准输出）")
+    parser.add_argument("--compare", help="与之前的 JSONL 结果对比中位数")
+    parser.add_argument("--io-gb", type=float, help="改为运行顺序读取 I/O 微基准，合成图库总大小（GB）")
+    parser.add_argument("--io-file-mb", type=int, default=32, help="I/O 微基准每个文件的大小（MB）")
+    parser.add_argument("--io-methods", nargs="+", default=IO_METHODS, choices=IO_METHODS, help="要对比的读法")
+    parser.add_argument("--io-worker", nargs=2, metavar=("METHOD", "DIR"), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.io_worker:
+        return io_worker(*args.io_worker)
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="images_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    params = catalog_params(args)
+    # 先读历史结果，避免 --output 与 --compare 为同一文件时和本次结果自比
+    previous = load_previous(args.compare) if args.compare and os.path.exists(args.compare) else None
+    if args.io_gb:
+        return main_io(args, workdir, previous)
+
+    # 复用参数一致的已有图库；否则清空重建
+    marker = os.path.join(workdir, CATALOG_MARKER)
+    reuse = False
+    if os.path.exists(marker):
+        with open(marker, encoding="utf-8") as f:
+            reuse = json.load(f) == params
+        if not reuse:
+            for name in ("images.db", "images.db-wal", "images.db-shm", "files", "import_src", CATALOG_MARKER):
+                p = os.path.join(workdir, name)
+                if os.path.isdir(p):
+                    shutil.rmtree(p)
+                elif os.path.exists(p):
+                    os.remove(p)
+
+    # 必须在导入主程序之前设置，主程序在导入时确定 BASE_DIR
+    os.environ["IMAGES_BASE_DIR"] = workdir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import imageApplication as app
+    t0 = time.perf_counter()
+    app.open_database()
+    open_s = time.perf_counter() - t0
+
+    meta = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "catalog": params,
+    }
+    records = []
+    if not reuse:
+        print(f"生成合成图库: {workdir}", file=sys.stderr)
+        gen_s = generate_catalog(app, args)
+        with open(marker, "w", encoding="utf-8") as f:
+            json.dump(params, f)
+        records.append({"op": "generate_catalog", **meta, **summarize([gen_s])})
+    else:
+        # 只有复用已有图库时才是有意义的启动耗时（新建时是空库）
+        records.append({"op": "open_database", **meta, **summarize([open_s])})
+
+    try:
+        for op, times, extra in run_benchmarks(app, args, workdir):
+            rec = {"op": op, **meta, **summarize(times), "extra": extra}
+            records.append(rec)
+            print(f"{op:<26} median {rec['median_s'] * 1000:10.2f} ms   {extra}", file=sys.stderr)
+    finally:
+        app.conn.close()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    write_records(records, args, previous)
+    return 0
+
+
+def main_io(args, workdir, previous):
+    os.environ["IMAGES_BASE_DIR"] = workdir
+    try:
+        params, results = run_io_benchmark(args, workdir)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    meta = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "catalog": params,
+    }
+    records = []
+    for op, times, extra in results:
+        rec = {"op": op, **meta, **summarize(times), "extra": extra}
+        records.append(rec)
+        print(f"{op:<26} median {rec['median_s'] * 1000:10.2f} ms   {extra}", file=sys.stderr)
+    write_records(records, args, previous)
+    return 0
+
+
+def write_records(records, args, previous):
+    out = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for rec in records:
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    finally:
+        if args.output:
+            out.close()
+
+    if previous is not None:
+        print("\n与历史结果对比（中位数，>1 表示变慢）：", file=sys.stderr)
+        for rec in records:
+            old = previous.get((rec["op"], json.dumps(rec["catalog"], sort_keys=True)))
+            if old and old["median_s"] > 0:
+                ratio = rec["median_s"] / old["median_s"]
+                print(f"  {rec['op']:<26} {old['median_s'] * 1000:10.2f} ms -> {rec['median_s'] * 1000:10.2f} ms"
+                      f"  x{ratio:.2f}  ({old.get('commit')} -> {rec.get('commit')})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
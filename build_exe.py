@@ -5,18 +5,25 @@
 使用 PyInstaller 将 Python 程序打包成独立的 exe 可执行文件
 """
 
+import argparse
 import os
 import shutil
 import subprocess
 import sys
 
+APP_NAME = "图片管理系统"
+
 def print_step(step, total, message):
     """打印步骤信息"""
     print(f"\n{'='*50}")
     print(f"[{step}/{total}] {message}")
     print('='*50)
 
-def main():
+def main(onedir=False):
+    # --onefile 每次启动都要把全部依赖解压到临时目录，--onedir 直接从 dist 目录加载，启动更快
+    dist_dir = os.path.join("dist", APP_NAME) if onedir else "dist"
+    exe_path = os.path.join(dist_dir, f"{APP_NAME}.exe")
+
     print("\n" + "="*50)
     print("    图片管理系统 - 打包工具")
     print("="*50)
@@ -46,11 +53,11 @@ def main():
             print(f"✓ 已删除 {file}")
     
     # Step 3: 打包 exe
-    print_step(3, 5, "开始打包 exe...")
+    print_step(3, 5, f"开始打包 exe（{'onedir' if onedir else 'onefile'}）...")
     pyinstaller_cmd = [
         "pyinstaller",
-        "--name=图片管理系统",
-        "--onefile",
+        f"--name={APP_NAME}",
+        "--onedir" if onedir else "--onefile",
         "--windowed",
         "--noconfirm",
         "imageApplication.py"
@@ -67,7 +74,7 @@ def main():
     print_step(4, 5, "复制必要文件...")
     
     # 创建 files 目录
-    dist_files = os.path.join("dist", "files")
+    dist_files = os.path.join(dist_dir, "files")
     os.makedirs(dist_files, exist_ok=True)
     print(f"✓ 已创建 {dist_files} 目录")
     
@@ -83,7 +90,7 @@ def main():
     
     # 复制数据库（如果有）
     if os.path.exists("images.db"):
-        shutil.copy2("images.db", os.path.join("dist", "images.db"))
+        shutil.copy2("images.db", os.path.join(dist_dir, "images.db"))
         print("✓ 已复制 images.db")
     else:
         print("ℹ images.db 不存在（首次运行会自动创建）")
@@ -102,9 +109,13 @@ def main():
    - images.db 数据库文件
 
 注意：三者必须在同一目录！
+"""
+    if onedir:
+        readme_content += """
+本版本为目录版（onedir）：_internal 文件夹是程序依赖，需与 exe 放在一起整体复制。
 """
     
-    readme_path = os.path.join("dist", "使用说明.txt")
+    readme_path = os.path.join(dist_dir, "使用说明.txt")
     with open(readme_path, "w", encoding="utf-8") as f:
         f.write(readme_content)
     print(f"✓ 已生成 {readme_path}")
@@ -113,15 +124,19 @@ def main():
     print("\n" + "="*50)
     print("    打包完成！")
     print("="*50)
-    print(f"\n可执行文件位置: dist{os.sep}图片管理系统.exe")
-    print("\n可以将 dist 文件夹整体移动到其他位置或电脑使用")
+    print(f"\n可执行文件位置: {exe_path}")
+    print(f"\n可以将 {dist_dir} 文件夹整体移动到其他位置或电脑使用")
     print("\n" + "="*50 + "\n")
     
     return True
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="图片管理系统打包工具")
+    parser.add_argument("--onedir", action="store_true",
+                        help="打包为目录（exe + 依赖文件），启动时无需解压，比单文件启动快")
+    args = parser.parse_args()
     try:
-        success = main()
+        success = main(onedir=args.onedir)
         if not success:
             sys.exit(1)
     except KeyboardInterrupt:
@@ -1,12 +1,38 @@
 import os
 import sys
+import argparse
 import sqlite3
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from tkinter import filedialog, messagebox, simpledialog, ttk
 from PIL import Image, ImageTk
 import shutil
 import zipfile
 import datetime
+import time
+import threading
+import functools
+import contextlib
+import cProfile
+import pstats
+import hashlib
+import zlib
+import json
+import gzip
+import io
+import re
+import secrets
+import struct
+import urllib.parse
+import webbrowser
+import math
+import mmap
+import queue
+import itertools
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from collections import OrderedDict, deque
 
 
 # -------------------------
@@ -17,7 +43,10 @@ def get_base_dir():
     获取程序运行的基础目录
     - 开发环境：脚本所在目录
     - 打包后的 exe：exe 文件所在目录
+    - 设置了环境变量 IMAGES_BASE_DIR 时使用该目录（基准测试、脚本批处理等）
     """
+    if os.environ.get("IMAGES_BASE_DIR"):
+        return os.path.abspath(os.environ["IMAGES_BASE_DIR"])
     if getattr(sys, 'frozen', False):
         # 打包后的 exe 环境
         return os.path.dirname(sys.executable)
@@ -32,56 +61,798 @@ DB_PATH = os.path.join(BASE_DIR, "images.db")
 
 os.makedirs(FILES_DIR, exist_ok=True)
 
-conn = sqlite3.connect(DB_PATH)
-cursor = conn.cursor()
+# 查看页缩略图尺寸与解码缓存上限（可通过环境变量调整）
+THUMB_SIZE = (120, 120)
+THUMB_CACHE_MAX_ITEMS = int(os.environ.get("IMAGES_THUMB_CACHE_ITEMS", "2000"))
+THUMB_CACHE_MAX_MB = float(os.environ.get("IMAGES_THUMB_CACHE_MB", "128"))
+
+# 大图查看：瓦片金字塔缓存目录、瓦片边长、内存中瓦片缓存上限；
+# 像素数不超过 PYRAMID_MIN_PIXELS 的图片直接在内存中分级，不落盘
+CACHE_DIR = os.path.join(BASE_DIR, "cache")
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, "tiles")
+TILE_SIZE = 256
+TILE_CACHE_MAX_MB = float(os.environ.get("IMAGES_TILE_CACHE_MB", "96"))
+# 磁盘瓦片缓存总大小上限：生成新金字塔后按最近使用时间（info.json 的修改时间）淘汰最旧的金字塔
+TILE_DISK_CACHE_MAX_MB = float(os.environ.get("IMAGES_TILE_DISK_CACHE_MB", "2048"))
+PYRAMID_MIN_PIXELS = 4 * 1024 * 1024
+# 大图查看时预解码前后相邻图片：后台线程数、预解码结果缓存上限、沿翻页方向多预取的张数
+PREFETCH_WORKERS = 2
+PREFETCH_CACHE_MB = 96
+PREFETCH_AHEAD = 2
+# 图库中允许的最大像素数（上亿像素的全景图）；只在查看、缩略图和完整性校验打开图库中的图片时放宽
+# （见 open_large_image），导入、转码等其余解码路径保持 Pillow 默认的解压炸弹保护
+LARGE_IMAGE_MAX_PIXELS = 1024 * 1024 * 1024
+
+
+# -------------------------
+# 性能统计：计时器 + 计数器
+# -------------------------
+class Instrumentation:
+    """
+    按操作名记录耗时样本和计数，用于定位卡顿发生在数据库、图片解码、界面还是磁盘 I/O。
+    - 关闭时 timer / timed 几乎无开销（环境变量 IMAGES_PROFILE=1 或菜单开启）
+    - 每个操作只保留最近 max_samples 个样本，用于计算 p50 / p95
+    - arm_profile(action) 后，下一次执行该界面操作时用 cProfile 采样并导出到 profiles/
+    """
+
+    def __init__(self, enabled=False, max_samples=2000):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = {}  # op -> deque[seconds]
+        self._totals = {}  # op -> (次数, 总耗时)
+        self._counters = {}  # name -> 累计值
+        self.profile_action = None
+        self.profile_dir = None
+        self.last_profile_path = None
+
+    def record(self, op, seconds):
+        with self._lock:
+            samples = self._samples.get(op)
+            if samples is None:
+                samples = self._samples[op] = deque(maxlen=self.max_samples)
+            samples.append(seconds)
+            n, total = self._totals.get(op, (0, 0.0))
+            self._totals[op] = (n + 1, total + seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, op):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(op, time.perf_counter() - start)
+
+    def timed(self, op):
+        """装饰器：统计函数每次调用的耗时"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(op, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def _percentile(sorted_samples, q):
+        if not sorted_samples:
+            return 0.0
+        return sorted_samples[int(round(q * (len(sorted_samples) - 1)))]
+
+    def snapshot(self):
+        """返回 (耗时统计列表, 计数器字典)；耗时统计按总耗时倒序"""
+        with self._lock:
+            samples = {op: sorted(v) for op, v in self._samples.items()}
+            totals = dict(self._totals)
+            counters = dict(self._counters)
+        rows = []
+        for op, values in samples.items():
+            n, total = totals[op]
+            rows.append({
+                "op": op,
+                "count": n,
+                "total_s": total,
+                "p50_s": self._percentile(values, 0.50),
+                "p95_s": self._percentile(values, 0.95),
+                "max_s": values[-1] if values else 0.0,
+            })
+        rows.sort(key=lambda r: r["total_s"], reverse=True)
+        return rows, counters
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+            self._counters.clear()
+
+    def arm_profile(self, action):
+        """下一次执行 action 时做 cProfile 采样"""
+        self.profile_action = action
+
+    def run_action(self, action, func, *args, **kwargs):
+        """
+        执行界面操作：启用时计时；若已为该操作预约 cProfile，则采样并导出 .prof 和文本摘要。
+        后台任务在工作线程里调用（见 JobManager），预约在锁内领取，并发的同名任务只有一个会被采样
+        """
+        with self._lock:
+            armed = self.profile_action == action
+            if armed:
+                self.profile_action = None
+        if not armed:
+            with self.timer(f"action.{action}"):
+                return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            self.record(f"action.{action}", time.perf_counter() - start)
+            self._dump_profile(action, profiler)
+
+    def _dump_profile(self, action, profiler):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(self.profile_dir, f"{action}_{stamp}")
+        profiler.dump_stats(base + ".prof")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(60)
+        self.last_profile_path = base + ".prof"
+
+
+perf = Instrumentation(enabled=os.environ.get("IMAGES_PROFILE") == "1")
+perf.profile_dir = os.path.join(BASE_DIR, "profiles")
+if os.environ.get("IMAGES_PROFILE_ACTION"):
+    perf.arm_profile(os.environ["IMAGES_PROFILE_ACTION"])
+
+
+def profiled_action(action):
+    """装饰界面操作方法：计时，并支持对该操作做一次性 cProfile 采样"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            return perf.run_action(action, method, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+# ================================================
+#    后台任务：优先级队列 + 工作线程，结果经队列交回界面线程
+# ================================================
+JOB_PRIORITY_HIGH = 0      # 用户正在等待结果的操作：打开数据库、搜索
+JOB_PRIORITY_NORMAL = 5    # 导入、导出
+JOB_PRIORITY_LOW = 10      # 可以稍后完成的批量删除
+JOB_WORKERS = int(os.environ.get("IMAGES_JOB_WORKERS", "3"))
+JOB_HISTORY = 50           # 任务面板保留的已结束任务数
+
+
+class JobCancelled(Exception):
+    """任务在检查点发现已被取消"""
+
+
+class Job:
+    """
+    一个后台任务。func(job) 在工作线程中执行，通过 job.progress() 报告进度、
+    在检查点调用 job.check()（或把 job.cancelled 作为 should_stop 传给数据库函数）响应取消。
+    """
+    QUEUED, RUNNING, DONE, FAILED, CANCELLED = "排队中", "运行中", "已完成", "失败", "已取消"
+
+    def __init__(self, job_id, name, func, priority, kind, on_done=None, on_error=None, on_cancel=None,
+                 action=None):
+        self.id = job_id
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.kind = kind
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self.action = action  # 界面操作名：任务体计入 action.* 统计，预约了 cProfile 时在工作线程中采样
+        self.status = Job.QUEUED
+        self.done = 0
+        self.total = None
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def progress(self, done, total=None, message=None):
+        """工作线程中调用；界面定时读取这些字段刷新任务面板"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+
+    @property
+    def finished_state(self):
+        return self.status in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    def progress_text(self):
+        if self.total:
+            text = f"{self.done}/{self.total}（{self.done * 100 // self.total}%）"
+        else:
+            text = str(self.done) if self.done else ""
+        return f"{text} {self.message}".strip()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class JobManager:
+    """
+    工作线程池 + 优先级队列（同优先级先进先出）。
+    任务结束后放入 events 队列，由界面线程定时调用 dispatch() 取出并执行回调，
+    回调里可以安全地操作 Tk 控件。数据库函数在工作线程中自动使用该线程自己的连接。
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self.events = queue.Queue()
+        self.jobs = OrderedDict()
+        for i in range(max(1, workers)):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, name, func, priority=JOB_PRIORITY_NORMAL, kind="task",
+               on_done=None, on_error=None, on_cancel=None, action=None):
+        """
+        提交任务，返回 Job。回调都在界面线程执行：
+        on_done(结果)、on_error(异常)、on_cancel(已完成部分的结果，抛出 JobCancelled 时为 None)。
+        action 为发起任务的界面操作名（见 profiled_action），真正的耗时在任务体中统计
+        """
+        with self._lock:
+            job = Job(next(self._seq), name, func, priority, kind, on_done, on_error, on_cancel, action)
+            self.jobs[job.id] = job
+            self._prune()
+        self._queue.put((priority, job.id, job))
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None and not job.finished_state:
+            job.cancel()
+
+    def active(self):
+        return [j for j in list(self.jobs.values()) if not j.finished_state]
+
+    def clear_finished(self):
+        with self._lock:
+            for job_id in [j.id for j in self.jobs.values() if j.finished_state]:
+                del self.jobs[job_id]
+
+    def _prune(self):
+        finished = [j.id for j in self.jobs.values() if j.finished_state]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    def _worker(self):
+        while True:
+            _, _, job = self._queue.get()
+            if not job.cancelled():
+                job.status = Job.RUNNING
+                job.started = time.time()
+                try:
+                    with perf.timer(f"job.{job.kind}"):
+                        if job.action:
+                            job.result = perf.run_action(job.action, job.func, job)
+                        else:
+                            job.result = job.func(job)
+                    job.status = Job.CANCELLED if job.cancelled() else Job.DONE
+                except JobCancelled:
+                    job.status = Job.CANCELLED
+                except Exception as e:
+                    job.error = e
+                    job.status = Job.FAILED
+                    traceback.print_exc()
+            else:
+                job.status = Job.CANCELLED
+            job.finished = time.time()
+            self.events.put(job)
+
+    def dispatch(self):
+        """在界面线程中调用：执行已结束任务的回调，返回处理的任务数"""
+        n = 0
+        while True:
+            try:
+                job = self.events.get_nowait()
+            except queue.Empty:
+                return n
+            n += 1
+            if job.status == Job.DONE and job.on_done:
+                job.on_done(job.result)
+            elif job.status == Job.FAILED and job.on_error:
+                job.on_error(job.error)
+            elif job.status == Job.CANCELLED and job.on_cancel:
+                job.on_cancel(job.result)
+
 
 # ------------------------------------
-# 数据表设计：支持动态维度/子标签创建
+# 数据库连接：每个线程一条
 # ------------------------------------
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS t_files (
-    file_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    file_name TEXT,
-    file_path TEXT,
-    import_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-''')
+class ThreadLocalDatabase:
+    """
+    每个线程使用自己的 SQLite 连接和游标：界面线程与后台任务的工作线程互不干扰，
+    WAL 下读写不互相阻塞，写写冲突时最多等待 timeout 秒。
+    open_database() 在调用线程中打开第一条连接并建表/迁移，其他线程首次访问时自动连接。
+    """
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS t_tags (
-    tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    parent TEXT,
-    name TEXT
-)
-''')
+    def __init__(self, timeout=30):
+        self.path = None
+        self.ready = False
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connection(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            if self.path is None:
+                raise RuntimeError("数据库尚未打开，请先调用 open_database()")
+            c = sqlite3.connect(self.path, timeout=self.timeout)
+            # 第一条连接由 create_core_schema() 在迁移完成后开启外键
+            if self.ready:
+                c.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = c
+            self._local.cursor = c.cursor()
+        return c
+
+    def cursor(self):
+        self.connection()
+        return self._local.cursor
+
+    def close(self):
+        """关闭当前线程的连接"""
+        c = getattr(self._local, "conn", None)
+        if c is not None:
+            c.close()
+            self._local.conn = self._local.cursor = None
+
+
+class _ConnectionProxy:
+    """模块级 conn：转发到当前线程的连接，支持 with conn: 事务"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return getattr(self._db.connection(), name)
+
+    def __enter__(self):
+        return self._db.connection().__enter__()
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS t_files_tags (
+    def __exit__(self, *exc):
+        return self._db.connection().__exit__(*exc)
+
+    def close(self):
+        self._db.close()
+
+
+class _CursorProxy:
+    """模块级 cursor：转发到当前线程的游标"""
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return getattr(self._db.cursor(), name)
+
+    def __iter__(self):
+        return iter(self._db.cursor())
+
+
+# 数据库由 open_database() 打开：界面先显示，再打开数据库（迁移、建索引可能耗时）；
+# 脚本和命令行在使用下面的数据库函数前调用一次 open_database()
+database = ThreadLocalDatabase()
+_open_lock = threading.Lock()
+conn = _ConnectionProxy(database)
+cursor = _CursorProxy(database)
+
+# ------------------------------------
+# 数据表设计：支持动态维度/子标签创建
+# ------------------------------------
+# 删除文件或标签时级联删除关联记录；同一文件同一标签只保留一条
+FILES_TAGS_DDL = '''
+CREATE TABLE IF NOT EXISTS {table} (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     file_id INTEGER,
     tag_id INTEGER,
-    FOREIGN KEY(file_id) REFERENCES t_files(file_id),
-    FOREIGN KEY(tag_id) REFERENCES t_tags(tag_id)
+    FOREIGN KEY(file_id) REFERENCES t_files(file_id) ON DELETE CASCADE,
+    FOREIGN KEY(tag_id) REFERENCES t_tags(tag_id) ON DELETE CASCADE,
+    UNIQUE(file_id, tag_id)
 )
-''')
-conn.commit()
+'''
+
+# 键值设置（存储布局、迁移进度等随库保存的配置）
+SETTINGS_DDL = "CREATE TABLE IF NOT EXISTS t_settings (key TEXT PRIMARY KEY, value TEXT)"
+
+
+def migrate_files_tags_cascade():
+    """
+    旧库的 t_files_tags 没有 ON DELETE CASCADE / UNIQUE 约束，SQLite 不能直接修改约束，
+    这里在一个事务内重建该表：去掉重复关联和指向已删除文件/标签的孤儿记录。
+    必须在开启 PRAGMA foreign_keys 之前调用。
+    """
+    cursor.execute("PRAGMA foreign_key_list(t_files_tags)")
+    on_delete = [r[6] for r in cursor.fetchall()]
+    if on_delete and all(a == "CASCADE" for a in on_delete):
+        return
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute("DROP TABLE IF EXISTS t_files_tags_new")
+        cursor.execute(FILES_TAGS_DDL.format(table="t_files_tags_new"))
+        cursor.execute("""
+            INSERT INTO t_files_tags_new (id, file_id, tag_id)
+            SELECT MIN(id), file_id, tag_id FROM t_files_tags
+            WHERE file_id IN (SELECT file_id FROM t_files)
+              AND tag_id IN (SELECT tag_id FROM t_tags)
+            GROUP BY file_id, tag_id
+        """)
+        cursor.execute("DROP TABLE t_files_tags")
+        cursor.execute("ALTER TABLE t_files_tags_new RENAME TO t_files_tags")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def create_core_schema():
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS t_files (
+        file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_name TEXT,
+        file_path TEXT,
+        import_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS t_tags (
+        tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        parent TEXT,
+        name TEXT
+    )
+    ''')
+    cursor.execute(FILES_TAGS_DDL.format(table="t_files_tags"))
+
+    migrate_files_tags_cascade()
+    cursor.execute("PRAGMA foreign_keys=ON")
+
+    # 关联表双向索引 + 标签名索引：按标签找文件、按文件找标签（UNIQUE 约束自带）、按名字找 tag_id 都走索引
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_tags_tag ON t_files_tags(tag_id, file_id)")
+    cursor.execute("DROP INDEX IF EXISTS idx_files_tags_file")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_parent_name ON t_tags(parent, name)")
+    # 按路径查文件（缩略图反查标签、目录导入去重）
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON t_files(file_path)")
+
+    # 批量标签操作日志（用于撤销）：每次操作一行，具体增删的关联记录在 t_tag_op_links
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS t_tag_ops (
+        op_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        description TEXT,
+        op_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        undone INTEGER DEFAULT 0
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS t_tag_op_links (
+        op_id INTEGER,
+        file_id INTEGER,
+        tag_id INTEGER,
+        action TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tag_op_links_op ON t_tag_op_links(op_id, action)")
+
+    cursor.execute(SETTINGS_DDL)
+    conn.commit()
+
+# 撤销历史保留的批量操作条数
+TAG_UNDO_HISTORY = 20
+# 删除标签时关联记录超过该数量则分批删除，每批提交一次，避免长时间占用写锁
+TAG_DELETE_CHUNK_THRESHOLD = 50000
+TAG_DELETE_CHUNK_SIZE = 5000
+
+
+# ------------------------------------
+# 全文检索：文件名 / 标签（维度 + 子标签）/ 图片元数据
+# ------------------------------------
+# t_files 的后加列：
+# - meta：导入时提取的格式、尺寸、EXIF 相机与拍摄时间等文本
+# - original_size / stored_size：转码前后的字节数（stored_size 非空表示已按转码策略处理过）
+# - original_path / transcoded_time：保留期内的原图路径及转码时间，过期后删除原图并清空 original_path
+FILES_EXTRA_COLUMNS = [
+    ("meta", "TEXT DEFAULT ''"),
+    ("original_size", "INTEGER"),
+    ("stored_size", "INTEGER"),
+    ("original_path", "TEXT"),
+    ("transcoded_time", "TEXT"),
+]
+
+
+def ensure_files_columns(cur):
+    cur.execute("PRAGMA table_info(t_files)")
+    existing = {r[1] for r in cur.fetchall()}
+    for name, decl in FILES_EXTRA_COLUMNS:
+        if name not in existing:
+            cur.execute(f"ALTER TABLE t_files ADD COLUMN {name} {decl}")
+
+
+# 文本搜索最多返回的条数
+TEXT_SEARCH_LIMIT = 5000
+
+# 文件行的增删改由触发器直接同步到 FTS 表；标签关联变化只把 file_id 记入 t_search_dirty，
+# 搜索前由 sync_search_index() 集合式地重算这些文件的标签文本，
+# 避免删除热门标签（级联删除上百万关联）时逐行重写索引
+FILE_TAGS_TEXT_SQL = """
+    (SELECT COALESCE(group_concat(t.parent || ' ' || t.name, ' '), '')
+     FROM t_files_tags ft JOIN t_tags t ON t.tag_id = ft.tag_id
+     WHERE ft.file_id = {file_id})
+"""
+
+
+def setup_search_index():
+    """
+    创建 FTS5 索引及同步触发器，返回 (是否支持 FTS5, 是否支持 trigram 模糊匹配)。
+    - t_search_fts：file_name / tags / meta 三列，rowid = file_id，unicode61 分词，支持前缀匹配
+    - t_search_trgm：同样内容合成一列，trigram 分词，用于子串 / 模糊匹配（SQLite >= 3.34）
+    新建索引时从现有数据回填。
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('t_search_fts', 't_search_trgm')")
+    existing = {r[0] for r in cursor.fetchall()}
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS t_search_fts
+            USING fts5(file_name, tags, meta, tokenize = 'unicode61 remove_diacritics 2')
+        """)
+    except sqlite3.OperationalError:
+        return False, False
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS t_search_trgm USING fts5(text, tokenize = 'trigram')")
+        has_trigram = True
+    except sqlite3.OperationalError:
+        has_trigram = False
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS t_search_dirty (file_id INTEGER PRIMARY KEY)")
+    trgm_insert = trgm_delete = ""
+    if has_trigram:
+        trgm_insert = """
+            INSERT INTO t_search_trgm(rowid, text)
+            VALUES (new.file_id, COALESCE(new.file_name, '') || ' ' || COALESCE(new.meta, ''));"""
+        trgm_delete = "DELETE FROM t_search_trgm WHERE rowid = old.file_id;"
+    cursor.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_search_files_ai AFTER INSERT ON t_files BEGIN
+            INSERT INTO t_search_fts(rowid, file_name, tags, meta)
+            VALUES (new.file_id, COALESCE(new.file_name, ''), '', COALESCE(new.meta, ''));
+            {trgm_insert}
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_search_files_ad AFTER DELETE ON t_files BEGIN
+            DELETE FROM t_search_fts WHERE rowid = old.file_id;
+            {trgm_delete}
+            DELETE FROM t_search_dirty WHERE file_id = old.file_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_search_files_au AFTER UPDATE OF file_name, meta ON t_files BEGIN
+            INSERT OR IGNORE INTO t_search_dirty(file_id) VALUES (new.file_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_search_links_ai AFTER INSERT ON t_files_tags BEGIN
+            INSERT OR IGNORE INTO t_search_dirty(file_id) VALUES (new.file_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_search_links_ad AFTER DELETE ON t_files_tags BEGIN
+            INSERT OR IGNORE INTO t_search_dirty(file_id) VALUES (old.file_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_search_tags_au AFTER UPDATE OF parent, name ON t_tags BEGIN
+            INSERT OR IGNORE INTO t_search_dirty(file_id)
+            SELECT file_id FROM t_files_tags WHERE tag_id = new.tag_id;
+        END;
+    """)
+
+    if "t_search_fts" not in existing:
+        cursor.execute("""
+            INSERT INTO t_search_fts(rowid, file_name, tags, meta)
+            SELECT file_id, COALESCE(file_name, ''), '', COALESCE(meta, '') FROM t_files
+        """)
+        cursor.execute("INSERT OR IGNORE INTO t_search_dirty(file_id) SELECT file_id FROM t_files")
+    if has_trigram and "t_search_trgm" not in existing:
+        cursor.execute("INSERT OR IGNORE INTO t_search_dirty(file_id) SELECT file_id FROM t_files")
+        cursor.execute("""
+            INSERT INTO t_search_trgm(rowid, text)
+            SELECT file_id, COALESCE(file_name, '') FROM t_files
+        """)
+    conn.commit()
+    return True, has_trigram
+
+
+# 由 open_database() 检测
+FTS_AVAILABLE = TRIGRAM_AVAILABLE = False
+
+
+# ------------------------------------
+# 保存的搜索：标签组合 + OR/AND，可选择物化结果集
+# ------------------------------------
+# 物化结果由 t_files_tags 上的触发器增量维护（导入、批量打标签、合并、撤销、级联删除都经过这里），
+# 打开时按 file_id 键集分页读取，只读一页；搜索定义中的标签被删除时标记 stale，下次打开时整体重算
+SAVED_SEARCH_DDL = """
+    CREATE TABLE IF NOT EXISTS t_saved_searches (
+        search_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        mode TEXT NOT NULL DEFAULT 'OR',
+        materialized INTEGER NOT NULL DEFAULT 0,
+        stale INTEGER NOT NULL DEFAULT 0,
+        created_time TEXT,
+        refreshed_time TEXT
+    );
+    CREATE TABLE IF NOT EXISTS t_saved_search_tags (
+        search_id INTEGER NOT NULL REFERENCES t_saved_searches(search_id) ON DELETE CASCADE,
+        tag_id INTEGER NOT NULL REFERENCES t_tags(tag_id) ON DELETE CASCADE,
+        PRIMARY KEY (search_id, tag_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_saved_search_tags_tag ON t_saved_search_tags(tag_id, search_id);
+    CREATE TABLE IF NOT EXISTS t_saved_search_results (
+        search_id INTEGER NOT NULL REFERENCES t_saved_searches(search_id) ON DELETE CASCADE,
+        file_id INTEGER NOT NULL REFERENCES t_files(file_id) ON DELETE CASCADE,
+        PRIMARY KEY (search_id, file_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_saved_search_results_file ON t_saved_search_results(file_id);
+
+    CREATE TRIGGER IF NOT EXISTS trg_saved_links_ai AFTER INSERT ON t_files_tags BEGIN
+        INSERT OR IGNORE INTO t_saved_search_results(search_id, file_id)
+        SELECT s.search_id, new.file_id
+        FROM t_saved_search_tags st JOIN t_saved_searches s ON s.search_id = st.search_id
+        WHERE st.tag_id = new.tag_id AND s.materialized = 1 AND s.stale = 0
+          AND (s.mode = 'OR' OR (
+              SELECT COUNT(*) FROM t_saved_search_tags st2
+              JOIN t_files_tags ft ON ft.tag_id = st2.tag_id AND ft.file_id = new.file_id
+              WHERE st2.search_id = s.search_id
+          ) = (SELECT COUNT(*) FROM t_saved_search_tags st3 WHERE st3.search_id = s.search_id));
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_saved_links_ad AFTER DELETE ON t_files_tags BEGIN
+        DELETE FROM t_saved_search_results
+        WHERE file_id = old.file_id AND search_id IN (
+            SELECT s.search_id
+            FROM t_saved_search_tags st JOIN t_saved_searches s ON s.search_id = st.search_id
+            WHERE st.tag_id = old.tag_id AND s.materialized = 1
+              AND (s.mode = 'AND' OR NOT EXISTS (
+                  SELECT 1 FROM t_saved_search_tags st2
+                  JOIN t_files_tags ft ON ft.tag_id = st2.tag_id AND ft.file_id = old.file_id
+                  WHERE st2.search_id = s.search_id
+              ))
+        );
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_saved_tags_ad AFTER DELETE ON t_saved_search_tags BEGIN
+        UPDATE t_saved_searches SET stale = 1 WHERE search_id = old.search_id;
+    END;
+"""
+
+# 保存的搜索每页显示的图片数
+SAVED_SEARCH_PAGE_SIZE = 200
+
+
+# ------------------------------------
+# 时间线：按导入时间浏览
+# ------------------------------------
+# t_timeline 按 UTC 小时（import_time 的前 13 位 "YYYY-MM-DD HH"）记录图片数，由 t_files 上的触发器增量维护
+# （导入、目录导入、删除都经过这里）；按天的汇总由小时桶在本地时区下合并得到。
+# 点开某个时间段后按 idx_files_import_time 以 (import_time, file_id) 键集分页，只读一页
+TIMELINE_READY_KEY = "timeline_ready"
+TIMELINE_DDL = """
+    CREATE INDEX IF NOT EXISTS idx_files_import_time ON t_files(import_time);
+    CREATE TABLE IF NOT EXISTS t_timeline (
+        bucket TEXT PRIMARY KEY,
+        cnt INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS trg_timeline_files_ai AFTER INSERT ON t_files
+    WHEN new.import_time IS NOT NULL BEGIN
+        INSERT INTO t_timeline (bucket, cnt) VALUES (substr(new.import_time, 1, 13), 1)
+        ON CONFLICT (bucket) DO UPDATE SET cnt = cnt + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_timeline_files_ad AFTER DELETE ON t_files
+    WHEN old.import_time IS NOT NULL BEGIN
+        UPDATE t_timeline SET cnt = cnt - 1 WHERE bucket = substr(old.import_time, 1, 13);
+        DELETE FROM t_timeline WHERE bucket = substr(old.import_time, 1, 13) AND cnt <= 0;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_timeline_files_au AFTER UPDATE OF import_time ON t_files
+    WHEN old.import_time IS NOT new.import_time BEGIN
+        UPDATE t_timeline SET cnt = cnt - 1 WHERE bucket = substr(old.import_time, 1, 13);
+        DELETE FROM t_timeline WHERE bucket = substr(old.import_time, 1, 13) AND cnt <= 0;
+        INSERT INTO t_timeline (bucket, cnt) SELECT substr(new.import_time, 1, 13), 1
+        WHERE new.import_time IS NOT NULL
+        ON CONFLICT (bucket) DO UPDATE SET cnt = cnt + 1;
+    END;
+"""
+
+
+def open_database():
+    """
+    打开本库并建表/迁移（幂等，只执行一次），返回 conn。
+    可在任意线程调用；之后每个线程首次访问 conn/cursor 时打开自己的连接。
+    """
+    global FTS_AVAILABLE, TRIGRAM_AVAILABLE
+    with _open_lock:
+        if database.ready:
+            return conn
+        with perf.timer("startup.db_open"):
+            database.path = DB_PATH
+            # WAL：后台任务写入期间界面线程的读操作不被阻塞
+            cursor.execute("PRAGMA journal_mode=WAL")
+            create_core_schema()
+            ensure_files_columns(cursor)
+            FTS_AVAILABLE, TRIGRAM_AVAILABLE = setup_search_index()
+            cursor.executescript(SAVED_SEARCH_DDL)
+            cursor.executescript(INTEGRITY_DDL)
+            cursor.executescript(TAG_COOCCUR_DDL)
+            cursor.executescript(TIMELINE_DDL)
+            if get_setting(TIMELINE_READY_KEY) is None:
+                rebuild_timeline()
+            conn.commit()
+            database.ready = True
+    return conn
 
 
 # ================================================
 #          工具函数：查询维度、标签等
 # ================================================
+@perf.timed("db.get_all_dimensions")
 def get_all_dimensions():
     cursor.execute("SELECT DISTINCT parent FROM t_tags")
     rows = cursor.fetchall()
     return sorted([r[0] for r in rows if r[0]])
 
 
+@perf.timed("db.get_tags_by_dimension")
 def get_tags_by_dimension(parent):
     cursor.execute("SELECT name FROM t_tags WHERE parent=?", (parent,))
     rows = cursor.fetchall()
     return sorted([r[0] for r in rows if r[0] and r[0].strip() != ""])
 
 
+@perf.timed("db.get_tag_tree")
+def get_tag_tree():
+    """一次查询取出全部维度及其子标签：OrderedDict {维度: [子标签]}，均按名称排序"""
+    cursor.execute("SELECT parent, name FROM t_tags WHERE parent IS NOT NULL AND parent != '' ORDER BY parent, name")
+    tree = OrderedDict()
+    for parent, name in cursor.fetchall():
+        tags = tree.setdefault(parent, [])
+        if name and name.strip() != "":
+            tags.append(name)
+    return tree
+
+
 def insert_dimension(parent):
     if not parent:
         return
@@ -100,67 +871,4209 @@ def insert_tag(parent, tag_name):
         conn.commit()
 
 
+def get_tag_id(parent, tag_name):
+    cursor.execute("SELECT tag_id FROM t_tags WHERE parent=? AND name=?", (parent, tag_name))
+    r = cursor.fetchone()
+    return r[0] if r else None
+
+
+def get_setting(key, default=None, cur=None):
+    cur = cur or cursor
+    cur.execute("SELECT value FROM t_settings WHERE key=?", (key,))
+    r = cur.fetchone()
+    return r[0] if r else default
+
+
+def set_setting(key, value, cur=None):
+    """写入设置（不提交，由调用方决定事务边界）"""
+    cur = cur or cursor
+    if value is None:
+        cur.execute("DELETE FROM t_settings WHERE key=?", (key,))
+    else:
+        cur.execute("INSERT OR REPLACE INTO t_settings (key, value) VALUES (?, ?)", (key, value))
+
+
+def build_tag_search_sql(tag_ids, mode):
+    """
+    构造按标签搜索的 SQL，返回 (sql, params)，结果列为 file_id, file_path
+    - OR：命中任一标签
+    - AND：命中全部标签
+    """
+    placeholder = ",".join("?" * len(tag_ids))
+    if mode == "OR":
+        sql = f"""
+            SELECT DISTINCT f.file_id, f.file_path
+            FROM t_files f
+            JOIN t_files_tags ft ON f.file_id = ft.file_id
+            WHERE ft.tag_id IN ({placeholder})
+        """
+    else:
+        sql = f"""
+            SELECT f.file_id, f.file_path
+            FROM t_files f
+            JOIN t_files_tags ft ON f.file_id = ft.file_id
+            WHERE ft.tag_id IN ({placeholder})
+            GROUP BY f.file_id
+            HAVING COUNT(DISTINCT ft.tag_id) = {len(tag_ids)}
+        """
+    return sql, list(tag_ids)
+
+
+@perf.timed("db.search_files_by_tags")
+def search_files_by_tags(tag_ids, mode):
+    """按标签搜索，返回 [(file_id, 绝对路径)]，跳过文件已不存在的记录"""
+    sql, params = build_tag_search_sql(tag_ids, mode)
+    cursor.execute(sql, params)
+    results = []
+    for file_id, file_path in cursor.fetchall():
+        abs_p = resolve_path(file_path)
+        if abs_p and os.path.exists(abs_p):
+            results.append((file_id, abs_p))
+    return results
+
+
+def extract_metadata(path):
+    """提取用于全文检索的图片元数据文本：格式、尺寸、EXIF 相机型号与拍摄时间"""
+    try:
+        with Image.open(path) as img:
+            parts = [img.format or "", f"{img.width}x{img.height}"]
+            exif = img.getexif()
+            for tag in (0x010F, 0x0110, 0x0132):  # Make, Model, DateTime
+                value = exif.get(tag)
+                if value:
+                    parts.append(str(value).strip("\x00 "))
+        return " ".join(p for p in parts if p)
+    except Exception:
+        return ""
+
+
+@perf.timed("db.sync_search_index")
+def sync_search_index():
+    """把 t_search_dirty 中的文件重新写入全文索引（标签文本集合式重算），返回处理的文件数"""
+    if not FTS_AVAILABLE:
+        return 0
+    cursor.execute("SELECT COUNT(*) FROM t_search_dirty")
+    n = cursor.fetchone()[0]
+    if not n:
+        return 0
+    tags_text = FILE_TAGS_TEXT_SQL.format(file_id="t_search_fts.rowid")
+    with conn:
+        cursor.execute(f"""
+            UPDATE t_search_fts
+            SET tags = {tags_text},
+                file_name = (SELECT COALESCE(file_name, '') FROM t_files WHERE file_id = t_search_fts.rowid),
+                meta = (SELECT COALESCE(meta, '') FROM t_files WHERE file_id = t_search_fts.rowid)
+            WHERE rowid IN (SELECT file_id FROM t_search_dirty)
+        """)
+        if TRIGRAM_AVAILABLE:
+            cursor.execute("""
+                UPDATE t_search_trgm
+                SET text = (SELECT file_name || ' ' || tags || ' ' || meta
+                            FROM t_search_fts WHERE rowid = t_search_trgm.rowid)
+                WHERE rowid IN (SELECT file_id FROM t_search_dirty)
+            """)
+        cursor.execute("DELETE FROM t_search_dirty")
+    return n
+
+
+def build_fts_match(text):
+    """把用户输入拆成词，每个词加引号（避免 FTS 语法字符）并做前缀匹配，词之间为 AND"""
+    tokens = [t for t in text.split() if t]
+    return " ".join('"' + t.replace('"', '""') + '"*' for t in tokens)
+
+
+def build_trigram_match(text):
+    """模糊匹配：输入中的所有三字片段取 OR，按 bm25 排序时共享片段越多越靠前"""
+    grams = []
+    for word in text.split():
+        for i in range(max(1, len(word) - 2)):
+            g = word[i:i + 3]
+            if len(g) == 3 and g not in grams:
+                grams.append(g)
+    return " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+
+
+def build_text_search_sql(text, tag_ids=None, mode="OR", fuzzy=False, limit=TEXT_SEARCH_LIMIT):
+    """
+    构造全文检索 SQL，返回 (sql, params)，结果列为 file_id, file_path，按相关度排序。
+    tag_ids 非空时与标签条件取交集（OR/AND 语义同 build_tag_search_sql）。
+    不支持 FTS5 时退化为 file_name / 标签名的 LIKE 匹配。
+    """
+    tag_filter, tag_params = "", []
+    if tag_ids:
+        tag_sql, tag_params = build_tag_search_sql(tag_ids, mode)
+        tag_filter = f"AND f.file_id IN (SELECT file_id FROM ({tag_sql}))"
+
+    if not FTS_AVAILABLE:
+        like = f"%{text.strip()}%"
+        sql = f"""
+            SELECT f.file_id, f.file_path FROM t_files f
+            WHERE (f.file_name LIKE ? OR f.file_id IN (
+                SELECT ft.file_id FROM t_files_tags ft JOIN t_tags t ON t.tag_id = ft.tag_id
+                WHERE t.parent LIKE ? OR t.name LIKE ?))
+            {tag_filter}
+            ORDER BY f.file_id LIMIT ?
+        """
+        return sql, [like, like, like] + tag_params + [limit]
+
+    if fuzzy and len(text.strip()) < 3:
+        # 不足三个字符无法构成 trigram（如两字中文词），对 trigram 表做子串扫描
+        sql = f"""
+            SELECT f.file_id, f.file_path
+            FROM t_search_trgm s JOIN t_files f ON f.file_id = s.rowid
+            WHERE s.text LIKE ? {tag_filter}
+            ORDER BY f.file_id LIMIT ?
+        """
+        return sql, [f"%{text.strip()}%"] + tag_params + [limit]
+
+    if fuzzy:
+        sql = f"""
+            SELECT f.file_id, f.file_path
+            FROM t_search_trgm s JOIN t_files f ON f.file_id = s.rowid
+            WHERE t_search_trgm MATCH ? {tag_filter}
+            ORDER BY bm25(t_search_trgm) LIMIT ?
+        """
+        return sql, [build_trigram_match(text)] + tag_params + [limit]
+
+    # 文件名权重最高，其次标签，再次元数据
+    sql = f"""
+        SELECT f.file_id, f.file_path
+        FROM t_search_fts s JOIN t_files f ON f.file_id = s.rowid
+        WHERE t_search_fts MATCH ? {tag_filter}
+        ORDER BY bm25(t_search_fts, 10.0, 5.0, 1.0) LIMIT ?
+    """
+    return sql, [build_fts_match(text)] + tag_params + [limit]
+
+
+@perf.timed("db.search_files_by_text")
+def search_files_by_text(text, tag_ids=None, mode="OR"):
+    """
+    全文检索（可叠加标签条件），精确/前缀匹配无结果时回退到 trigram 模糊/子串匹配。
+    返回 ([(file_id, 绝对路径)], 实际使用的 (sql, params))，跳过文件已不存在的记录
+    """
+    sync_search_index()
+    query = build_text_search_sql(text, tag_ids, mode)
+    cursor.execute(*query)
+    rows = cursor.fetchall()
+    if not rows and TRIGRAM_AVAILABLE:
+        query = build_text_search_sql(text, tag_ids, mode, fuzzy=True)
+        cursor.execute(*query)
+        rows = cursor.fetchall()
+    results = []
+    for file_id, file_path in rows:
+        abs_p = resolve_path(file_path)
+        if abs_p and os.path.exists(abs_p):
+            results.append((file_id, abs_p))
+    return results, query
+
+
+@perf.timed("db.save_search")
+def save_search(name, tag_ids, mode="OR", materialize=True):
+    """
+    保存（或覆盖同名）搜索，返回 search_id。
+    materialize=True 时立即计算并保存结果集，之后由触发器增量维护。
+    """
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    with conn:
+        cursor.execute("SELECT search_id FROM t_saved_searches WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        if row:
+            search_id = row[0]
+            cursor.execute("DELETE FROM t_saved_search_tags WHERE search_id = ?", (search_id,))
+            cursor.execute("UPDATE t_saved_searches SET mode = ?, materialized = ? WHERE search_id = ?",
+                           (mode, int(materialize), search_id))
+        else:
+            cursor.execute("""
+                INSERT INTO t_saved_searches (name, mode, materialized, created_time)
+                VALUES (?, ?, ?, ?)
+            """, (name, mode, int(materialize), now))
+            search_id = cursor.lastrowid
+        cursor.executemany("INSERT OR IGNORE INTO t_saved_search_tags (search_id, tag_id) VALUES (?, ?)",
+                           [(search_id, t) for t in tag_ids])
+        _materialize_saved_search(search_id)
+    return search_id
+
+
+def _materialize_saved_search(search_id):
+    """整体重算物化结果（不提交），非物化搜索只清空结果表"""
+    cursor.execute("DELETE FROM t_saved_search_results WHERE search_id = ?", (search_id,))
+    cursor.execute("SELECT mode, materialized FROM t_saved_searches WHERE search_id = ?", (search_id,))
+    mode, materialized = cursor.fetchone()
+    if materialized:
+        tag_ids = get_saved_search_tag_ids(search_id)
+        if tag_ids:
+            sql, params = build_tag_search_sql(tag_ids, mode)
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO t_saved_search_results (search_id, file_id)
+                SELECT ?, file_id FROM ({sql})
+            """, [search_id] + params)
+    cursor.execute("UPDATE t_saved_searches SET stale = 0, refreshed_time = ? WHERE search_id = ?",
+                   (datetime.datetime.now().isoformat(timespec="seconds"), search_id))
+
+
+@perf.timed("db.refresh_saved_search")
+def refresh_saved_search(search_id):
+    with conn:
+        _materialize_saved_search(search_id)
+
+
+def list_saved_searches():
+    """返回 [(search_id, name, mode, materialized)]，按名称排序"""
+    cursor.execute("SELECT search_id, name, mode, materialized FROM t_saved_searches ORDER BY name")
+    return cursor.fetchall()
+
+
+def get_saved_search_tag_ids(search_id):
+    cursor.execute("SELECT tag_id FROM t_saved_search_tags WHERE search_id = ? ORDER BY tag_id", (search_id,))
+    return [r[0] for r in cursor.fetchall()]
+
+
+def delete_saved_search(search_id):
+    with conn:
+        cursor.execute("DELETE FROM t_saved_searches WHERE search_id = ?", (search_id,))
+
+
+def saved_search_query(search_id):
+    """返回保存的搜索的完整结果 (sql, params)，列为 file_id, file_path，可直接用于批量标签操作"""
+    cursor.execute("SELECT mode, materialized FROM t_saved_searches WHERE search_id = ?", (search_id,))
+    mode, materialized = cursor.fetchone()
+    if materialized:
+        return ("""
+            SELECT f.file_id, f.file_path FROM t_saved_search_results r
+            JOIN t_files f ON f.file_id = r.file_id WHERE r.search_id = ?
+        """, [search_id])
+    return build_tag_search_sql(get_saved_search_tag_ids(search_id), mode)
+
+
+@perf.timed("db.get_saved_search_page")
+def get_saved_search_page(search_id, after_file_id=0, limit=SAVED_SEARCH_PAGE_SIZE):
+    """
+    读取保存的搜索中 file_id > after_file_id 的一页结果，返回 [(file_id, 绝对路径)]。
+    物化搜索直接按主键范围读取（stale 时先重算）；未物化的搜索执行原始查询再分页。
+    返回的行包含文件已不存在的记录（abs_path 为 None 时由调用方跳过），以便用最后一个 file_id 继续翻页。
+    """
+    cursor.execute("SELECT mode, materialized, stale FROM t_saved_searches WHERE search_id = ?", (search_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return []
+    mode, materialized, stale = row
+    if materialized:
+        if stale:
+            refresh_saved_search(search_id)
+        cursor.execute("""
+            SELECT f.file_id, f.file_path FROM t_saved_search_results r
+            JOIN t_files f ON f.file_id = r.file_id
+            WHERE r.search_id = ? AND r.file_id > ?
+            ORDER BY r.file_id LIMIT ?
+        """, (search_id, after_file_id, limit))
+    else:
+        tag_ids = get_saved_search_tag_ids(search_id)
+        if not tag_ids:
+            return []
+        sql, params = build_tag_search_sql(tag_ids, mode)
+        cursor.execute(f"""
+            SELECT file_id, file_path FROM ({sql})
+            WHERE file_id > ? ORDER BY file_id LIMIT ?
+        """, params + [after_file_id, limit])
+    return [(file_id, resolve_path(file_path)) for file_id, file_path in cursor.fetchall()]
+
+
+def rebuild_timeline():
+    """按 t_files 重新统计时间线（旧库首次打开时执行一次，之后由触发器维护）"""
+    with conn:
+        cursor.execute("DELETE FROM t_timeline")
+        cursor.execute("""
+            INSERT INTO t_timeline (bucket, cnt)
+            SELECT substr(import_time, 1, 13), COUNT(*) FROM t_files
+            WHERE import_time IS NOT NULL GROUP BY 1
+        """)
+        set_setting(TIMELINE_READY_KEY, "1")
+
+
+def _utc_text(dt):
+    """带时区的时间 → 与 import_time（CURRENT_TIMESTAMP）同格式的 UTC 字符串"""
+    return dt.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+@perf.timed("db.get_timeline")
+def get_timeline():
+    """
+    导入时间线，按本地日期汇总、新的在前：[(日期, 起, 止, 图片数, [(时刻, 起, 止, 图片数)])]，
+    小时按时间先后排列。起止为 UTC 的 import_time 字符串（左闭右开），可直接交给 get_timeline_page。
+    小时桶按 UTC 整点划分，非整点时区下跨日的那个小时计入其起点所在的日期
+    """
+    cursor.execute("SELECT bucket, cnt FROM t_timeline ORDER BY bucket")
+    days = OrderedDict()
+    for bucket, cnt in cursor.fetchall():
+        try:
+            start = datetime.datetime.strptime(bucket, "%Y-%m-%d %H").replace(tzinfo=datetime.timezone.utc)
+        except (TypeError, ValueError):
+            continue
+        local = start.astimezone()
+        day = days.setdefault(local.date(), [0, []])
+        day[0] += cnt
+        day[1].append((local.strftime("%H:%M"), _utc_text(start),
+                       _utc_text(start + datetime.timedelta(hours=1)), cnt))
+    timeline = []
+    for date, (count, hours) in reversed(days.items()):
+        start = datetime.datetime.combine(date, datetime.time()).astimezone()
+        end = datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time()).astimezone()
+        timeline.append((date.isoformat(), _utc_text(start), _utc_text(end), count, hours))
+    return timeline
+
+
+def timeline_query(start, end):
+    """时间段内全部图片的 (sql, params)，列为 file_id, file_path，可直接用于批量标签操作"""
+    return ("SELECT file_id, file_path FROM t_files WHERE import_time >= ? AND import_time < ?", [start, end])
+
+
+@perf.timed("db.get_timeline_page")
+def get_timeline_page(start, end, after_file_id=0, limit=SAVED_SEARCH_PAGE_SIZE):
+    """
+    读取 [start, end) 内排在 after_file_id 之后的一页图片（按导入时间、file_id 排序），返回 [(file_id, 绝对路径)]。
+    after_file_id 为上一页最后一张，从它的 import_time 处在索引中定位，不需要 OFFSET
+    """
+    lower = start
+    if after_file_id:
+        cursor.execute("SELECT import_time FROM t_files WHERE file_id = ?", (after_file_id,))
+        r = cursor.fetchone()
+        if r and r[0] is not None:
+            lower = max(start, r[0])
+    cursor.execute("""
+        SELECT file_id, file_path FROM t_files
+        WHERE import_time >= ? AND import_time < ? AND (import_time, file_id) > (?, ?)
+        ORDER BY import_time, file_id LIMIT ?
+    """, (lower, end, lower, after_file_id, limit))
+    return [(file_id, resolve_path(file_path)) for file_id, file_path in cursor.fetchall()]
+
+
+@perf.timed("db.get_file_tags")
+def get_file_tags(file_id):
+    """
+    获取指定文件的所有标签
+    返回格式: ["维度:标签", "维度:标签", ...]
+    """
+    sql = """
+        SELECT t.parent, t.name
+        FROM t_tags t
+        JOIN t_files_tags ft ON t.tag_id = ft.tag_id
+        WHERE ft.file_id = ?
+        ORDER BY t.parent, t.name
+    """
+    cursor.execute(sql, (file_id,))
+    return [f"{parent}:{name}" for parent, name in cursor.fetchall() if name]
+
+
+# 导入时每复制这么多个文件登记并提交一次
+IMPORT_COMMIT_BATCH = 100
+
+
+@perf.timed("import.files")
+def import_files(paths, chosen_tags, progress=None, should_stop=None):
+    """
+    导入图片：复制到 FILES_DIR（文件名加时间戳前缀），以相对路径入库并关联标签
+    chosen_tags 为 [(parent, tag)]，返回新文件的 file_id 列表（中途停止时为已导入的部分）
+    """
+    tag_ids = [t for t in (get_tag_id(parent, tag) for parent, tag in chosen_tags) if t is not None]
+    file_ids = _copy_and_insert_files(cursor, paths, tag_ids, FILES_DIR, BASE_DIR, get_storage_layout(),
+                                      progress, should_stop)
+    conn.commit()
+    return file_ids
+
+
+def _copy_and_insert_files(cur, paths, tag_ids, files_dir, base_dir, layout="flat", progress=None, should_stop=None):
+    """
+    复制文件到 files_dir（按 layout 分子目录）并在 cur 所属的库中登记、关联标签，返回 file_id 列表。
+    每 IMPORT_COMMIT_BATCH 个文件为一批：先复制（不占写锁），再在一个短事务内登记并提交，
+    导入期间界面和其他任务的写操作最多等一批的登记。每个文件之后回调 progress(已复制数)；
+    should_stop() 为真时停在文件之间，已复制的文件照常登记
+    """
+    file_ids = []
+    pending = []  # 已复制、尚未登记的 (原文件名, 相对路径, 元数据)
+
+    def flush():
+        for file_name, rel_path, meta in pending:
+            cur.execute("INSERT INTO t_files (file_name, file_path, meta) VALUES (?, ?, ?)",
+                        (file_name, rel_path, meta))
+            file_id = cur.lastrowid
+            cur.executemany("INSERT OR IGNORE INTO t_files_tags (file_id, tag_id) VALUES (?, ?)",
+                            [(file_id, tag_id) for tag_id in tag_ids])
+            file_ids.append(file_id)
+        pending.clear()
+        cur.connection.commit()
+
+    # 与 import_time 的默认值 CURRENT_TIMESTAMP 一致用 UTC，迁移时按 import_time 算出的目录与此相同
+    import_month = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m")
+    for f in paths:
+        if should_stop and should_stop():
+            break
+        file_name = os.path.basename(f)
+        timestamp = datetime.datetime.now().timestamp()
+        new_filename = f"{timestamp}_{file_name}"
+        dest_dir = os.path.join(files_dir, storage_subdir(new_filename, import_month, layout))
+        os.makedirs(dest_dir, exist_ok=True)
+        dest_abs = os.path.join(dest_dir, new_filename)
+        with perf.timer("io.copy"):
+            shutil.copy(f, dest_abs)
+        perf.count("import.files")
+
+        pending.append((file_name, os.path.relpath(dest_abs, base_dir), extract_metadata(dest_abs)))
+        if len(pending) >= IMPORT_COMMIT_BATCH:
+            flush()
+        if progress:
+            progress(len(file_ids) + len(pending))
+    flush()
+    return file_ids
+
+
+@perf.timed("image.thumbnail")
+def load_thumbnail(path, size=THUMB_SIZE):
+    """解码图片并缩小到 size 以内，返回 PIL Image（像素上限与大图查看相同）"""
+    perf.count("image.open")
+    img = open_large_image(path)
+    img.thumbnail(size)
+    return img
+
+
 # -------------------------
-# 路径解析帮助函数
+# 顺序读取 I/O：导出、哈希、备份、完整性校验共用
 # -------------------------
-def resolve_path(db_path_value):
+# 一次性的整文件顺序读取（哈希、打包、校验）不经过 Python 的缓冲层：
+#   - readinto 到一块复用的大缓冲区（IO_CHUNK，页大小的整数倍），每块不再分配新的 bytes；
+#   - 只需要摘要的大文件用 mmap 直接交给 hashlib，数据不复制到用户态缓冲区；
+#   - 支持的系统上用 posix_fadvise 声明顺序读，drop_cache=True 时读完即释放页缓存，
+#     扫描整个图库（校验、备份）时不把前台正在用的缓存挤出去。
+IO_CHUNK = 4 << 20
+IO_MMAP_MIN = IO_CHUNK  # 一块以内的文件 readinto 一次就读完，mmap 的建立/撤销开销不划算
+
+
+def _fadvise(fd, advice):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+
+def iter_file_chunks(path, start=0, end=None, chunk_size=IO_CHUNK, drop_cache=False):
     """
-    把数据库里存的路径（可能是绝对路径，也可能是相对路径）解析为可打开的绝对路径。
-    规则：
-      - 如果 db_path_value 是绝对路径（os.path.isabs），直接返回；
-      - 否则按 BASE_DIR/db_path_value 拼接并返回。
+    顺序读取文件的 [start, end)，按块产出 memoryview。所有块共用同一块缓冲区，
+    调用方必须在取下一块之前用完（写出、更新摘要）；需要保留时自行 bytes(chunk)。
+    start 不在块边界时第一块只读到下一个边界，之后的读取都按块对齐。
     """
-    if not db_path_value:
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        fd = f.fileno()
+        if hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+            _fadvise(fd, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            pos = start
+            if start:
+                f.seek(start)
+            while end is None or pos < end:
+                want = chunk_size - pos % chunk_size
+                if end is not None:
+                    want = min(want, end - pos)
+                n = f.readinto(view[:want])
+                if not n:
+                    break
+                pos += n
+                yield view[:n]
+        finally:
+            if drop_cache and hasattr(os, "POSIX_FADV_DONTNEED"):
+                _fadvise(fd, os.POSIX_FADV_DONTNEED)
+
+
+@contextlib.contextmanager
+def mapped_file(path):
+    """只读映射整个文件（空文件给出空 bytes），可直接交给 hashlib / zlib / Image.open"""
+    with open(path, "rb", buffering=0) as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            yield m
+
+
+def hash_file(path, algorithm="sha256", drop_cache=False):
+    """文件摘要（十六进制）：大文件走 mmap，其余 readinto 分块"""
+    digest = hashlib.new(algorithm)
+    if os.path.getsize(path) >= IO_MMAP_MIN:
+        with mapped_file(path) as m:
+            digest.update(m)
+        if drop_cache and hasattr(os, "POSIX_FADV_DONTNEED"):
+            with open(path, "rb", buffering=0) as f:
+                _fadvise(f.fileno(), os.POSIX_FADV_DONTNEED)
+    else:
+        for chunk in iter_file_chunks(path, drop_cache=drop_cache):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def crc32_file(path):
+    crc = 0
+    for chunk in iter_file_chunks(path):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def copy_file_hashed(src, dst, algorithm="sha256", drop_cache=False):
+    """边复制边计算摘要（同一块缓冲区读入、更新摘要、写出），返回十六进制摘要；不复制元数据"""
+    digest = hashlib.new(algorithm)
+    with open(dst, "wb", buffering=0) as fout:
+        for chunk in iter_file_chunks(src, drop_cache=drop_cache):
+            digest.update(chunk)
+            # 无缓冲写可能只写出一部分
+            while chunk:
+                n = fout.write(chunk)
+                chunk = chunk[n:]
+    return digest.hexdigest()
+
+
+@perf.timed("export.zip")
+def export_zip(paths, zip_path, progress=None, should_stop=None):
+    """
+    把图片打包为 ZIP，包内使用文件名（重名时加序号），返回写入的文件数。
+    should_stop() 为真时停止并删除未写完的压缩包，返回 None
+    """
+    written = 0
+    used = set()
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        for p in paths:
+            if should_stop and should_stop():
+                break
+            # 与 zf.write 相同的条目信息，数据按 IO_CHUNK 块写入（zf.write 每次只读 8 KB）
+            with zf.open(zipfile.ZipInfo.from_file(p, _unique_arcname(os.path.basename(p), used)), "w") as entry:
+                for chunk in iter_file_chunks(p):
+                    entry.write(chunk)
+            perf.count("export.files")
+            written += 1
+            if progress:
+                progress(written)
+    if written < len(paths):
+        os.remove(zip_path)
         return None
-    if os.path.isabs(db_path_value):
-        return db_path_value
-    return os.path.join(BASE_DIR, db_path_value)
+    return written
+
+
+# -------------------------
+# 流式 ZIP：不生成临时压缩包，边读图片边写入任意可写流
+# -------------------------
+ZIP_STREAM_CHUNK = 1 << 20
+
+
+def _unique_arcname(name, used):
+    """包内文件名去重：同名文件依次改为 name (2).ext、name (3).ext"""
+    arcname, n = name, 1
+    stem, ext = os.path.splitext(name)
+    while arcname in used:
+        n += 1
+        arcname = f"{stem} ({n}){ext}"
+    used.add(arcname)
+    return arcname
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipStreamPlan:
+    """
+    预先排好版的 ZIP：条目全部为 STORED（图片本身已压缩），每个条目后跟数据描述符，
+    因此不读文件内容就能算出每一段的偏移和总大小，可以从任意偏移开始输出（HTTP Range 续传），
+    写入 socket、管道、HTTP 响应等不可 seek 的流，内存只占一个读块。
+    crc32 在第一次完整输出某个文件时计算并缓存；中央目录或数据描述符需要尚未算过的 crc 时补读该文件。
+    文件在计划创建之后大小发生变化时输出中止（抛出 OSError）。
+    """
+    ZIP64_LIMIT = 0xFFFFFFFF  # 达到该值的大小/偏移改用 zip64 扩展字段记录
+    _MARKER = 0xFFFFFFFF      # 32 位字段中表示「见 zip64 扩展字段」的值
+    _FLAGS = 0x08 | 0x800  # 数据描述符 + 文件名为 UTF-8
+
+    def __init__(self, paths):
+        self.entries = []
+        self._crc_lock = threading.Lock()
+        used = set()
+        offset = 0
+        for path in paths:
+            st = os.stat(path)
+            name = _unique_arcname(os.path.basename(path), used).encode("utf-8")
+            entry = {"path": path, "name": name, "size": st.st_size, "offset": offset, "crc": None,
+                     "zip64": st.st_size >= self.ZIP64_LIMIT, "dos": _dos_datetime(st.st_mtime)}
+            self.entries.append(entry)
+            offset += len(self._local_header(entry)) + entry["size"] + (24 if entry["zip64"] else 16)
+        self.cd_offset = offset
+        self.cd_size = sum(len(self._central_header(e, crc=0)) for e in self.entries)
+        self.size = self.cd_offset + self.cd_size + len(self._end_records())
+
+    # ---- 各段的字节 ----
+    def _local_header(self, e):
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if e["zip64"] else b""
+        size_field = self._MARKER if e["zip64"] else 0
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if e["zip64"] else 20, self._FLAGS, 0,
+                           e["dos"][0], e["dos"][1], 0, size_field, size_field,
+                           len(e["name"]), len(extra)) + e["name"] + extra
+
+    def _descriptor(self, e):
+        if e["zip64"]:
+            return struct.pack("<IIQQ", 0x08074b50, e["crc"], e["size"], e["size"])
+        return struct.pack("<IIII", 0x08074b50, e["crc"], e["size"], e["size"])
+
+    def _central_header(self, e, crc):
+        extra_values = []
+        size_field = e["size"]
+        if e["size"] >= self.ZIP64_LIMIT:
+            extra_values += [e["size"], e["size"]]
+            size_field = self._MARKER
+        offset_field = e["offset"]
+        if e["offset"] >= self.ZIP64_LIMIT:
+            extra_values.append(e["offset"])
+            offset_field = self._MARKER
+        extra = struct.pack(f"<HH{len(extra_values)}Q", 1, 8 * len(extra_values), *extra_values) if extra_values else b""
+        version = 45 if extra_values else 20
+        # 高字节 3 = Unix，外部属性为权限位
+        return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, (3 << 8) | version, version, self._FLAGS, 0,
+                           e["dos"][0], e["dos"][1], crc, size_field, size_field,
+                           len(e["name"]), len(extra), 0, 0, 0, 0o100644 << 16, offset_field) + e["name"] + extra
+
+    def _end_records(self):
+        count = len(self.entries)
+        records = b""
+        zip64 = count >= 0xFFFF or self.cd_offset >= self.ZIP64_LIMIT or self.cd_size >= self.ZIP64_LIMIT
+        if zip64:
+            eocd64_offset = self.cd_offset + self.cd_size
+            records += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count,
+                                   self.cd_size, self.cd_offset)
+            records += struct.pack("<IIQI", 0x07064b50, 0, eocd64_offset, 1)
+        count16 = 0xFFFF if zip64 else count
+        records += struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count16, count16,
+                               self._MARKER if zip64 else self.cd_size, self._MARKER if zip64 else self.cd_offset, 0)
+        return records
+
+    def _crc(self, e):
+        """补算未输出过的文件的 crc32"""
+        if e["crc"] is None:
+            crc, n = 0, 0
+            for chunk in iter_file_chunks(e["path"]):
+                crc = zlib.crc32(chunk, crc)
+                n += len(chunk)
+            if n != e["size"]:
+                raise OSError(f"文件大小已变化：{e['path']}")
+            with self._crc_lock:
+                e["crc"] = crc
+        return e["crc"]
+
+    def _segments(self):
+        """按输出顺序给出 (长度, 生成该段字节的函数 或 文件条目)"""
+        for e in self.entries:
+            header = self._local_header(e)
+            yield len(header), (lambda h=header: h)
+            yield e["size"], e
+            yield (24 if e["zip64"] else 16), (lambda e=e: (self._crc(e), self._descriptor(e))[1])
+        for e in self.entries:
+            header_len = len(self._central_header(e, crc=0))
+            yield header_len, (lambda e=e: self._central_header(e, self._crc(e)))
+        end = self._end_records()
+        yield len(end), (lambda: end)
+
+    def _file_range(self, e, start, end):
+        """输出文件内容的 [start, end)；从头读到尾时顺便算出 crc"""
+        compute_crc = e["crc"] is None and start == 0 and end == e["size"]
+        crc, pos = 0, start
+        # 多读 1 字节用于发现文件变大
+        for chunk in iter_file_chunks(e["path"], start, end + 1 if compute_crc else end, ZIP_STREAM_CHUNK):
+            if pos + len(chunk) > end:
+                raise OSError(f"文件大小已变化：{e['path']}")
+            if compute_crc:
+                crc = zlib.crc32(chunk, crc)
+            pos += len(chunk)
+            yield chunk
+        if pos != end:
+            raise OSError(f"文件大小已变化：{e['path']}")
+        if compute_crc:
+            with self._crc_lock:
+                e["crc"] = crc
+
+    def iter_bytes(self, start=0, end=None):
+        """按块生成 ZIP 的 [start, end) 字节；文件内容块与 iter_file_chunks 一样复用缓冲区，取下一块前须用完"""
+        end = self.size if end is None else min(end, self.size)
+        pos = 0
+        for length, source in self._segments():
+            seg_start, seg_end = pos, pos + length
+            pos = seg_end
+            if seg_end <= start or length == 0:
+                continue
+            if seg_start >= end:
+                break
+            lo, hi = max(start, seg_start) - seg_start, min(end, seg_end) - seg_start
+            if isinstance(source, dict):
+                yield from self._file_range(source, lo, hi)
+                perf.count("export.files")
+            else:
+                yield source()[lo:hi]
+
+    def write_to(self, out, start=0, end=None, progress=None, should_stop=None):
+        """写入任意可写流（不需要 seek），返回写入的字节数；should_stop() 为真时在块之间停止"""
+        written = 0
+        for chunk in self.iter_bytes(start, end):
+            if should_stop and should_stop():
+                break
+            out.write(chunk)
+            written += len(chunk)
+            if progress:
+                progress(written, self.size)
+        perf.count("export.stream_bytes", written)
+        return written
+
+
+@perf.timed("export.zip_stream")
+def export_zip_stream(paths, out, progress=None, should_stop=None):
+    """把图片以 ZIP 格式流式写入 out（文件、管道、socket 等），返回写入的字节数"""
+    return ZipStreamPlan(paths).write_to(out, progress=progress, should_stop=should_stop)
+
+
+class _ZipExportHandler(BaseHTTPRequestHandler):
+    """GET/HEAD /<令牌>/<名称>.zip，支持单段 Range: bytes=a-b"""
+
+    def _plan(self):
+        token = self.path.lstrip("/").split("/", 1)[0]
+        return self.server.exports.get(token)
+
+    def _send_headers(self, plan):
+        start, end = 0, plan.size
+        status = 200
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", "").strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)) + 1, plan.size) if match.group(2) else plan.size
+            else:
+                start = max(0, plan.size - int(match.group(2)))
+            if start >= end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{plan.size}")
+                self.end_headers()
+                return None
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{plan.size}")
+        filename = urllib.parse.unquote(self.path.rsplit("/", 1)[-1]) or "images.zip"
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}")
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self):
+        plan = self._plan()
+        if plan is None:
+            self.send_error(404)
+            return
+        self._send_headers(plan)
+
+    def do_GET(self):
+        plan = self._plan()
+        if plan is None:
+            self.send_error(404)
+            return
+        span = self._send_headers(plan)
+        if span is None:
+            return
+        try:
+            plan.write_to(self.wfile, *span)
+        except (BrokenPipeError, ConnectionResetError):
+            # 浏览器取消或暂停下载，之后会带 Range 续传
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ZipExportServer:
+    """
+    本机 HTTP 下载服务（只监听 127.0.0.1，端口随机）。每次导出注册一个随机令牌，
+    浏览器或 curl/wget 下载时实时生成 ZIP，支持 Range 续传；程序退出时随之结束。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), _ZipExportHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.exports = {}
+        threading.Thread(target=self.httpd.serve_forever, name="zip-export-server", daemon=True).start()
+
+    def add(self, paths, name="images"):
+        """注册一次导出，返回下载地址"""
+        token = secrets.token_urlsafe(12)
+        self.httpd.exports[token] = ZipStreamPlan(paths)
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/{token}/{urllib.parse.quote(name)}.zip"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ================================================
+#    批量标签操作：集合式 SQL，单事务，可撤销
+# ================================================
+def _load_bulk_targets(file_ids=None, query=None):
+    """
+    把操作目标装入临时表 t_bulk_targets(file_id)
+    - file_ids：勾选的文件 id 列表
+    - query：(sql, params)，第一列为 file_id；直接 INSERT ... SELECT，不把结果读进 Python
+    """
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS t_bulk_targets (file_id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM t_bulk_targets")
+    if query is not None:
+        sql, params = query
+        cursor.execute(f"INSERT OR IGNORE INTO t_bulk_targets (file_id) SELECT file_id FROM ({sql})", params)
+    else:
+        cursor.executemany("INSERT OR IGNORE INTO t_bulk_targets (file_id) VALUES (?)",
+                           ((fid,) for fid in file_ids or ()))
+
+
+@perf.timed("db.bulk_tag_files")
+def bulk_tag_files(action, tag_id, file_ids=None, query=None, from_tag_id=None, description=""):
+    """
+    对一批文件批量修改标签，整个操作在一个事务内完成
+      action = "add"    给目标文件添加 tag_id（已有的跳过）
+      action = "remove" 从目标文件移除 tag_id
+      action = "move"   目标文件中带 from_tag_id 的，改为 tag_id
+    目标由 file_ids 或 query 指定（见 _load_bulk_targets）。
+    先把要增删的关联写入 t_tag_op_links，再据此执行增删，撤销时按日志反向操作。
+    返回 (op_id, 新增条数, 移除条数)
+    """
+    with conn:
+        return _apply_bulk_tag_op(action, tag_id, file_ids, query, from_tag_id, description)
+
+
+def _apply_bulk_tag_op(action, tag_id, file_ids=None, query=None, from_tag_id=None, description=""):
+    """bulk_tag_files 的事务内部分，不提交，供其他单事务操作（如拆分标签）复用"""
+    if action not in ("add", "remove", "move"):
+        raise ValueError(f"未知的批量操作: {action}")
+    if action == "move" and (from_tag_id is None or from_tag_id == tag_id):
+        raise ValueError("移动标签需要指定不同的源标签")
+
+    _load_bulk_targets(file_ids, query)
+    cursor.execute("INSERT INTO t_tag_ops (description) VALUES (?)", (description or action,))
+    op_id = cursor.lastrowid
+
+    if action == "move":
+        # 只处理带源标签的文件
+        cursor.execute("""
+            DELETE FROM t_bulk_targets
+            WHERE file_id NOT IN (SELECT file_id FROM t_files_tags WHERE tag_id=?)
+        """, (from_tag_id,))
+
+    remove_tag_id = tag_id if action == "remove" else from_tag_id
+    removed = 0
+    if remove_tag_id is not None:
+        cursor.execute("""
+            INSERT INTO t_tag_op_links (op_id, file_id, tag_id, action)
+            SELECT ?, ft.file_id, ft.tag_id, 'remove'
+            FROM t_files_tags ft
+            JOIN t_bulk_targets b ON b.file_id = ft.file_id
+            WHERE ft.tag_id = ?
+        """, (op_id, remove_tag_id))
+        cursor.execute("""
+            DELETE FROM t_files_tags
+            WHERE tag_id = ? AND file_id IN (SELECT file_id FROM t_bulk_targets)
+        """, (remove_tag_id,))
+        removed = cursor.rowcount
+
+    added = 0
+    if action in ("add", "move"):
+        cursor.execute("""
+            INSERT INTO t_tag_op_links (op_id, file_id, tag_id, action)
+            SELECT ?, b.file_id, ?, 'add'
+            FROM t_bulk_targets b
+            WHERE NOT EXISTS (
+                SELECT 1 FROM t_files_tags ft WHERE ft.file_id = b.file_id AND ft.tag_id = ?
+            )
+        """, (op_id, tag_id, tag_id))
+        cursor.execute("""
+            INSERT INTO t_files_tags (file_id, tag_id)
+            SELECT file_id, tag_id FROM t_tag_op_links WHERE op_id = ? AND action = 'add'
+        """, (op_id,))
+        added = cursor.rowcount
+
+    # 只保留最近 TAG_UNDO_HISTORY 次操作的撤销日志
+    cursor.execute("""
+        DELETE FROM t_tag_op_links WHERE op_id IN (
+            SELECT op_id FROM t_tag_ops ORDER BY op_id DESC LIMIT -1 OFFSET ?
+        )
+    """, (TAG_UNDO_HISTORY,))
+    cursor.execute("""
+        DELETE FROM t_tag_ops WHERE op_id IN (
+            SELECT op_id FROM t_tag_ops ORDER BY op_id DESC LIMIT -1 OFFSET ?
+        )
+    """, (TAG_UNDO_HISTORY,))
+    return op_id, added, removed
+
+
+def get_last_tag_op():
+    """返回最近一次尚未撤销的批量操作 (op_id, description)，没有则返回 None"""
+    cursor.execute("SELECT op_id, description FROM t_tag_ops WHERE undone=0 ORDER BY op_id DESC LIMIT 1")
+    return cursor.fetchone()
+
+
+@perf.timed("db.undo_tag_op")
+def undo_tag_op(op_id):
+    """按日志撤销一次批量操作：删除当时新增的关联，恢复当时移除的关联（已被删除的文件/标签跳过）"""
+    with conn:
+        cursor.execute("""
+            DELETE FROM t_files_tags
+            WHERE (file_id, tag_id) IN (
+                SELECT file_id, tag_id FROM t_tag_op_links WHERE op_id = ? AND action = 'add'
+            )
+        """, (op_id,))
+        cursor.execute("""
+            INSERT INTO t_files_tags (file_id, tag_id)
+            SELECT l.file_id, l.tag_id FROM t_tag_op_links l
+            WHERE l.op_id = ? AND l.action = 'remove'
+              AND l.file_id IN (SELECT file_id FROM t_files)
+              AND l.tag_id IN (SELECT tag_id FROM t_tags)
+        """, (op_id,))
+        cursor.execute("UPDATE t_tag_ops SET undone=1 WHERE op_id=?", (op_id,))
+        cursor.execute("DELETE FROM t_tag_op_links WHERE op_id=?", (op_id,))
+
+
+# ================================================
+#   标签 / 维度维护：合并、重命名、拆分、删除
+#   均为单事务内的集合式语句，tag_id 保持稳定（重命名原地更新，
+#   合并时保留目标标签的 id），关联记录依赖外键级联删除
+# ================================================
+@perf.timed("db.merge_tags")
+def merge_tags(source_ids, target_id):
+    """把 source_ids 的所有关联并入 target_id，然后删除源标签（关联随外键级联删除）"""
+    source_ids = [t for t in source_ids if t != target_id]
+    if not source_ids:
+        return
+    placeholder = ",".join("?" * len(source_ids))
+    with conn:
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO t_files_tags (file_id, tag_id)
+            SELECT file_id, ? FROM t_files_tags WHERE tag_id IN ({placeholder})
+        """, [target_id] + source_ids)
+        # 保存的搜索中引用源标签的改为引用目标标签（删除源标签时这些搜索会标记为 stale 并重算）
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO t_saved_search_tags (search_id, tag_id)
+            SELECT search_id, ? FROM t_saved_search_tags WHERE tag_id IN ({placeholder})
+        """, [target_id] + source_ids)
+        cursor.execute(f"DELETE FROM t_tags WHERE tag_id IN ({placeholder})", source_ids)
+
+
+def rename_tag(tag_id, new_name):
+    """
+    重命名子标签，tag_id 不变。
+    若同维度下已存在同名标签，则合并到已有标签，返回合并后的 tag_id。
+    """
+    cursor.execute("SELECT parent FROM t_tags WHERE tag_id=?", (tag_id,))
+    r = cursor.fetchone()
+    if not r:
+        return None
+    existing = get_tag_id(r[0], new_name)
+    if existing is not None and existing != tag_id:
+        merge_tags([tag_id], existing)
+        return existing
+    with conn:
+        cursor.execute("UPDATE t_tags SET name=? WHERE tag_id=?", (new_name, tag_id))
+    return tag_id
+
+
+@perf.timed("db.rename_dimension")
+def rename_dimension(old_name, new_name):
+    """
+    重命名大维度。若新维度已存在，同名子标签合并（保留新维度下的 tag_id），
+    其余子标签整体改挂到新维度下，tag_id 不变。
+    """
+    if old_name == new_name:
+        return
+    with conn:
+        cursor.execute("""
+            INSERT OR IGNORE INTO t_files_tags (file_id, tag_id)
+            SELECT ft.file_id, n.tag_id
+            FROM t_files_tags ft
+            JOIN t_tags o ON o.tag_id = ft.tag_id
+            JOIN t_tags n ON n.parent = ? AND n.name = o.name
+            WHERE o.parent = ?
+        """, (new_name, old_name))
+        cursor.execute("""
+            INSERT OR IGNORE INTO t_saved_search_tags (search_id, tag_id)
+            SELECT st.search_id, n.tag_id
+            FROM t_saved_search_tags st
+            JOIN t_tags o ON o.tag_id = st.tag_id
+            JOIN t_tags n ON n.parent = ? AND n.name = o.name
+            WHERE o.parent = ?
+        """, (new_name, old_name))
+        cursor.execute("""
+            DELETE FROM t_tags
+            WHERE parent = ? AND name IN (SELECT name FROM t_tags WHERE parent = ?)
+        """, (old_name, new_name))
+        cursor.execute("UPDATE t_tags SET parent=? WHERE parent=?", (new_name, old_name))
+
+
+def split_tag(tag_id, new_name, file_ids=None, query=None):
+    """
+    拆分子标签：在同一维度下新建（或复用）new_name，把目标文件上的 tag_id 移到新标签。
+    目标由 file_ids / query 指定（同 bulk_tag_files），与新建标签在同一事务内完成，可撤销。
+    返回 (新标签 tag_id, 移动的文件数)
+    """
+    cursor.execute("SELECT parent, name FROM t_tags WHERE tag_id=?", (tag_id,))
+    r = cursor.fetchone()
+    if not r:
+        return None, 0
+    parent, old_name = r
+    with conn:
+        new_id = get_tag_id(parent, new_name)
+        if new_id is None:
+            cursor.execute("INSERT INTO t_tags (parent, name) VALUES (?, ?)", (parent, new_name))
+            new_id = cursor.lastrowid
+        _, _, moved = _apply_bulk_tag_op("move", new_id, file_ids, query, from_tag_id=tag_id,
+                                         description=f"拆分 {parent}:{old_name} → {parent}:{new_name}")
+    return new_id, moved
+
+
+def count_tag_links(tag_ids):
+    if not tag_ids:
+        return 0
+    cursor.execute(f"SELECT COUNT(*) FROM t_files_tags WHERE tag_id IN ({','.join('?' * len(tag_ids))})",
+                   list(tag_ids))
+    return cursor.fetchone()[0]
+
+
+@perf.timed("db.delete_tags")
+def delete_tags(tag_ids, chunk_size=None, progress=None, should_stop=None):
+    """
+    删除标签及其全部关联。
+    - chunk_size 为 None：一条 DELETE 删除标签，关联由外键级联删除，单事务
+    - 指定 chunk_size：先按批删除关联记录，每批单独提交（期间读操作不受长事务影响），
+      最后再删除标签本身；progress(已删除条数) 在每批之后回调。
+      should_stop() 为真时在批次之间停止：已删除的关联不恢复，标签本身保留，返回 None
+    """
+    tag_ids = list(tag_ids)
+    if not tag_ids:
+        return 0
+    placeholder = ",".join("?" * len(tag_ids))
+    deleted = 0
+    if chunk_size:
+        while True:
+            with conn:
+                cursor.execute(f"""
+                    DELETE FROM t_files_tags WHERE id IN (
+                        SELECT id FROM t_files_tags WHERE tag_id IN ({placeholder}) LIMIT ?
+                    )
+                """, tag_ids + [chunk_size])
+                n = cursor.rowcount
+            deleted += n
+            if progress:
+                progress(deleted)
+            if n < chunk_size:
+                break
+            if should_stop and should_stop():
+                return None
+    with conn:
+        cursor.execute(f"DELETE FROM t_tags WHERE tag_id IN ({placeholder})", tag_ids)
+    return deleted
+
+
+def get_dimension_tag_ids(parent):
+    """维度下全部 tag_id（含维度占位行）"""
+    cursor.execute("SELECT tag_id FROM t_tags WHERE parent=?", (parent,))
+    return [r[0] for r in cursor.fetchall()]
+
+
+# -------------------------
+# 标签共现统计 / 标签建议
+# -------------------------
+# t_tag_cooccur 记录每对标签同时出现在多少个文件上：只存 tag_a <= tag_b 的一半，
+# tag_a = tag_b 的对角线就是该标签的文件数。rebuild_tag_cooccurrence() 一次性统计（有 NumPy 时
+# 在内存中向量化计数，否则用 SQL 自连接），之后由 t_files_tags 上的触发器增量维护（导入、批量标签操作、
+# 合并、撤销、级联删除都经过这里）；t_settings 中没有 TAG_COOCCUR_READY_KEY（尚未统计）时触发器不动作。
+TAG_COOCCUR_READY_KEY = "tag_cooccur_ready"
+TAG_COOCCUR_DDL = """
+    CREATE TABLE IF NOT EXISTS t_tag_cooccur (
+        tag_a INTEGER NOT NULL,
+        tag_b INTEGER NOT NULL,
+        cnt INTEGER NOT NULL,
+        PRIMARY KEY (tag_a, tag_b)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_tag_cooccur_b ON t_tag_cooccur(tag_b, tag_a);
+
+    CREATE TRIGGER IF NOT EXISTS trg_cooccur_links_ai AFTER INSERT ON t_files_tags
+    WHEN EXISTS (SELECT 1 FROM t_settings WHERE key = 'tag_cooccur_ready') BEGIN
+        INSERT INTO t_tag_cooccur (tag_a, tag_b, cnt)
+        SELECT MIN(new.tag_id, ft.tag_id), MAX(new.tag_id, ft.tag_id), 1
+        FROM t_files_tags ft WHERE ft.file_id = new.file_id
+        ON CONFLICT (tag_a, tag_b) DO UPDATE SET cnt = cnt + 1;
+    END;
+    -- 只清理本次减到 0 的那几对（按主键查找），不扫描该标签的全部搭配；
+    -- 早期版本按 tag_a / tag_b 整体扫描，先删除再重建
+    DROP TRIGGER IF EXISTS trg_cooccur_links_ad;
+    CREATE TRIGGER trg_cooccur_links_ad AFTER DELETE ON t_files_tags
+    WHEN EXISTS (SELECT 1 FROM t_settings WHERE key = 'tag_cooccur_ready') BEGIN
+        UPDATE t_tag_cooccur SET cnt = cnt - 1
+        WHERE tag_a = old.tag_id AND tag_b IN (
+            SELECT old.tag_id UNION ALL
+            SELECT tag_id FROM t_files_tags WHERE file_id = old.file_id AND tag_id > old.tag_id);
+        UPDATE t_tag_cooccur SET cnt = cnt - 1
+        WHERE tag_b = old.tag_id AND tag_a IN (
+            SELECT tag_id FROM t_files_tags WHERE file_id = old.file_id AND tag_id < old.tag_id);
+        DELETE FROM t_tag_cooccur
+        WHERE tag_a = old.tag_id AND cnt <= 0 AND tag_b IN (
+            SELECT old.tag_id UNION ALL
+            SELECT tag_id FROM t_files_tags WHERE file_id = old.file_id AND tag_id > old.tag_id);
+        DELETE FROM t_tag_cooccur
+        WHERE tag_b = old.tag_id AND cnt <= 0 AND tag_a IN (
+            SELECT tag_id FROM t_files_tags WHERE file_id = old.file_id AND tag_id < old.tag_id);
+    END;
+"""
+# 导入页最多显示的建议标签数；共现次数低于 TAG_SUGGEST_MIN_COUNT 的组合不作为建议
+TAG_SUGGEST_LIMIT = 6
+TAG_SUGGEST_MIN_COUNT = 2
+# 统计窗口列出的标签 / 标签对数
+TAG_STATS_LIMIT = 200
+
+
+def _numpy():
+    """可选依赖 NumPy：用于向量化统计共现，未安装时返回 None（回退到 SQL）"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def tag_cooccurrence_ready(cur=None):
+    return get_setting(TAG_COOCCUR_READY_KEY, cur=cur) is not None
+
+
+def _count_cooccurrence_numpy(np, file_ids, tag_ids, should_stop=None):
+    """
+    file_ids / tag_ids 为按 (file_id, tag_id) 排好序的关联（int64 数组），
+    返回 (tag_a, tag_b, cnt) 三个数组（tag_a <= tag_b，含对角线）；should_stop() 为真时返回 None。
+    同一文件的关联相邻，第 d 轮把每条关联与其后第 d 条（仍属同一文件时）配对，
+    候选下标逐轮缩小，总工作量与标签对数成正比；标签对编码为 tag_a * span + tag_b 后排序计数
+    """
+    n = len(tag_ids)
+    diag = np.bincount(tag_ids)
+    diag_tags = np.flatnonzero(diag)
+    if n < 2:
+        return diag_tags, diag_tags.copy(), diag[diag_tags]
+    span = np.int64(diag.size)
+    codes = []
+    idx = np.arange(n - 1)
+    d = 1
+    while idx.size:
+        if should_stop and should_stop():
+            return None
+        idx = idx[idx + d < n]
+        idx = idx[file_ids[idx + d] == file_ids[idx]]
+        if idx.size:
+            codes.append(tag_ids[idx] * span + tag_ids[idx + d])
+        d += 1
+    if codes:
+        pairs, counts = np.unique(np.concatenate(codes), return_counts=True)
+    else:
+        pairs = counts = np.zeros(0, dtype=np.int64)
+    return (np.concatenate([diag_tags, pairs // span]), np.concatenate([diag_tags, pairs % span]),
+            np.concatenate([diag[diag_tags], counts]))
+
+
+@perf.timed("db.rebuild_tag_cooccurrence")
+def rebuild_tag_cooccurrence(progress=None, should_stop=None, use_numpy=True):
+    """
+    重新统计 t_tag_cooccur 并启用触发器增量维护，返回标签对数（含对角线）。
+    读取关联和写入结果在同一个写事务中：统计期间其他连接的写操作排在其后，不会漏计或重复计数。
+    progress(已完成步骤, 3) 在读取、计数、写入之后回调；should_stop() 为真时放弃（保留原有统计），返回 None
+    """
+    np = _numpy() if use_numpy else None
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DELETE FROM t_tag_cooccur")
+        if np is None:
+            with perf.timer("cooccur.sql"):
+                cursor.execute("""
+                    INSERT INTO t_tag_cooccur (tag_a, tag_b, cnt)
+                    SELECT a.tag_id, b.tag_id, COUNT(*)
+                    FROM t_files_tags a JOIN t_files_tags b ON b.file_id = a.file_id AND b.tag_id >= a.tag_id
+                    GROUP BY a.tag_id, b.tag_id
+                """)
+            total = cursor.rowcount
+        else:
+            with perf.timer("cooccur.read"):
+                n = cursor.execute("SELECT COUNT(*) FROM t_files_tags").fetchone()[0]
+                links = np.fromiter(
+                    cursor.execute("SELECT file_id, tag_id FROM t_files_tags ORDER BY file_id, tag_id"),
+                    dtype=np.dtype([("file_id", np.int64), ("tag_id", np.int64)]), count=n)
+            if progress:
+                progress(1, 3)
+            with perf.timer("cooccur.count"):
+                counted = _count_cooccurrence_numpy(np, links["file_id"], links["tag_id"], should_stop)
+            if counted is None:
+                conn.rollback()
+                return None
+            if progress:
+                progress(2, 3)
+            with perf.timer("cooccur.write"):
+                cursor.executemany("INSERT INTO t_tag_cooccur (tag_a, tag_b, cnt) VALUES (?, ?, ?)",
+                                   zip(*(a.tolist() for a in counted)))
+            total = len(counted[2])
+        if should_stop and should_stop():
+            conn.rollback()
+            return None
+        set_setting(TAG_COOCCUR_READY_KEY, datetime.datetime.now().isoformat(timespec="seconds"))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if progress:
+        progress(3, 3)
+    return total
+
+
+def _tag_labels(tag_ids):
+    """{tag_id: (parent, name)}，只含子标签（不含维度占位行）"""
+    tag_ids = list(tag_ids)
+    labels = {}
+    for i in range(0, len(tag_ids), 500):
+        chunk = tag_ids[i:i + 500]
+        cursor.execute(f"SELECT tag_id, parent, name FROM t_tags WHERE tag_id IN ({','.join('?' * len(chunk))})"
+                       " AND name != ''", chunk)
+        labels.update((tag_id, (parent, name)) for tag_id, parent, name in cursor.fetchall())
+    return labels
+
+
+@perf.timed("db.suggest_tags")
+def suggest_tags(tag_ids, limit=TAG_SUGGEST_LIMIT, min_count=TAG_SUGGEST_MIN_COUNT):
+    """
+    按共现统计为已选标签推荐其他标签，返回 [(tag_id, parent, name, score)]，按 score 降序。
+    score 为 P(候选 | 已选标签) 对各已选标签的平均值：同时常和所有已选标签一起出现的标签排在前面；
+    与已选标签的共现次数合计少于 min_count 的不推荐。没有已选标签或尚未统计时返回 []
+    """
+    selected = set(tag_ids)
+    if not selected:
+        return []
+    placeholder = ",".join("?" * len(selected))
+    cursor.execute(f"""
+        SELECT tag_a, tag_b, cnt FROM t_tag_cooccur WHERE tag_a IN ({placeholder})
+        UNION ALL
+        SELECT tag_b, tag_a, cnt FROM t_tag_cooccur WHERE tag_b IN ({placeholder}) AND tag_a NOT IN ({placeholder})
+    """, list(selected) * 3)
+    rows = cursor.fetchall()
+    freq = {a: cnt for a, b, cnt in rows if a == b}
+    score, support = {}, {}
+    for sel, other, cnt in rows:
+        if other in selected or not freq.get(sel):
+            continue
+        score[other] = score.get(other, 0.0) + cnt / freq[sel]
+        support[other] = support.get(other, 0) + cnt
+    ranked = sorted((c for c in score if support[c] >= min_count), key=lambda c: (-score[c], c))
+    labels = _tag_labels(ranked[:limit * 2])
+    return [(c, *labels[c], score[c] / len(selected)) for c in ranked if c in labels][:limit]
+
+
+@perf.timed("db.tag_cooccurrence_stats")
+def tag_cooccurrence_stats(tag_id=None, limit=TAG_STATS_LIMIT):
+    """
+    统计视图的数据：
+    - tags：[(tag_id, parent, name, 文件数)]，按文件数降序
+    - pairs：[(parent_a, name_a, parent_b, name_b, 共现数, P(B|A), P(A|B), 提升度)]，按共现数降序；
+      指定 tag_id 时只列出含该标签的组合（A 为该标签）
+    提升度 = 共现数 × 文件总数 / (A 的文件数 × B 的文件数)，大于 1 表示两者比随机搭配更常一起出现
+    """
+    total_files = cursor.execute("SELECT COUNT(*) FROM t_files").fetchone()[0]
+    cursor.execute("SELECT tag_a, cnt FROM t_tag_cooccur WHERE tag_a = tag_b")
+    freq = dict(cursor.fetchall())
+    top_tags = sorted(freq, key=lambda t: -freq[t])
+    if tag_id is None:
+        cursor.execute("SELECT tag_a, tag_b, cnt FROM t_tag_cooccur WHERE tag_a != tag_b ORDER BY cnt DESC LIMIT ?",
+                       (limit * 2,))
+        pair_rows = cursor.fetchall()
+    else:
+        cursor.execute("""
+            SELECT tag_a, tag_b, cnt FROM t_tag_cooccur WHERE tag_a = ? AND tag_b != ?
+            UNION ALL
+            SELECT tag_b, tag_a, cnt FROM t_tag_cooccur WHERE tag_b = ? AND tag_a != ?
+            ORDER BY cnt DESC LIMIT ?
+        """, (tag_id, tag_id, tag_id, tag_id, limit * 2))
+        pair_rows = cursor.fetchall()
+    labels = _tag_labels(set(top_tags[:limit * 2]) | {t for a, b, _ in pair_rows for t in (a, b)})
+    tags = [(t, *labels[t], freq[t]) for t in top_tags if t in labels][:limit]
+    pairs = []
+    for a, b, cnt in pair_rows:
+        if a in labels and b in labels and freq.get(a) and freq.get(b):
+            pairs.append((*labels[a], *labels[b], cnt, cnt / freq[a], cnt / freq[b],
+                          cnt * total_files / (freq[a] * freq[b])))
+    return {"files": total_files, "tags": tags, "pairs": pairs[:limit]}
+
+
+# -------------------------
+# 路径解析帮助函数
+# -------------------------
+def resolve_path(db_path_value, import_time=None):
+    """
+    把数据库里存的路径（可能是绝对路径，也可能是相对路径）解析为可打开的绝对路径。
+    规则：
+      - 如果 db_path_value 是绝对路径（os.path.isabs），直接返回；
+      - 否则按 BASE_DIR/db_path_value 拼接，文件存在则返回；
+      - 不存在时（存储布局迁移中或被中断）依次检查该文件名在 flat / hash / date 布局下的位置，
+        date 布局的年月取自 import_time（有则用）或文件名的时间戳前缀；只做几次 stat，不扫描目录；
+      - 都找不到时返回 BASE_DIR/db_path_value。
+    """
+    if not db_path_value:
+        return None
+    if os.path.isabs(db_path_value):
+        return db_path_value
+    abs_path = os.path.join(BASE_DIR, db_path_value)
+    if os.path.exists(abs_path):
+        return abs_path
+    for candidate in _layout_candidates(db_path_value, import_time):
+        if candidate != abs_path and os.path.exists(candidate):
+            return candidate
+    return abs_path
+
+
+# -------------------------
+# 存储布局：files/ 下分子目录，避免单目录数十万文件
+# -------------------------
+# flat：files/<文件名>（旧版行为）
+# date：files/<年>/<月>/<文件名>，按导入时间（UTC）
+# hash：files/<ab>/<cd>/<文件名>，取文件名 sha1 的前 4 位，分布均匀
+STORAGE_LAYOUTS = ("flat", "date", "hash")
+LAYOUT_MIGRATION_BATCH = 500
+
+
+def get_storage_layout():
+    layout = get_setting("storage_layout", "flat")
+    return layout if layout in STORAGE_LAYOUTS else "flat"
+
+
+def storage_subdir(stored_name, import_month, layout):
+    """返回 files/ 下的相对子目录；import_month 形如 "2024-05"（取自 import_time 前 7 位）"""
+    if layout == "date" and import_month:
+        year, month = import_month[:7].split("-")
+        return os.path.join(year, month)
+    if layout == "hash":
+        digest = hashlib.sha1(stored_name.encode("utf-8")).hexdigest()
+        return os.path.join(digest[:2], digest[2:4])
+    return ""
+
+
+def _import_months(name, import_time=None):
+    """date 布局下文件可能所在的年月：import_time 的前 7 位，以及导入时加的时间戳前缀（UTC）换算出的年月"""
+    months = []
+    if import_time and re.match(r"\d{4}-\d{2}", str(import_time)):
+        months.append(str(import_time)[:7])
+    prefix = name.split("_", 1)[0]
+    try:
+        month = datetime.datetime.fromtimestamp(float(prefix), datetime.timezone.utc).strftime("%Y-%m")
+    except (ValueError, OverflowError, OSError):
+        month = None
+    if month and month not in months:
+        months.append(month)
+    return months
+
+
+def _layout_candidates(db_path_value, import_time=None):
+    """按文件名推算在各布局下可能的位置（不扫描目录）"""
+    name = os.path.basename(db_path_value.replace("\\", "/"))
+    yield os.path.join(FILES_DIR, name)
+    yield os.path.join(FILES_DIR, storage_subdir(name, None, "hash"), name)
+    for month in _import_months(name, import_time):
+        yield os.path.join(FILES_DIR, storage_subdir(name, month, "date"), name)
+
+
+def _link_or_copy(src, dst):
+    """同一文件系统下用硬链接（瞬间完成、不占额外空间），否则复制"""
+    if os.path.exists(dst):
+        if os.path.getsize(dst) == os.path.getsize(src):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+@perf.timed("storage.migrate_layout")
+def migrate_storage_layout(layout, batch_size=LAYOUT_MIGRATION_BATCH, progress=None, should_stop=None, pause=0.0):
+    """
+    把现有文件迁移到 layout 布局，可在程序运行时执行、随时中断并续传。
+    新导入立即使用新布局。每批：硬链接/复制到新位置 → 一个事务内更新 file_path 并记录进度和待删除的旧路径
+    → 删除旧文件 → 清除待删除记录。任何一步中断，数据库中的路径都指向存在的文件，下次运行从断点继续。
+    使用独立连接，可在后台线程调用。progress(done, total)；should_stop() 返回 True 时在批次之间停止；
+    pause 为每批之间的休眠秒数，给前台操作让出磁盘和写锁。返回本次迁移的文件数。
+    """
+    if layout not in STORAGE_LAYOUTS:
+        raise ValueError(f"未知的存储布局：{layout}")
+    db = sqlite3.connect(DB_PATH, timeout=30)
+    cur = db.cursor()
+    try:
+        state = json.loads(get_setting("layout_migration", "{}", cur))
+        if state.get("layout") != layout:
+            state = {"layout": layout, "last_file_id": 0, "pending": []}
+        with db:
+            set_setting("storage_layout", layout, cur)
+            set_setting("layout_migration", json.dumps(state), cur)
+
+        def remove_pending():
+            for old in state["pending"]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+            state["pending"] = []
+            with db:
+                set_setting("layout_migration", json.dumps(state), cur)
+
+        remove_pending()
+        cur.execute("SELECT COUNT(*) FROM t_files")
+        total = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM t_files WHERE file_id <= ?", (state["last_file_id"],))
+        done = cur.fetchone()[0]
+        moved = 0
+        while True:
+            if should_stop and should_stop():
+                return moved
+            cur.execute("""
+                SELECT file_id, file_path, import_time FROM t_files
+                WHERE file_id > ? ORDER BY file_id LIMIT ?
+            """, (state["last_file_id"], batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            updates, old_paths = [], []
+            for file_id, file_path, import_time in rows:
+                src = resolve_path(file_path, import_time)
+                if not src or not os.path.exists(src):
+                    continue
+                name = os.path.basename(src)
+                dest_dir = os.path.join(FILES_DIR, storage_subdir(name, str(import_time or "")[:7], layout))
+                dst = os.path.join(dest_dir, name)
+                if os.path.abspath(dst) == os.path.abspath(src):
+                    continue
+                os.makedirs(dest_dir, exist_ok=True)
+                with perf.timer("io.copy"):
+                    _link_or_copy(src, dst)
+                updates.append((os.path.relpath(dst, BASE_DIR), file_id))
+                old_paths.append(src)
+            state["last_file_id"] = rows[-1][0]
+            state["pending"] = old_paths
+            with db:
+                cur.executemany("UPDATE t_files SET file_path=? WHERE file_id=?", updates)
+                set_setting("layout_migration", json.dumps(state), cur)
+            remove_pending()
+            moved += len(updates)
+            done += len(rows)
+            if progress:
+                progress(done, total)
+            if pause:
+                time.sleep(pause)
+        # 全部完成：删除进度记录，清理空的旧子目录（非空目录 rmdir 会失败，直接跳过）
+        with db:
+            set_setting("layout_migration", None, cur)
+        for dirpath, _, _ in os.walk(FILES_DIR, topdown=False):
+            if dirpath != FILES_DIR:
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+        return moved
+    finally:
+        db.close()
+
+
+# -------------------------
+# 转码：BMP/PNG 等大文件转为 WebP 或高质量 JPEG
+# -------------------------
+# 策略按图库保存在 t_settings["transcode_policy"]（JSON）：
+#   enabled：是否启用；on_import：导入后立即转码（否则只在手动/后台转码时处理）
+#   format：webp / jpeg；quality：1-100；sources：参与转码的原格式（Pillow 的 format 名）
+#   keep_days：原图保留天数，0 为转码后立即删除
+# 转码结果不比原图小时保留原图，只记录大小。
+TRANSCODE_DEFAULT_POLICY = {
+    "enabled": False,
+    "on_import": False,
+    "format": "webp",
+    "quality": 90,
+    "sources": ["BMP", "PNG"],
+    "keep_days": 30,
+}
+TRANSCODE_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+TRANSCODE_WORKERS = int(os.environ.get("IMAGES_TRANSCODE_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+TRANSCODE_BATCH = 64
+
+
+def get_transcode_policy(cur=None):
+    policy = dict(TRANSCODE_DEFAULT_POLICY)
+    try:
+        policy.update(json.loads(get_setting("transcode_policy", "{}", cur)))
+    except ValueError:
+        pass
+    return policy
+
+
+def set_transcode_policy(policy, cur=None):
+    set_setting("transcode_policy", json.dumps(policy), cur)
+
+
+def _transcode_one(src, dst, fmt, quality, sources):
+    """
+    进程池中执行：解码 src 并编码为 dst。
+    返回 (原大小, 新大小)；原格式不在 sources 中时返回 (原大小, None)，不写文件。
+    """
+    original_size = os.path.getsize(src)
+    with Image.open(src) as img:
+        if img.format not in sources:
+            return original_size, None
+        img.load()
+        if fmt == "jpeg":
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            img.save(dst, "JPEG", quality=quality, optimize=True, subsampling=0 if quality >= 90 else 2)
+        else:
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+            img.save(dst, "WEBP", quality=quality, method=4)
+    return original_size, os.path.getsize(dst)
+
+
+@perf.timed("storage.transcode")
+def transcode_files(library=None, file_ids=None, policy=None, workers=None, progress=None, should_stop=None,
+                    on_import=False):
+    """
+    按转码策略并行转码尚未处理的文件（进程池编码，主进程只做数据库更新），使用独立连接，可在后台线程调用。
+    library 为 None 时处理本库；file_ids 限定范围（如刚导入的文件）；policy 默认读取该库的策略，
+    显式传入时即使未启用也执行（用于手动转码）；on_import=True 时只在策略开启了导入时转码才执行。
+    新文件写在原图同目录（扩展名改为目标格式），file_path 指向新文件；原图按 keep_days 保留或立即删除。
+    返回 (处理文件数, 原总字节, 新总字节)。
+    """
+    db_path = library.db_path if library else DB_PATH
+    root = library.root if library else BASE_DIR
+    db = sqlite3.connect(db_path, timeout=30)
+    cur = db.cursor()
+    try:
+        if policy is None:
+            policy = get_transcode_policy(cur)
+            if not policy["enabled"] or (on_import and not policy["on_import"]):
+                return 0, 0, 0
+        fmt = policy["format"] if policy["format"] in TRANSCODE_EXTENSIONS else "webp"
+        ext = TRANSCODE_EXTENSIONS[fmt]
+        sources = set(policy["sources"])
+        quality = int(policy["quality"])
+        keep_days = float(policy["keep_days"])
+
+        sql = "SELECT file_id, file_path, meta FROM t_files WHERE stored_size IS NULL"
+        params = []
+        if file_ids is not None:
+            ids = list(file_ids)
+            if not ids:
+                return 0, 0, 0
+            sql += f" AND file_id IN ({','.join('?' * len(ids))})"
+            params = ids
+        cur.execute(sql + " ORDER BY file_id", params)
+        # 先在主进程按导入时记录的元数据（meta 以格式开头，如 "PNG 32x32"）筛掉不在 sources 中的格式，
+        # 直接标记为已检查，不必交给子进程解码；没有 meta 的旧记录仍由子进程判断格式
+        candidates, skipped = [], []
+        for file_id, file_path, meta in cur.fetchall():
+            src = library.resolve(file_path) if library else resolve_path(file_path)
+            if not src or not os.path.exists(src):
+                continue
+            if meta and meta.split(" ", 1)[0] not in sources:
+                size = os.path.getsize(src)
+                skipped.append((size, size, file_id))
+                continue
+            candidates.append((file_id, file_path, src))
+        if skipped:
+            with db:
+                cur.executemany("UPDATE t_files SET original_size=?, stored_size=? WHERE file_id=?", skipped)
+        total = len(candidates)
+        done = processed = before = after = 0
+        if not total:
+            return 0, 0, 0
+        with ProcessPoolExecutor(max_workers=min(workers or TRANSCODE_WORKERS, total)) as pool:
+            for start in range(0, total, TRANSCODE_BATCH):
+                if should_stop and should_stop():
+                    break
+                jobs = []
+                for file_id, file_path, src in candidates[start:start + TRANSCODE_BATCH]:
+                    dst = os.path.splitext(src)[0] + ext
+                    if os.path.abspath(dst) == os.path.abspath(src):
+                        dst = os.path.splitext(src)[0] + ".t" + ext
+                    jobs.append((file_id, file_path, src, dst,
+                                 pool.submit(_transcode_one, src, dst, fmt, quality, sources)))
+
+                now = datetime.datetime.now().isoformat(timespec="seconds")
+                updates, skipped, removals = [], [], []
+                for file_id, file_path, src, dst, future in jobs:
+                    try:
+                        original_size, new_size = future.result()
+                    except Exception:
+                        # 解码失败的文件留给完整性校验处理，这里不标记，下次仍会尝试
+                        if os.path.exists(dst):
+                            os.remove(dst)
+                        continue
+                    if new_size is None or new_size >= original_size:
+                        if new_size is not None:
+                            os.remove(dst)
+                        skipped.append((original_size, original_size, file_id))
+                        continue
+                    updates.append((os.path.relpath(dst, root), original_size, new_size,
+                                    None if keep_days <= 0 else file_path, now, file_id))
+                    if keep_days <= 0:
+                        removals.append(src)
+                    before += original_size
+                    after += new_size
+                with db:
+                    cur.executemany("UPDATE t_files SET original_size=?, stored_size=? WHERE file_id=?", skipped)
+                    cur.executemany("""
+                        UPDATE t_files SET file_path=?, original_size=?, stored_size=?,
+                                           original_path=?, transcoded_time=?
+                        WHERE file_id=?
+                    """, updates)
+                # 数据库已指向新文件后再删除原图
+                for path in removals:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                processed += len(updates)
+                done += min(TRANSCODE_BATCH, total - start)
+                perf.count("transcode.files", len(updates))
+                if progress:
+                    progress(done, total)
+        return processed, before, after
+    finally:
+        db.close()
+
+
+def purge_transcoded_originals(library=None, keep_days=None):
+    """删除超过保留期的原图，返回 (删除的文件数, 释放的字节数)"""
+    db_path = library.db_path if library else DB_PATH
+    root = library.root if library else BASE_DIR
+    db = sqlite3.connect(db_path, timeout=30)
+    cur = db.cursor()
+    try:
+        if keep_days is None:
+            keep_days = float(get_transcode_policy(cur)["keep_days"])
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=keep_days)).isoformat(timespec="seconds")
+        cur.execute("""
+            SELECT file_id, original_path FROM t_files
+            WHERE original_path IS NOT NULL AND transcoded_time <= ?
+        """, (cutoff,))
+        rows = cur.fetchall()
+        count = freed = 0
+        with db:
+            for file_id, original_path in rows:
+                path = original_path if os.path.isabs(original_path) else os.path.join(root, original_path)
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    count += 1
+                except OSError:
+                    pass
+                cur.execute("UPDATE t_files SET original_path=NULL WHERE file_id=?", (file_id,))
+        return count, freed
+    finally:
+        db.close()
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def transcode_stats(cur=None):
+    """返回 {"files", "original_bytes", "stored_bytes", "saved_bytes", "retained_originals"}"""
+    cur = cur or cursor
+    cur.execute("""
+        SELECT COUNT(*), COALESCE(SUM(original_size), 0), COALESCE(SUM(stored_size), 0),
+               COUNT(original_path)
+        FROM t_files WHERE stored_size IS NOT NULL AND stored_size < original_size
+    """)
+    files, original, stored, retained = cur.fetchone()
+    return {"files": files, "original_bytes": original, "stored_bytes": stored,
+            "saved_bytes": original - stored, "retained_originals": retained}
+
+
+# -------------------------
+# 多图库：分片存储与联合搜索
+# -------------------------
+# 每个图库是一对 (images.db, files/)，根目录下的结构与本库相同。
+# BASE_DIR 自身始终是第一个图库（"本库"），其余图库登记在 libraries.json：
+#   {"libraries": [{"name": "2023", "root": "D:/images-2023", "shard_from": "2023-01-01"}]}
+# root 可为相对 BASE_DIR 的路径；shard_from 只在按日期分片导入时使用。
+# 浏览、编辑标签等功能仍作用于本库，其他图库参与联合搜索和分片导入。
+LIBRARIES_CONFIG = os.path.join(BASE_DIR, "libraries.json")
+PRIMARY_LIBRARY_NAME = "本库"
+FEDERATED_SEARCH_WORKERS = int(os.environ.get("IMAGES_FEDERATED_WORKERS", "4"))
+
+# 新图库只需要核心表；全文索引、保存的搜索等在该库作为本库打开时才创建
+LIBRARY_CORE_DDL = """
+CREATE TABLE IF NOT EXISTS t_files (
+    file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_name TEXT,
+    file_path TEXT,
+    import_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    meta TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS t_tags (
+    tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    parent TEXT,
+    name TEXT
+);
+""" + FILES_TAGS_DDL.format(table="t_files_tags") + """;
+CREATE INDEX IF NOT EXISTS idx_files_tags_tag ON t_files_tags(tag_id, file_id);
+CREATE INDEX IF NOT EXISTS idx_tags_parent_name ON t_tags(parent, name);
+""" + SETTINGS_DDL + ";"
+
+
+class Library:
+    """
+    一个图库（数据库 + 存储目录）。连接在首次使用时打开，check_same_thread=False，
+    由 self.lock 串行化，联合搜索时每个图库在线程池的一个线程里查询。
+    本库另开一条连接（WAL 下读写互不阻塞），写入仍走全局 conn。
+    """
+
+    def __init__(self, name, root, shard_from=None):
+        self.name = name
+        self.root = os.path.abspath(root)
+        self.shard_from = shard_from
+        self.db_path = os.path.join(self.root, "images.db")
+        self.files_dir = os.path.join(self.root, "files")
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def is_primary(self):
+        return library_root_key(self.root) == library_root_key(BASE_DIR)
+
+    def connection(self):
+        """返回本图库的连接（调用方需持有 self.lock），首次调用时建库建表"""
+        if self._conn is None:
+            os.makedirs(self.files_dir, exist_ok=True)
+            c = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            c.execute("PRAGMA journal_mode=WAL")
+            if not self.is_primary:
+                c.executescript(LIBRARY_CORE_DDL)
+                ensure_files_columns(c.cursor())
+                c.commit()
+            c.execute("PRAGMA foreign_keys=ON")
+            self._conn = c
+        return self._conn
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def resolve(self, file_path):
+        if not file_path:
+            return None
+        if os.path.isabs(file_path):
+            return file_path
+        return os.path.join(self.root, file_path)
+
+    def _tag_ids(self, cur, tag_specs, create=False):
+        """按 (维度, 子标签) 查本图库的 tag_id；create=True 时补建缺失的维度和标签"""
+        ids = []
+        for parent, name in tag_specs:
+            cur.execute("SELECT tag_id FROM t_tags WHERE parent=? AND name=?", (parent, name))
+            row = cur.fetchone()
+            if row:
+                ids.append(row[0])
+            elif create:
+                cur.execute("SELECT 1 FROM t_tags WHERE parent=? AND name=''", (parent,))
+                if not cur.fetchone():
+                    cur.execute("INSERT INTO t_tags (parent, name) VALUES (?, '')", (parent,))
+                cur.execute("INSERT INTO t_tags (parent, name) VALUES (?, ?)", (parent, name))
+                ids.append(cur.lastrowid)
+        return ids
+
+    def search(self, tag_specs, mode="OR", text=""):
+        """
+        在本图库中按 (维度, 子标签) 和文件名关键词搜索，返回 [(file_id, 绝对路径)]。
+        标签按名称映射到本库的 tag_id：AND 模式下缺任一标签即无结果；关键词为文件名子串匹配。
+        """
+        with self.lock:
+            cur = self.connection().cursor()
+            tag_ids = self._tag_ids(cur, tag_specs)
+            if tag_specs and (not tag_ids or (mode == "AND" and len(tag_ids) < len(tag_specs))):
+                return []
+            if tag_ids:
+                sql, params = build_tag_search_sql(tag_ids, mode)
+            else:
+                sql, params = "SELECT file_id, file_path FROM t_files", []
+            if text:
+                sql = f"""
+                    SELECT s.file_id, s.file_path FROM ({sql}) s
+                    JOIN t_files f ON f.file_id = s.file_id WHERE f.file_name LIKE ?
+                """
+                params = params + [f"%{text.strip()}%"]
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        results = []
+        for file_id, file_path in rows:
+            abs_p = self.resolve(file_path)
+            if abs_p and os.path.exists(abs_p):
+                results.append((file_id, abs_p))
+        return results
+
+    def get_file_tags(self, file_id):
+        with self.lock:
+            cur = self.connection().cursor()
+            cur.execute("""
+                SELECT t.parent, t.name FROM t_tags t
+                JOIN t_files_tags ft ON t.tag_id = ft.tag_id
+                WHERE ft.file_id = ? ORDER BY t.parent, t.name
+            """, (file_id,))
+            return [f"{parent}:{name}" for parent, name in cur.fetchall() if name]
+
+    def import_files(self, paths, chosen_tags, progress=None, should_stop=None):
+        """导入到本图库（缺失的标签按名称补建），返回 file_id 列表；本库直接走 import_files"""
+        if self.is_primary:
+            return import_files(paths, chosen_tags, progress, should_stop)
+        with self.lock:
+            c = self.connection()
+            with c:
+                cur = c.cursor()
+                tag_ids = self._tag_ids(cur, chosen_tags, create=True)
+                layout = get_setting("storage_layout", "flat", cur)
+                return _copy_and_insert_files(cur, paths, tag_ids, self.files_dir, self.root, layout,
+                                              progress, should_stop)
+
+
+def library_root_key(root):
+    """图库根目录的规范化形式（绝对路径，Windows 下不区分大小写），用于判断两个图库是否是同一个目录"""
+    return os.path.normcase(os.path.abspath(root))
+
+
+def load_libraries():
+    """读取 libraries.json，返回 [本库, 其他图库...]；配置缺失或损坏时只有本库，重名或重复的根目录只保留第一个"""
+    libraries = [Library(PRIMARY_LIBRARY_NAME, BASE_DIR)]
+    try:
+        with open(LIBRARIES_CONFIG, encoding="utf-8") as f:
+            entries = json.load(f).get("libraries", [])
+    except (OSError, ValueError):
+        entries = []
+    names = {PRIMARY_LIBRARY_NAME}
+    roots = {library_root_key(BASE_DIR)}
+    for entry in entries:
+        name, root = entry.get("name"), entry.get("root")
+        if not name or not root or name in names:
+            continue
+        if not os.path.isabs(root):
+            root = os.path.join(BASE_DIR, root)
+        if library_root_key(root) in roots:
+            continue
+        libraries.append(Library(name, root, entry.get("shard_from")))
+        names.add(name)
+        roots.add(library_root_key(root))
+    return libraries
+
+
+def save_libraries(libraries):
+    """把除本库外的图库写回 libraries.json"""
+    entries = []
+    for lib in libraries:
+        if lib.is_primary:
+            continue
+        entry = {"name": lib.name, "root": lib.root}
+        if lib.shard_from:
+            entry["shard_from"] = lib.shard_from
+        entries.append(entry)
+    with open(LIBRARIES_CONFIG, "w", encoding="utf-8") as f:
+        json.dump({"libraries": entries}, f, ensure_ascii=False, indent=2)
+
+
+@perf.timed("db.federated_search")
+def federated_search(libraries, tag_specs, mode="OR", text=""):
+    """
+    在多个图库中并行搜索并合并结果，返回 ([(Library, file_id, 绝对路径)], {图库名: 错误信息})。
+    结果按图库顺序排列；某个图库出错（如目录未挂载）不影响其他图库。
+    """
+    results, errors = [], {}
+    if not libraries:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=max(1, min(FEDERATED_SEARCH_WORKERS, len(libraries)))) as pool:
+        futures = [(lib, pool.submit(lib.search, tag_specs, mode, text)) for lib in libraries]
+        for lib, future in futures:
+            try:
+                results.extend((lib, file_id, abs_p) for file_id, abs_p in future.result())
+            except Exception as e:
+                errors[lib.name] = str(e)
+    return results, errors
+
+
+def shard_library_for(path, libraries, by="hash"):
+    """
+    为待导入文件选择目标图库：
+    - hash：按文件内容 crc32 对图库数取模，相同内容总落在同一图库
+    - date：按文件修改日期，选 shard_from 不晚于该日期的最新图库；没有 shard_from 的图库兜底
+    """
+    if by == "date":
+        day = datetime.date.fromtimestamp(os.path.getmtime(path)).isoformat()
+        candidates = [lib for lib in libraries if (lib.shard_from or "") <= day]
+        if not candidates:
+            return libraries[0]
+        return max(candidates, key=lambda lib: lib.shard_from or "")
+    return libraries[crc32_file(path) % len(libraries)]
+
+
+@perf.timed("import.sharded")
+def import_files_sharded(paths, chosen_tags, libraries, by="hash", progress=None, should_stop=None):
+    """按 shard_library_for 把文件分组导入各图库，返回 {图库名: [file_id]}；progress 为各图库累计的已导入数"""
+    groups = OrderedDict()
+    for p in paths:
+        groups.setdefault(shard_library_for(p, libraries, by), []).append(p)
+    imported = OrderedDict()
+    offset = 0
+    for lib, group in groups.items():
+        if should_stop and should_stop():
+            break
+        lib_progress = (lambda n, base=offset: progress(base + n)) if progress else None
+        imported[lib.name] = lib.import_files(group, chosen_tags, lib_progress, should_stop)
+        offset += len(imported[lib.name])
+    return imported
+
+
+# -------------------------
+# 增量备份 / 恢复
+# -------------------------
+# 备份目录结构：
+#   images.db                 数据库的一致性快照（sqlite3 在线备份，备份期间程序可继续使用）
+#   files/...                 与 BASE_DIR 相同的相对路径
+#   manifest.json             {"created", "files": {相对路径: {"size", "mtime_ns", "sha256"}}}
+#   manifest.partial.jsonl    进行中的备份日志，每复制完一个文件追加一行，中断后据此续传
+# 大小和修改时间与上次清单一致的文件不再复制。快照先写到 images.db.partial，
+# 文件全部复制完成后才替换 images.db 和 manifest.json，因此两者始终互相对应。
+BACKUP_MANIFEST = "manifest.json"
+BACKUP_JOURNAL = "manifest.partial.jsonl"
+
+
+def _copy_with_sha256(src, dst):
+    """边复制边计算 sha256，先写临时文件再改名，返回十六进制摘要；读完释放源文件的页缓存"""
+    tmp = dst + ".part"
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    digest = copy_file_hashed(src, tmp, drop_cache=True)
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    return digest
+
+
+def _write_json_atomic(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_backup_manifest(dest):
+    try:
+        with open(os.path.join(dest, BACKUP_MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+
+def _referenced_paths(db_file):
+    """快照中引用的相对路径（当前文件与保留期内的原图），绝对路径的文件不在 BASE_DIR 下，不备份"""
+    snap = sqlite3.connect(db_file)
+    try:
+        rows = snap.execute("""
+            SELECT file_path FROM t_files
+            UNION SELECT original_path FROM t_files WHERE original_path IS NOT NULL
+        """).fetchall()
+    except sqlite3.OperationalError:
+        rows = snap.execute("SELECT file_path FROM t_files").fetchall()
+    finally:
+        snap.close()
+    # 统一为 / 分隔，备份在不同系统之间可移植
+    return sorted({r[0].replace("\\", "/") for r in rows if r[0] and not os.path.isabs(r[0])})
+
+
+@perf.timed("backup.run")
+def backup_library(dest, library=None, progress=None, should_stop=None, prune=False):
+    """
+    增量备份本库（或 library）到 dest。返回 {"copied", "skipped", "missing", "bytes", "pruned", "completed"}，
+    should_stop() 为 True 时在文件之间停止（completed=False），再次调用从日志处继续。
+    """
+    db_path = library.db_path if library else DB_PATH
+    root = library.root if library else BASE_DIR
+    os.makedirs(dest, exist_ok=True)
+    manifest = load_backup_manifest(dest)
+    known = dict(manifest.get("files", {}))
+    journal_path = os.path.join(dest, BACKUP_JOURNAL)
+    try:
+        with open(journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # 中断时写了一半的最后一行
+                known[entry.pop("path")] = entry
+    except OSError:
+        pass
+
+    # 1. 数据库在线快照
+    snapshot = os.path.join(dest, "images.db.partial")
+    source = sqlite3.connect(db_path, timeout=30)
+    target = sqlite3.connect(snapshot)
+    try:
+        with perf.timer("backup.db_snapshot"):
+            source.backup(target, pages=1024)
+    finally:
+        target.close()
+        source.close()
+
+    # 2. 复制快照引用且有变化的文件
+    stats = {"copied": 0, "skipped": 0, "missing": 0, "bytes": 0, "pruned": 0, "completed": False}
+    paths = _referenced_paths(snapshot)
+    current = {}
+    with open(journal_path, "a", encoding="utf-8") as journal:
+        for i, rel in enumerate(paths):
+            if should_stop and should_stop():
+                return stats
+            src = os.path.join(root, rel)
+            dst = os.path.join(dest, rel)
+            try:
+                st = os.stat(src)
+            except OSError:
+                stats["missing"] += 1
+                continue
+            entry = known.get(rel)
+            if (entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+                    and os.path.exists(dst) and os.path.getsize(dst) == st.st_size):
+                current[rel] = entry
+                stats["skipped"] += 1
+            else:
+                with perf.timer("io.copy"):
+                    sha = _copy_with_sha256(src, dst)
+                entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha}
+                current[rel] = entry
+                journal.write(json.dumps(dict(entry, path=rel), ensure_ascii=False) + "\n")
+                journal.flush()
+                stats["copied"] += 1
+                stats["bytes"] += st.st_size
+            if progress:
+                progress(i + 1, len(paths))
+
+    # 3. 提交：快照与清单一起生效
+    if prune:
+        for rel in set(manifest.get("files", {})) - set(current):
+            try:
+                os.remove(os.path.join(dest, rel))
+                stats["pruned"] += 1
+            except OSError:
+                pass
+    else:
+        # 不清理时旧文件仍在备份目录中，保留其清单条目
+        for rel, entry in manifest.get("files", {}).items():
+            current.setdefault(rel, entry)
+    os.replace(snapshot, os.path.join(dest, "images.db"))
+    _write_json_atomic(os.path.join(dest, BACKUP_MANIFEST), {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "files": current,
+    })
+    os.remove(journal_path)
+    stats["completed"] = True
+    return stats
+
+
+def verify_backup(dest, progress=None):
+    """按清单重新计算 sha256 并检查快照完整性，返回问题列表 [(相对路径, 说明)]"""
+    problems = []
+    db_file = os.path.join(dest, "images.db")
+    try:
+        snap = sqlite3.connect(db_file)
+        result = snap.execute("PRAGMA integrity_check").fetchone()[0]
+        snap.close()
+        if result != "ok":
+            problems.append(("images.db", result))
+    except sqlite3.Error as e:
+        problems.append(("images.db", str(e)))
+    files = load_backup_manifest(dest).get("files", {})
+    for i, (rel, entry) in enumerate(sorted(files.items())):
+        path = os.path.join(dest, rel)
+        if not os.path.exists(path):
+            problems.append((rel, "缺失"))
+        elif hash_file(path, drop_cache=True) != entry["sha256"]:
+            problems.append((rel, "内容校验不一致"))
+        if progress:
+            progress(i + 1, len(files))
+    return problems
+
+
+@perf.timed("backup.restore")
+def restore_backup(backup_dir, target_dir, progress=None):
+    """
+    把备份恢复到新的 BASE_DIR（target_dir 中不能已有 images.db），复制时校验 sha256。
+    返回问题列表 [(相对路径, 说明)]；有问题的文件仍会复制，由调用方决定如何处理。
+    """
+    if os.path.exists(os.path.join(target_dir, "images.db")):
+        raise FileExistsError(f"{target_dir} 中已有 images.db，请恢复到新的目录")
+    files = load_backup_manifest(backup_dir).get("files", {})
+    problems = []
+    for i, (rel, entry) in enumerate(sorted(files.items())):
+        src = os.path.join(backup_dir, rel)
+        if not os.path.exists(src):
+            problems.append((rel, "缺失"))
+            continue
+        if _copy_with_sha256(src, os.path.join(target_dir, rel)) != entry["sha256"]:
+            problems.append((rel, "内容校验不一致"))
+        if progress:
+            progress(i + 1, len(files))
+    os.makedirs(os.path.join(target_dir, "files"), exist_ok=True)
+    # 数据库最后复制：恢复中断时目标目录不会被当作完整的图库
+    source = sqlite3.connect(os.path.join(backup_dir, "images.db"))
+    target = sqlite3.connect(os.path.join(target_dir, "images.db"))
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return problems
+
+
+# -------------------------
+# 完整性校验 / 修复
+# -------------------------
+# t_integrity 记录每个文件最近一次校验的结果：status 为 ok / missing（文件不存在）/
+# corrupt（无法完整解码）/ changed（大小和修改时间没变但 sha256 与上次不同，即静默损坏）/
+# too_large（像素数超过 LARGE_IMAGE_MAX_PIXELS，未解码；文件本身不一定有问题，不算作待修复的问题）。
+# sha256 是基线：文件路径、大小或修改时间变化（如转码、迁移）时重新取基线；
+# changed 时保留旧基线，修复前再次校验仍会报告。
+# 校验按 file_id 分批，进度保存在 t_settings["integrity_scan"]，中断后从断点继续。
+INTEGRITY_DDL = """
+CREATE TABLE IF NOT EXISTS t_integrity (
+    file_id INTEGER PRIMARY KEY REFERENCES t_files(file_id) ON DELETE CASCADE,
+    file_path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    checked_time TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_integrity_problems ON t_integrity(status) WHERE status != 'ok';
+"""
+INTEGRITY_BATCH = 128
+INTEGRITY_WORKERS = int(os.environ.get("IMAGES_VERIFY_WORKERS", "0")) or max(1, (os.cpu_count() or 2) - 1)
+# 界面中后台校验的默认限速（MB/s），命令行默认不限速
+INTEGRITY_GUI_MB_PER_SEC = float(os.environ.get("IMAGES_VERIFY_MB_PER_SEC", "50"))
+INTEGRITY_STATUS_TEXT = {"missing": "文件缺失", "corrupt": "无法解码", "changed": "内容被改动",
+                         "too_large": "超过像素上限"}
+
+
+def _verify_one(path):
+    """
+    进程池中执行：映射文件，计算 sha256 并完整解码（像素上限与大图查看相同，见 open_large_image）。
+    返回 (大小, 修改时间 ns, sha256, 状态, 错误说明)：可以解码时状态和错误说明为 None，
+    无法解码时状态为 "corrupt"，像素数超过上限时为 "too_large"
+    """
+    st = os.stat(path)
+    with mapped_file(path) as m:
+        # 摘要直接读映射；解码时再从映射读取，文件只从磁盘读一次，也不复制出整份 bytes
+        digest = hashlib.sha256(m).hexdigest()
+        try:
+            with open_large_image(io.BytesIO(m) if isinstance(m, bytes) else m) as img:
+                img.load()
+        except Image.DecompressionBombError as e:
+            return st.st_size, st.st_mtime_ns, digest, "too_large", str(e)
+        except Exception as e:
+            return st.st_size, st.st_mtime_ns, digest, "corrupt", f"{type(e).__name__}: {e}"
+    return st.st_size, st.st_mtime_ns, digest, None, None
+
+
+def _integrity_result(row, outcome, now):
+    """根据校验结果和上次的记录得出 t_integrity 的新行"""
+    file_id, file_path, old_path, old_size, old_mtime, old_sha = row
+    size, mtime_ns, digest, status, error = outcome
+    if status:
+        return file_id, file_path, size, mtime_ns, digest, status, error, now
+    if old_sha and old_path == file_path and old_size == size and old_mtime == mtime_ns and old_sha != digest:
+        return file_id, file_path, size, mtime_ns, old_sha, "changed", "sha256 与上次校验不一致", now
+    return file_id, file_path, size, mtime_ns, digest, "ok", None, now
+
+
+@perf.timed("integrity.verify")
+def verify_library(library=None, workers=None, batch_size=INTEGRITY_BATCH, max_mb_per_sec=0, restart=False,
+                   progress=None, should_stop=None):
+    """
+    校验本库（或 library）全部文件：进程池中并行计算 sha256 并解码，结果写入 t_integrity。
+    使用独立连接，可在后台线程调用。max_mb_per_sec 限制平均读取速度（0 为不限），
+    给前台操作让出磁盘；should_stop() 为 True 时在批次之间停止，再次调用从断点继续（restart=True 从头开始）。
+    返回本次校验的 {"ok", "missing", "corrupt", "changed", "too_large", "completed"}。
+    """
+    db_path = library.db_path if library else DB_PATH
+    db = sqlite3.connect(db_path, timeout=30)
+    cur = db.cursor()
+    counts = {"ok": 0, "missing": 0, "corrupt": 0, "changed": 0, "too_large": 0, "completed": False}
+    try:
+        cur.executescript(INTEGRITY_DDL)
+        state = json.loads(get_setting("integrity_scan", "{}", cur))
+        if restart or "last_file_id" not in state:
+            state = {"started": datetime.datetime.now().isoformat(timespec="seconds"), "last_file_id": 0}
+            with db:
+                set_setting("integrity_scan", json.dumps(state), cur)
+        cur.execute("SELECT COUNT(*) FROM t_files")
+        total = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM t_files WHERE file_id <= ?", (state["last_file_id"],))
+        done = cur.fetchone()[0]
+        read_bytes = 0
+        t0 = time.monotonic()
+        with ProcessPoolExecutor(max_workers=workers or INTEGRITY_WORKERS) as pool:
+            while True:
+                if should_stop and should_stop():
+                    return counts
+                cur.execute("""
+                    SELECT f.file_id, f.file_path, i.file_path, i.size, i.mtime_ns, i.sha256
+                    FROM t_files f LEFT JOIN t_integrity i ON i.file_id = f.file_id
+                    WHERE f.file_id > ? ORDER BY f.file_id LIMIT ?
+                """, (state["last_file_id"], batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                now = datetime.datetime.now().isoformat(timespec="seconds")
+                results, jobs = [], []
+                for row in rows:
+                    path = library.resolve(row[1]) if library else resolve_path(row[1])
+                    if not path or not os.path.exists(path):
+                        results.append((row[0], row[1], None, None, row[5], "missing", "文件不存在", now))
+                    else:
+                        jobs.append((row, pool.submit(_verify_one, path)))
+                for row, future in jobs:
+                    try:
+                        outcome = future.result()
+                    except OSError as e:
+                        outcome = (None, None, None, "corrupt", f"读取失败：{e}")
+                    read_bytes += outcome[0] or 0
+                    results.append(_integrity_result(row, outcome, now))
+                state["last_file_id"] = rows[-1][0]
+                with db:
+                    cur.executemany("INSERT OR REPLACE INTO t_integrity VALUES (?, ?, ?, ?, ?, ?, ?, ?)", results)
+                    set_setting("integrity_scan", json.dumps(state), cur)
+                for r in results:
+                    counts[r[5]] += 1
+                perf.count("integrity.files", len(rows))
+                done += len(rows)
+                if progress:
+                    progress(done, total)
+                # 限速：按已读字节数算出应耗的时间，超前时休眠
+                if max_mb_per_sec:
+                    ahead = read_bytes / (max_mb_per_sec * 1024 * 1024) - (time.monotonic() - t0)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        with db:
+            set_setting("integrity_scan", None, cur)
+        counts["completed"] = True
+        return counts
+    finally:
+        db.close()
+
+
+def get_integrity_problems(cur=None):
+    """最近一次校验有问题的文件（不含 too_large）：[(file_id, file_path, status, error, checked_time)]"""
+    cur = cur or cursor
+    try:
+        cur.execute("""
+            SELECT file_id, file_path, status, error, checked_time FROM t_integrity
+            WHERE status != 'ok' AND status != 'too_large' ORDER BY file_id
+        """)
+    except sqlite3.OperationalError:
+        # 从未校验过的图库没有 t_integrity
+        return []
+    return cur.fetchall()
+
+
+def get_integrity_flags(file_ids):
+    """{file_id: (status, error)}，只包含有问题的文件（不含 too_large）"""
+    flags = {}
+    ids = list(file_ids)
+    for start in range(0, len(ids), 900):
+        chunk = ids[start:start + 900]
+        cursor.execute(f"""
+            SELECT file_id, status, error FROM t_integrity
+            WHERE status != 'ok' AND status != 'too_large' AND file_id IN ({','.join('?' * len(chunk))})
+        """, chunk)
+        flags.update((file_id, (status, error)) for file_id, status, error in cursor.fetchall())
+    return flags
+
+
+def _repair_one(db, backup_dir, root, entry, rel, file_id, file_path):
+    """用备份副本替换一个文件并把 t_integrity 标记为 ok；返回未修复的原因，修复成功时返回 None"""
+    src = os.path.join(backup_dir, rel)
+    if os.path.isabs(rel) or entry is None or not os.path.exists(src):
+        return "备份中没有该文件"
+    dst = os.path.join(root, rel)
+    tmp = dst + ".repair"
+    if _copy_with_sha256(src, tmp) != entry["sha256"]:
+        os.remove(tmp)
+        return "备份副本的 sha256 与清单不符"
+    size, mtime_ns, digest, status, error = _verify_one(tmp)
+    if status:
+        os.remove(tmp)
+        return f"备份副本也无法解码：{error}"
+    os.replace(tmp, dst)
+    st = os.stat(dst)
+    with db:
+        db.execute("INSERT OR REPLACE INTO t_integrity VALUES (?, ?, ?, ?, ?, 'ok', NULL, ?)",
+                   (file_id, file_path, st.st_size, st.st_mtime_ns, digest,
+                    datetime.datetime.now().isoformat(timespec="seconds")))
+    return None
+
+
+def repair_from_backup(backup_dir, library=None, progress=None):
+    """
+    用增量备份中的副本替换有问题的文件：按清单核对 sha256、确认能解码后才覆盖，并更新 t_integrity。
+    返回 (修复数, [(相对路径, 未修复原因)])
+    """
+    db_path = library.db_path if library else DB_PATH
+    root = library.root if library else BASE_DIR
+    files = load_backup_manifest(backup_dir).get("files", {})
+    db = sqlite3.connect(db_path, timeout=30)
+    cur = db.cursor()
+    try:
+        problems = get_integrity_problems(cur)
+        repaired, failed = 0, []
+        for i, (file_id, file_path, _, _, _) in enumerate(problems):
+            rel = (file_path or "").replace("\\", "/")
+            reason = _repair_one(db, backup_dir, root, files.get(rel), rel, file_id, file_path)
+            if reason:
+                failed.append((rel, reason))
+            else:
+                repaired += 1
+            # 每个有问题的文件都报告一次进度，无论是否修复成功
+            if progress:
+                progress(i + 1, len(problems))
+        return repaired, failed
+    finally:
+        db.close()
+
+
+# -------------------------
+# 标签目录导入 / 导出（JSONL，或安装了 pyarrow 时的 Parquet）
+# -------------------------
+# JSONL（可 .gz 压缩）：先是标签行，再是文件行，逐行流式读写：
+#   {"type": "tag", "parent": "维度", "name": "子标签"}          name 为 "" 表示维度本身
+#   {"type": "file", "file_id": 1, "file_name": ..., "file_path": ..., "import_time": ..., "meta": ...,
+#    "tags": [["维度", "子标签"], ...]}
+# Parquet：每行一个文件，tags 列为 list<struct<parent, name>>，完整的标签列表存放在文件元数据 "tags" 中。
+# 导入时标签按 (维度, 子标签) 匹配或新建，文件按 file_path 去重（已存在的文件只补充标签），
+# file_id 重新分配；每 chunk_size 个文件一个事务。
+CATALOG_CHUNK = 5000
+
+
+def _require_pyarrow():
+    """可选依赖 pyarrow 在用到 Parquet 时才导入（导入较慢，不拖累启动）"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet 格式需要安装 pyarrow（pip install pyarrow）")
+    return pyarrow
+
+
+def _open_catalog_text(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _iter_catalog_files(db, absolute=False, root=BASE_DIR):
+    """按 file_id 顺序流式产出文件记录（标签随文件聚合，不整体载入内存）"""
+    rows = db.execute("""
+        SELECT f.file_id, f.file_name, f.file_path, f.import_time, f.meta, t.parent, t.name
+        FROM t_files f
+        LEFT JOIN t_files_tags ft ON ft.file_id = f.file_id
+        LEFT JOIN t_tags t ON t.tag_id = ft.tag_id
+        ORDER BY f.file_id
+    """)
+    record = None
+    for file_id, file_name, file_path, import_time, meta, parent, name in rows:
+        if record is None or record["file_id"] != file_id:
+            if record is not None:
+                yield record
+            if absolute and file_path and not os.path.isabs(file_path):
+                file_path = os.path.join(root, file_path)
+            record = {"file_id": file_id, "file_name": file_name, "file_path": file_path,
+                      "import_time": str(import_time) if import_time is not None else None,
+                      "meta": meta or "", "tags": []}
+        if name:
+            record["tags"].append([parent, name])
+    if record is not None:
+        yield record
+
+
+@perf.timed("catalog.export")
+def export_catalog(out_path, library=None, absolute=False, progress=None):
+    """
+    导出标签目录到 out_path（.parquet 需要 pyarrow，其余按 JSONL），使用独立连接，返回导出的文件数。
+    absolute=True 时 file_path 写为绝对路径，便于训练流水线直接读取图片。
+    """
+    db_path = library.db_path if library else DB_PATH
+    root = library.root if library else BASE_DIR
+    db = sqlite3.connect(db_path, timeout=30)
+    try:
+        total = db.execute("SELECT COUNT(*) FROM t_files").fetchone()[0]
+        tags = db.execute("SELECT parent, name FROM t_tags WHERE parent IS NOT NULL ORDER BY parent, name").fetchall()
+        records = _iter_catalog_files(db, absolute, root)
+        count = 0
+        if out_path.endswith(".parquet"):
+            pyarrow = _require_pyarrow()
+            tag_type = pyarrow.struct([("parent", pyarrow.string()), ("name", pyarrow.string())])
+            schema = pyarrow.schema([
+                ("file_id", pyarrow.int64()), ("file_name", pyarrow.string()), ("file_path", pyarrow.string()),
+                ("import_time", pyarrow.string()), ("meta", pyarrow.string()), ("tags", pyarrow.list_(tag_type)),
+            ], metadata={"tags": json.dumps(tags, ensure_ascii=False)})
+            with pyarrow.parquet.ParquetWriter(out_path, schema) as writer:
+                while True:
+                    batch = [r for _, r in zip(range(CATALOG_CHUNK), records)]
+                    if not batch:
+                        break
+                    for r in batch:
+                        r["tags"] = [{"parent": p, "name": n} for p, n in r["tags"]]
+                    writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                    count += len(batch)
+                    if progress:
+                        progress(count, total)
+        else:
+            with _open_catalog_text(out_path, "w") as f:
+                for parent, name in tags:
+                    f.write(json.dumps({"type": "tag", "parent": parent, "name": name or ""}, ensure_ascii=False))
+                    f.write("\n")
+                for record in records:
+                    f.write(json.dumps(dict(record, type="file"), ensure_ascii=False))
+                    f.write("\n")
+                    count += 1
+                    if progress and count % CATALOG_CHUNK == 0:
+                        progress(count, total)
+            if progress:
+                progress(count, total)
+        return count
+    finally:
+        db.close()
+
+
+def _read_catalog(in_path):
+    """产出 ("tag", (parent, name)) 和 ("file", record)；Parquet 按行组分批读取"""
+    if in_path.endswith(".parquet"):
+        pyarrow = _require_pyarrow()
+        pf = pyarrow.parquet.ParquetFile(in_path)
+        meta = pf.schema_arrow.metadata or {}
+        for parent, name in json.loads(meta.get(b"tags", b"[]")):
+            yield "tag", (parent, name or "")
+        for batch in pf.iter_batches(batch_size=CATALOG_CHUNK):
+            for r in batch.to_pylist():
+                r["tags"] = [(t["parent"], t["name"]) for t in r.get("tags") or []]
+                yield "file", r
+        return
+    with _open_catalog_text(in_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            if r.get("type") == "tag":
+                yield "tag", (r["parent"], r.get("name") or "")
+            elif r.get("type") == "file":
+                r["tags"] = [tuple(t) for t in r.get("tags", [])]
+                yield "file", r
+
+
+@perf.timed("catalog.import")
+def import_catalog(in_path, library=None, chunk_size=CATALOG_CHUNK, progress=None, root=None):
+    """
+    从 export_catalog 的输出导入标签目录（只导入记录，不复制图片），使用独立连接。
+    目录中的相对 file_path 是相对导出方图库根目录的：root 指定该目录时按它改写（位于本库根目录下的
+    写为相对本库的路径，其余写为绝对路径）；不指定时原样入库，即按本库根目录解析。
+    返回 {"tags": 新建标签数, "files": 新增文件数, "merged": 已存在而补充标签的文件数, "links": 新增关联数,
+          "unresolved": 在本机找不到图片的记录数}
+    """
+    db_path = library.db_path if library else DB_PATH
+    target_root = os.path.abspath(library.root if library else BASE_DIR)
+    resolve = library.resolve if library else resolve_path
+    db = sqlite3.connect(db_path, timeout=30)
+    db.execute("PRAGMA foreign_keys=ON")
+    cur = db.cursor()
+    stats = {"tags": 0, "files": 0, "merged": 0, "links": 0, "unresolved": 0}
+    tag_ids = {}
+    for parent, name, tag_id in cur.execute("SELECT parent, name, tag_id FROM t_tags"):
+        tag_ids.setdefault((parent, name or ""), tag_id)
+
+    def add_tags(specs):
+        """在当前事务中用一条 executemany 补建缺失的维度和子标签，再按 tag_id 区间取回新 id"""
+        new = []
+        for parent, name in specs:
+            for key in ((parent, ""), (parent, name)) if name else ((parent, ""),):
+                if key not in tag_ids:
+                    tag_ids[key] = None
+                    new.append(key)
+        if not new:
+            return
+        cur.execute("SELECT COALESCE(MAX(tag_id), 0) FROM t_tags")
+        before = cur.fetchone()[0]
+        cur.executemany("INSERT INTO t_tags (parent, name) VALUES (?, ?)", new)
+        for parent, name, tag_id in cur.execute("SELECT parent, name, tag_id FROM t_tags WHERE tag_id > ?",
+                                                (before,)):
+            if tag_ids.get((parent, name or "")) is None:
+                tag_ids[(parent, name or "")] = tag_id
+        stats["tags"] += len(new)
+
+    def rebase(file_path):
+        if root is None or not file_path or os.path.isabs(file_path):
+            return file_path
+        abs_path = os.path.abspath(os.path.join(root, file_path))
+        try:
+            rel = os.path.relpath(abs_path, target_root)
+        except ValueError:  # Windows 下不在同一个盘符
+            return abs_path
+        return abs_path if rel == os.pardir or rel.startswith(os.pardir + os.sep) else rel
+
+    def flush(chunk, pending_tags):
+        for r in chunk:
+            r["file_path"] = rebase(r["file_path"])
+            abs_path = resolve(r["file_path"])
+            if not abs_path or not os.path.exists(abs_path):
+                stats["unresolved"] += 1
+        with db:
+            add_tags(pending_tags + [(p, n) for r in chunk for p, n in r["tags"] if n])
+            paths = [r["file_path"] for r in chunk]
+            existing = {}
+            for i in range(0, len(paths), 500):
+                part = paths[i:i + 500]
+                cur.execute(f"SELECT file_path, file_id FROM t_files WHERE file_path IN ({','.join('?' * len(part))})",
+                            part)
+                existing.update(cur.fetchall())
+            links = []
+            for r in chunk:
+                file_id = existing.get(r["file_path"])
+                if file_id is None:
+                    cur.execute("""
+                        INSERT INTO t_files (file_name, file_path, import_time, meta) VALUES (?, ?, ?, ?)
+                    """, (r.get("file_name"), r["file_path"],
+                          r.get("import_time") or datetime.datetime.now(datetime.timezone.utc).strftime(
+                              "%Y-%m-%d %H:%M:%S"), r.get("meta") or ""))
+                    file_id = cur.lastrowid
+                    existing[r["file_path"]] = file_id
+                    stats["files"] += 1
+                else:
+                    stats["merged"] += 1
+                links.extend((file_id, tag_ids[(p, n)]) for p, n in r["tags"] if n)
+            cur.executemany("INSERT OR IGNORE INTO t_files_tags (file_id, tag_id) VALUES (?, ?)", links)
+            # rowcount 只统计本语句插入的行，不含触发器的写入
+            stats["links"] += max(cur.rowcount, 0)
+
+    try:
+        chunk, tags = [], []
+        done = 0
+        for kind, value in _read_catalog(in_path):
+            if kind == "tag":
+                # 标签行同样每 chunk_size 条一个事务；剩余的随下一批文件一起提交
+                tags.append(value)
+                if len(tags) >= chunk_size:
+                    with db:
+                        add_tags(tags)
+                    tags = []
+                continue
+            chunk.append(value)
+            if len(chunk) >= chunk_size:
+                flush(chunk, tags)
+                tags = []
+                done += len(chunk)
+                chunk = []
+                if progress:
+                    progress(done, None)
+        if chunk or tags:
+            flush(chunk, tags)
+            done += len(chunk)
+        if progress:
+            progress(done, done)
+        return stats
+    finally:
+        db.close()
+
+
+# -------------------------
+# 已解码图片的 LRU 缓存
+# -------------------------
+def image_nbytes(img):
+    """估算解码后图片占用的内存（按 RGBA 每像素 4 字节），支持 PIL Image 与 PhotoImage"""
+    if hasattr(img, "size") and not callable(img.size):
+        w, h = img.size
+    else:
+        w, h = img.width(), img.height()
+    return w * h * 4
+
+
+class ImageLRUCache:
+    """
+    有界的已解码图片缓存（最近最少使用淘汰）
+    - 同时按条目数和估算字节数限制容量，任一超限即从最旧的条目开始淘汰
+    - hits / misses / evictions 计数用于观察命中率，通过 stats() 获取
+    """
+
+    def __init__(self, max_items=THUMB_CACHE_MAX_ITEMS, max_mb=THUMB_CACHE_MAX_MB):
+        self.max_items = max(1, int(max_items))
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._items = OrderedDict()  # key -> (image, nbytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, image, nbytes=None):
+        if nbytes is None:
+            nbytes = image_nbytes(image)
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+        self._items[key] = (image, nbytes)
+        self.current_bytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        # 至少保留刚放入的一条，避免单张超大图片把缓存清空后仍超限导致死循环
+        while len(self._items) > 1 and (len(self._items) > self.max_items or self.current_bytes > self.max_bytes):
+            _, (_, nbytes) = self._items.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+    def discard(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.current_bytes -= item[1]
+
+    def clear(self):
+        self._items.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "items": len(self._items),
+            "bytes": self.current_bytes,
+            "max_items": self.max_items,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+
+# ================================================
+#    大图查看：多分辨率瓦片金字塔
+#    level 0 为原图，每升一级宽高减半，直到整图不超过一个瓦片；
+#    查看时只加载当前缩放级别下可见的瓦片
+# ================================================
+class MemoryPyramid:
+    """小图：整图解码后在内存中按级缩小，按需裁出瓦片"""
+
+    def __init__(self, img, tile_size=TILE_SIZE):
+        self.key = None
+        self.tile_size = tile_size
+        self._images = [img]
+        while img.width > tile_size or img.height > tile_size:
+            img = img.reduce(2)
+            self._images.append(img)
+        self.levels = [im.size for im in self._images]
+
+    def get_tile(self, level, tx, ty):
+        t = self.tile_size
+        img = self._images[level]
+        return img.crop((tx * t, ty * t, min(img.width, (tx + 1) * t), min(img.height, (ty + 1) * t)))
+
+
+class TilePyramid:
+    """大图：瓦片缓存在磁盘 TILE_CACHE_DIR/<key>/<level>/<x>_<y>.jpg，info.json 最后写入作为完成标记"""
+
+    def __init__(self, directory, info):
+        self.directory = directory
+        self.key = os.path.basename(directory)
+        self.tile_size = info["tile_size"]
+        self.levels = [tuple(wh) for wh in info["levels"]]
+
+    def get_tile(self, level, tx, ty):
+        perf.count("image.tile_load")
+        with Image.open(os.path.join(self.directory, str(level), f"{tx}_{ty}.jpg")) as img:
+            img.load()
+            return img
+
+    @staticmethod
+    def cache_dir_for(abs_path):
+        """按路径 + 大小 + 修改时间生成缓存目录，原图变化后自动使用新目录"""
+        st = os.stat(abs_path)
+        key = hashlib.sha1(f"{abs_path}|{st.st_size}|{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+        return os.path.join(TILE_CACHE_DIR, key[:2], key)
+
+    @classmethod
+    def load(cls, abs_path):
+        directory = cls.cache_dir_for(abs_path)
+        info_path = os.path.join(directory, "info.json")
+        try:
+            with open(info_path, encoding="utf-8") as f:
+                pyramid = cls(directory, json.load(f))
+        except (OSError, ValueError):
+            return None
+        # 刷新 info.json 的修改时间，作为 prune_tile_cache 的最近使用时间
+        with contextlib.suppress(OSError):
+            os.utime(info_path)
+        return pyramid
+
+    @classmethod
+    def build(cls, img, abs_path, tile_size=TILE_SIZE):
+        """
+        把已解码的原图切成各级瓦片写入磁盘；逐级 reduce，同一时刻只保留一级的整图。
+        瓦片总字节数记在 info.json 的 bytes 中，prune_tile_cache 不必再遍历瓦片
+        """
+        directory = cls.cache_dir_for(abs_path)
+        levels = []
+        level = 0
+        nbytes = 0
+        while True:
+            level_dir = os.path.join(directory, str(level))
+            os.makedirs(level_dir, exist_ok=True)
+            w, h = img.size
+            for ty in range(math.ceil(h / tile_size)):
+                for tx in range(math.ceil(w / tile_size)):
+                    box = (tx * tile_size, ty * tile_size, min(w, (tx + 1) * tile_size), min(h, (ty + 1) * tile_size))
+                    tile_path = os.path.join(level_dir, f"{tx}_{ty}.jpg")
+                    img.crop(box).save(tile_path, "JPEG", quality=90)
+                    nbytes += os.path.getsize(tile_path)
+            levels.append((w, h))
+            if w <= tile_size and h <= tile_size:
+                break
+            img = img.reduce(2)
+            level += 1
+        info = {"tile_size": tile_size, "levels": levels, "source": abs_path, "bytes": nbytes}
+        tmp = os.path.join(directory, "info.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        os.replace(tmp, os.path.join(directory, "info.json"))
+        prune_tile_cache(keep=directory)
+        return cls(directory, info)
+
+
+# 没有 info.json 的目录可能正在另一个线程中生成，超过这个时间仍未完成才视为中断残留
+TILE_BUILD_STALE_SECONDS = 3600
+_tile_prune_lock = threading.Lock()
+
+
+def _dir_size(path):
+    total = 0
+    for root, _dirs, names in os.walk(path):
+        for name in names:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _pyramid_bytes(directory, info_path):
+    """已完成金字塔的字节数：取 info.json 中的 bytes；没有该字段的旧缓存遍历一次后写回（保留修改时间）"""
+    with open(info_path, encoding="utf-8") as f:
+        info = json.load(f)
+    if "bytes" in info:
+        return info["bytes"]
+    st = os.stat(info_path)
+    info["bytes"] = _dir_size(directory)
+    tmp = info_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    os.replace(tmp, info_path)
+    os.utime(info_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return info["bytes"]
+
+
+def prune_tile_cache(max_bytes=None, keep=None):
+    """
+    把磁盘瓦片缓存控制在 max_bytes（默认 TILE_DISK_CACHE_MAX_MB）以内：
+    按金字塔的最近使用时间（info.json 的修改时间，打开时刷新）从最旧的开始整目录删除。
+    已完成的金字塔只读 info.json 中记录的大小，只有未完成的目录才遍历瓦片。
+    keep 为刚生成、不参与淘汰的目录。返回 (删除的金字塔数, 释放的字节数)
+    """
+    if max_bytes is None:
+        max_bytes = int(TILE_DISK_CACHE_MAX_MB * 1024 * 1024)
+    with _tile_prune_lock, perf.timer("image.prune_tile_cache"):
+        entries = []  # (最近使用时间, 大小, 目录, 是否完成)
+        total = 0
+        try:
+            prefixes = [e.path for e in os.scandir(TILE_CACHE_DIR) if e.is_dir()]
+        except OSError:
+            return 0, 0
+        for prefix in prefixes:
+            with contextlib.suppress(OSError):
+                for entry in os.scandir(prefix):
+                    if not entry.is_dir():
+                        continue
+                    info_path = os.path.join(entry.path, "info.json")
+                    try:
+                        mtime = os.stat(info_path).st_mtime
+                        size = _pyramid_bytes(entry.path, info_path)
+                        complete = True
+                    except (OSError, ValueError):
+                        mtime = entry.stat().st_mtime
+                        size = _dir_size(entry.path)
+                        complete = False
+                    total += size
+                    entries.append((mtime, size, entry.path, complete))
+        removed = freed = 0
+        stale_before = time.time() - TILE_BUILD_STALE_SECONDS
+        for mtime, size, path, complete in sorted(entries):
+            if total <= max_bytes:
+                break
+            if path == keep or (not complete and mtime > stale_before):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            freed += size
+            removed += 1
+        if removed:
+            perf.count("image.tile_cache_evict", removed)
+        return removed, freed
+
+
+_large_image_lock = threading.Lock()
+if hasattr(os, "register_at_fork"):
+    # 进程池以 fork 启动时，子进程可能继承一把被其他线程持有的锁，在子进程中换一把新的
+    os.register_at_fork(after_in_child=lambda: globals().update(_large_image_lock=threading.Lock()))
+
+
+def open_large_image(fp):
+    """
+    打开图库中的图片（路径或文件对象）：只在读取文件头期间把 Pillow 的像素上限临时放宽到
+    LARGE_IMAGE_MAX_PIXELS，打开后再按该上限检查尺寸，超出时抛出 Image.DecompressionBombError
+    """
+    with _large_image_lock:
+        default = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = LARGE_IMAGE_MAX_PIXELS
+        try:
+            img = Image.open(fp)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default
+    if img.width * img.height > LARGE_IMAGE_MAX_PIXELS:
+        img.close()
+        raise Image.DecompressionBombError(
+            f"图片 {img.width}x{img.height} 超过像素上限 {LARGE_IMAGE_MAX_PIXELS}")
+    return img
+
+
+@perf.timed("image.open_pyramid")
+def open_pyramid(abs_path):
+    """取图片的瓦片金字塔：磁盘已有则直接用，否则解码原图生成（耗时，应在后台线程调用）"""
+    pyramid = TilePyramid.load(abs_path)
+    if pyramid is not None:
+        return pyramid
+    perf.count("image.open")
+    with open_large_image(abs_path) as img:
+        img = img.convert("RGB")
+    if img.width * img.height <= PYRAMID_MIN_PIXELS:
+        return MemoryPyramid(img)
+    return TilePyramid.build(img, abs_path)
+
+
+def load_fit_preview(abs_path, size):
+    """按窗口大小快速解码一张预览图（JPEG 用 draft 降采样解码），返回 (预览图, 原图尺寸)"""
+    with open_large_image(abs_path) as img:
+        full_size = img.size
+        img.draft("RGB", size)
+        img = img.convert("RGB")
+    img.thumbnail(size)
+    return img, full_size
+
+
+class ImagePrefetcher:
+    """
+    在后台线程池中把图片按屏幕大小预解码（load_fit_preview），结果放入有界 LRU。
+    prefetch() 只保留最新一批目标，尚未开始的旧任务会被取消；
+    get() 命中缓存直接返回，正在解码则等待该任务，都没有才同步解码。
+    """
+
+    def __init__(self, size, workers=PREFETCH_WORKERS, max_mb=PREFETCH_CACHE_MB):
+        self.size = size
+        self.cache = ImageLRUCache(max_items=64, max_mb=max_mb)
+        self._lock = threading.Lock()
+        self._futures = {}  # path -> Future
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+    def _decode(self, path):
+        try:
+            with perf.timer("image.prefetch_decode"):
+                result = load_fit_preview(path, self.size)
+            with self._lock:
+                self.cache.put(path, result, image_nbytes(result[0]))
+            return result
+        finally:
+            with self._lock:
+                self._futures.pop(path, None)
+
+    def prefetch(self, paths):
+        with self._lock:
+            for p, fut in list(self._futures.items()):
+                if p not in paths and fut.cancel():
+                    del self._futures[p]
+            for p in paths:
+                if p not in self.cache and p not in self._futures:
+                    self._futures[p] = self._executor.submit(self._decode, p)
+
+    def get(self, path):
+        with self._lock:
+            hit = self.cache.get(path)
+            fut = self._futures.get(path)
+        if hit is not None:
+            perf.count("prefetch.hit")
+            return hit
+        if fut is not None:
+            perf.count("prefetch.wait")
+            try:
+                return fut.result()
+            except Exception:
+                pass
+        perf.count("prefetch.miss")
+        return self._decode(path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ================================================================
+#                      大图查看窗口（瓦片金字塔 + 缩放/平移）
+# ================================================================
+class ImageViewer(tk.Toplevel):
+    """
+    大图查看：先显示按屏幕大小解码的预览，放大到预览分辨率不够时，
+    才在后台生成/加载瓦片金字塔并切换为瓦片显示。
+    滚轮以鼠标位置为中心缩放，左键拖动平移，+/- 缩放，0 适应窗口。
+    内存占用只与可见瓦片数和瓦片缓存上限有关，与原图大小无关。
+    ←/→ 在结果列表中翻页，同一窗口复用；前后相邻的图片在后台预解码。
+    """
+
+    ZOOM_STEP = 1.25
+    MAX_ZOOM = 8.0
+
+    def __init__(self, master, abs_path, playlist=None):
+        super().__init__(master)
+        self.title("查看图片")
+        self.geometry("1000x800")
+
+        self.canvas = tk.Canvas(self, bg="#202020", highlightthickness=0)
+        self.canvas.pack(fill="both", expand=True)
+        self.status_var = tk.StringVar(value="")
+        tk.Label(self, textvariable=self.status_var, anchor="w", fg="#555").pack(fill="x", padx=6)
+
+        self.tile_cache = ImageLRUCache(max_items=100000, max_mb=TILE_CACHE_MAX_MB)
+        self._photos = {}  # (level, tx, ty) -> PhotoImage，仅保留当前可见的瓦片
+        self._photos_zoom = None
+        self._render_pending = None
+        self._drag_start = None
+        self.pyramid = None
+        self._pyramid_result = None
+
+        # 翻页与预解码
+        self.playlist = []
+        self.index = 0
+        self.direction = 1
+        self.prefetcher = ImagePrefetcher((self.winfo_screenwidth(), self.winfo_screenheight()))
+        self.bind("<Destroy>", self._on_destroy)
+
+        self.canvas.bind("<Configure>", lambda e: self._on_resize())
+        self.canvas.bind("<ButtonPress-1>", self._on_drag_start)
+        self.canvas.bind("<B1-Motion>", self._on_drag)
+        self.canvas.bind("<MouseWheel>", lambda e: self._zoom_at(e.x, e.y, 1 if e.delta > 0 else -1))
+        self.canvas.bind("<Button-4>", lambda e: self._zoom_at(e.x, e.y, 1))
+        self.canvas.bind("<Button-5>", lambda e: self._zoom_at(e.x, e.y, -1))
+        self.bind("<plus>", lambda e: self._zoom_center(1))
+        self.bind("<equal>", lambda e: self._zoom_center(1))
+        self.bind("<minus>", lambda e: self._zoom_center(-1))
+        self.bind("<Key-0>", lambda e: self.fit())
+        self.bind("<Left>", lambda e: self.step(-1))
+        self.bind("<Right>", lambda e: self.step(1))
+        self.bind("<Prior>", lambda e: self.step(-1))
+        self.bind("<Next>", lambda e: self.step(1))
+
+        try:
+            self.show(abs_path, playlist)
+        except Exception:
+            self.destroy()
+            raise
+
+    def _on_destroy(self, event):
+        if event.widget is self:
+            self.prefetcher.shutdown()
+
+    # ------------------ 载入 / 翻页 ------------------
+    def show(self, abs_path, playlist=None):
+        """显示 abs_path；playlist 为可翻页的路径列表（通常是当前搜索结果）"""
+        playlist = self.playlist if playlist is None else list(playlist)
+        self.load(abs_path, playlist.index(abs_path) if abs_path in playlist else 0, playlist)
+
+    def step(self, delta):
+        """
+        翻到相邻图片。只有新图片解码成功后才更新 index；打不开的图片沿翻页方向跳过，
+        都打不开时停留在当前图片
+        """
+        if not self.playlist:
+            return
+        self.direction = 1 if delta > 0 else -1
+        index = self.index + delta
+        failed = []
+        while 0 <= index < len(self.playlist):
+            try:
+                self.load(self.playlist[index], index)
+            except Exception:
+                failed.append(os.path.basename(self.playlist[index]))
+                index += self.direction
+                continue
+            break
+        if failed:
+            self.status_var.set(f"{self.full_size[0]}x{self.full_size[1]}  已跳过无法打开的图片：{', '.join(failed)}")
+
+    def _prefetch_neighbours(self):
+        """预解码前后各一张，并沿翻页方向多取 PREFETCH_AHEAD 张"""
+        d = self.direction
+        offsets = [d, -d] + [d * k for k in range(2, PREFETCH_AHEAD + 2)]
+        paths = [self.playlist[self.index + o] for o in offsets if 0 <= self.index + o < len(self.playlist)]
+        self.prefetcher.prefetch(paths)
+
+    def load(self, abs_path, index=None, playlist=None):
+        """解码并显示 abs_path；解码失败时抛出异常，当前显示和 index / playlist 保持不变"""
+        with perf.timer("image.decode_preview"):
+            self.preview, self.full_size = self.prefetcher.get(abs_path)
+        if playlist is not None:
+            self.playlist = playlist
+        if index is not None:
+            self.index = index
+        self.abs_path = abs_path
+        position = f"（{self.index + 1}/{len(self.playlist)}）" if self.playlist else ""
+        self.title(f"查看图片 - {os.path.basename(abs_path)} {position}")
+        self.pyramid = None
+        self._pyramid_result = None
+        self._photos = {}
+        self.update_idletasks()
+        self.fit()
+        self.status_var.set(f"{self.full_size[0]}x{self.full_size[1]}")
+        if self.playlist:
+            self._prefetch_neighbours()
+
+    def _preview_is_enough(self):
+        """当前缩放下预览图分辨率是否足够（不够才需要瓦片）"""
+        return self.zoom * self.full_size[0] <= self.preview.width * 1.01
+
+    def _start_pyramid(self, abs_path):
+        self.status_var.set("正在准备瓦片…")
+        result = self._pyramid_result = {}
+
+        def worker():
+            try:
+                result["pyramid"] = open_pyramid(abs_path)
+            except Exception as e:
+                result["error"] = e
+
+        threading.Thread(target=worker, daemon=True).start()
+        self._poll_pyramid(abs_path, result)
+
+    def _poll_pyramid(self, abs_path, result):
+        # 已翻到别的图片（或重新载入）时丢弃旧结果
+        if not self.winfo_exists() or result is not self._pyramid_result:
+            return
+        if not result:
+            self.after(50, self._poll_pyramid, abs_path, result)
+            return
+        if "error" in result:
+            self.status_var.set(f"瓦片生成失败，仅显示预览：{result['error']}")
+            return
+        self.pyramid = result["pyramid"]
+        self._schedule_render()
+
+    # ------------------ 视图状态 ------------------
+    def _canvas_size(self):
+        return max(self.canvas.winfo_width(), 1), max(self.canvas.winfo_height(), 1)
+
+    def fit(self):
+        cw, ch = self._canvas_size()
+        w, h = self.full_size
+        self.min_zoom = min(cw / w, ch / h, 1.0) / 2
+        self.zoom = min(cw / w, ch / h, 1.0)
+        self.view_x, self.view_y = 0.0, 0.0
+        # 用户缩放/拖动前，窗口大小变化时保持适应窗口
+        self._auto_fit = True
+        self._clamp_view()
+        self._schedule_render()
+
+    def _clamp_view(self):
+        """view_x/view_y 为画布左上角对应的原图坐标；图比画布小时居中，否则不越出图片边界"""
+        cw, ch = self._canvas_size()
+        w, h = self.full_size
+        vw, vh = cw / self.zoom, ch / self.zoom
+        self.view_x = (w - vw) / 2 if vw >= w else min(max(self.view_x, 0), w - vw)
+        self.view_y = (h - vh) / 2 if vh >= h else min(max(self.view_y, 0), h - vh)
+
+    def _zoom_at(self, x, y, steps):
+        new_zoom = min(max(self.zoom * (self.ZOOM_STEP ** steps), self.min_zoom), self.MAX_ZOOM)
+        if new_zoom == self.zoom:
+            return
+        self._auto_fit = False
+        # 保持鼠标下的原图坐标不动
+        ox, oy = self.view_x + x / self.zoom, self.view_y + y / self.zoom
+        self.zoom = new_zoom
+        self.view_x, self.view_y = ox - x / new_zoom, oy - y / new_zoom
+        self._clamp_view()
+        self._schedule_render()
+
+    def _zoom_center(self, steps):
+        cw, ch = self._canvas_size()
+        self._zoom_at(cw / 2, ch / 2, steps)
+
+    def _on_drag_start(self, event):
+        self._drag_start = (event.x, event.y, self.view_x, self.view_y)
+
+    def _on_drag(self, event):
+        if not self._drag_start:
+            return
+        x0, y0, vx, vy = self._drag_start
+        self._auto_fit = False
+        self.view_x = vx - (event.x - x0) / self.zoom
+        self.view_y = vy - (event.y - y0) / self.zoom
+        self._clamp_view()
+        self._schedule_render()
+
+    def _on_resize(self):
+        if not hasattr(self, "zoom"):
+            return
+        if self._auto_fit:
+            self.fit()
+        else:
+            self._clamp_view()
+            self._schedule_render()
+
+    # ------------------ 绘制 ------------------
+    def _schedule_render(self):
+        # 合并连续的缩放/拖动事件，每次空闲时只绘制一次
+        if self._render_pending is None:
+            self._render_pending = self.after_idle(self._render)
+
+    def _render(self):
+        self._render_pending = None
+        with perf.timer("ui.viewer_render"):
+            self.canvas.delete("img")
+            if self.pyramid is None:
+                self._render_preview()
+                if self._pyramid_result is None and not self._preview_is_enough():
+                    self._start_pyramid(self.abs_path)
+            else:
+                self._render_tiles()
+
+    def _to_screen(self, x, y):
+        return round((x - self.view_x) * self.zoom), round((y - self.view_y) * self.zoom)
+
+    def _render_preview(self):
+        """瓦片就绪前用预览图顶替：只取可见区域放大到画布，不会随缩放倍数生成超大图片"""
+        cw, ch = self._canvas_size()
+        w, h = self.full_size
+        sx, sy = self.preview.width / w, self.preview.height / h
+        vx0, vy0 = max(0.0, self.view_x), max(0.0, self.view_y)
+        vx1, vy1 = min(w, self.view_x + cw / self.zoom), min(h, self.view_y + ch / self.zoom)
+        x0, y0 = self._to_screen(vx0, vy0)
+        x1, y1 = self._to_screen(vx1, vy1)
+        img = self.preview.resize((max(1, x1 - x0), max(1, y1 - y0)), Image.BILINEAR,
+                                  box=(vx0 * sx, vy0 * sy, vx1 * sx, vy1 * sy))
+        self._preview_photo = ImageTk.PhotoImage(img)
+        self.canvas.create_image(x0, y0, image=self._preview_photo, anchor="nw", tags="img")
+
+    def _render_tiles(self):
+        pyramid = self.pyramid
+        cw, ch = self._canvas_size()
+        # 选择分辨率不低于显示需要的最粗一级：level 每升一级缩小一半
+        level = 0
+        if self.zoom < 1:
+            level = min(int(math.floor(math.log2(1 / self.zoom))), len(pyramid.levels) - 1)
+        scale = 2 ** level  # level 中 1 像素 = 原图 scale 像素
+        t = pyramid.tile_size
+        lw, lh = pyramid.levels[level]
+
+        if self._photos_zoom != self.zoom:
+            self._photos = {}
+            self._photos_zoom = self.zoom
+
+        tx0 = max(0, int(self.view_x / scale // t))
+        ty0 = max(0, int(self.view_y / scale // t))
+        tx1 = min(math.ceil(lw / t) - 1, int((self.view_x + cw / self.zoom) / scale // t))
+        ty1 = min(math.ceil(lh / t) - 1, int((self.view_y + ch / self.zoom) / scale // t))
+
+        visible = {}
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                key = (level, tx, ty)
+                # 瓦片在原图中的范围（右/下边缘瓦片可能不满）
+                x0, y0 = self._to_screen(tx * t * scale, ty * t * scale)
+                x1, y1 = self._to_screen(min(lw, (tx + 1) * t) * scale, min(lh, (ty + 1) * t) * scale)
+                photo = self._photos.get(key)
+                if photo is None:
+                    cache_key = (pyramid.key or self.abs_path, level, tx, ty)
+                    tile = self.tile_cache.get(cache_key)
+                    if tile is None:
+                        tile = pyramid.get_tile(level, tx, ty)
+                        self.tile_cache.put(cache_key, tile)
+                    if tile.size != (x1 - x0, y1 - y0):
+                        tile = tile.resize((max(1, x1 - x0), max(1, y1 - y0)), Image.BILINEAR)
+                    photo = ImageTk.PhotoImage(tile)
+                visible[key] = photo
+                self.canvas.create_image(x0, y0, image=photo, anchor="nw", tags="img")
+        self._photos = visible
+
+        st = self.tile_cache.stats()
+        w, h = self.full_size
+        self.status_var.set(f"{w}x{h}  缩放 {self.zoom:.0%}  层级 {level}/{len(pyramid.levels) - 1}  "
+                            f"可见瓦片 {len(visible)}  瓦片缓存 {st['items']} 张 / {st['bytes'] / 1024 / 1024:.0f} MB")
+
+
+# ================================================================
+#                      导入页预览条（虚拟化 + 后台懒解码）
+# ================================================================
+class ImportGallery(tk.Frame):
+    """
+    导入页横向预览条：显示本次选择的全部图片，可逐张取消勾选。
+    - 只为可见范围内的格子创建画布元素，几千张图片也只有十几个格子在画布上
+    - 缩略图在后台线程中解码（thumbnail 内部用 draft 降采样解码 JPEG），
+      结果经队列回到 Tk 线程生成 PhotoImage；滚出可见范围的排队任务会被取消
+    - 点击格子左上角的勾选框切换是否导入，点击其他位置在右侧大预览中显示
+    """
+
+    CELL_W, CELL_H = 112, 132
+    THUMB = (96, 96)
+    CHECK_BOX = 18
+
+    def __init__(self, master, on_preview=None, on_change=None):
+        super().__init__(master)
+        self.on_preview = on_preview
+        self.on_change = on_change
+        self.paths = []
+        self.included = []
+
+        self.canvas = tk.Canvas(self, height=self.CELL_H + 4, bg="#f7f7f7", highlightthickness=0)
+        hsb = tk.Scrollbar(self, orient="horizontal", command=self._xview)
+        self.canvas.configure(xscrollcommand=hsb.set)
+        self.canvas.pack(fill="x")
+        hsb.pack(fill="x")
+
+        self.photos = ImageLRUCache(max_items=600, max_mb=64)  # path -> PhotoImage
+        self.failed = set()
+        self._drawn = set()
+        self._pending = {}  # index -> Future
+        self._results = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gallery")
+        self._generation = 0  # 每次 set_paths 递增，丢弃上一批的解码结果
+
+        self.canvas.bind("<Configure>", lambda e: self._refresh_visible())
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<MouseWheel>", lambda e: self._scroll(-1 if e.delta > 0 else 1))
+        self.canvas.bind("<Shift-MouseWheel>", lambda e: self._scroll(-1 if e.delta > 0 else 1))
+        self.canvas.bind("<Button-4>", lambda e: self._scroll(-1))
+        self.canvas.bind("<Button-5>", lambda e: self._scroll(1))
+        self.bind("<Destroy>", lambda e: self._executor.shutdown(wait=False, cancel_futures=True)
+                  if e.widget is self else None)
+        self.after(50, self._drain_results)
+
+    # ------------------ 数据 ------------------
+    def set_paths(self, paths):
+        self._generation += 1
+        for fut in self._pending.values():
+            fut.cancel()
+        self._pending = {}
+        self.paths = list(paths)
+        self.included = [True] * len(self.paths)
+        self.failed = set()
+        self.canvas.delete("all")
+        self._drawn = set()
+        self.canvas.configure(scrollregion=(0, 0, len(self.paths) * self.CELL_W, self.CELL_H))
+        self.canvas.xview_moveto(0)
+        self._refresh_visible()
+        self._notify_change()
+
+    def clear(self):
+        self.set_paths([])
+
+    def included_paths(self):
+        return [p for p, inc in zip(self.paths, self.included) if inc]
+
+    def set_all(self, value):
+        self.included = [value] * len(self.paths)
+        for idx in list(self._drawn):
+            self._redraw(idx)
+        self._notify_change()
+
+    def _notify_change(self):
+        if self.on_change:
+            self.on_change(sum(self.included), len(self.paths))
+
+    # ------------------ 滚动 / 可见范围 ------------------
+    def _xview(self, *args):
+        self.canvas.xview(*args)
+        self._refresh_visible()
+
+    def _scroll(self, units):
+        self.canvas.xview_scroll(units * 3, "units")
+        self._refresh_visible()
+
+    def _visible_range(self):
+        if not self.paths:
+            return range(0)
+        x0 = self.canvas.canvasx(0)
+        x1 = self.canvas.canvasx(max(self.canvas.winfo_width(), 1))
+        first = max(0, int(x0 // self.CELL_W) - 1)
+        last = min(len(self.paths) - 1, int(x1 // self.CELL_W) + 1)
+        return range(first, last + 1)
+
+    def _refresh_visible(self):
+        visible = set(self._visible_range())
+        for idx in self._drawn - visible:
+            self.canvas.delete(f"cell{idx}")
+        for idx in visible - self._drawn:
+            self._draw_cell(idx)
+        self._drawn = visible
+
+        # 取消已滚出可见范围、尚未开始的解码任务
+        for idx, fut in list(self._pending.items()):
+            if idx not in visible and fut.cancel():
+                del self._pending[idx]
+        for idx in sorted(visible):
+            path = self.paths[idx]
+            if idx not in self._pending and path not in self.photos and path not in self.failed:
+                self._pending[idx] = self._executor.submit(self._decode, self._generation, idx, path)
+
+    # ------------------ 解码 ------------------
+    def _decode(self, generation, idx, path):
+        try:
+            img = load_thumbnail(path, self.THUMB)
+            img.load()
+        except Exception:
+            img = None
+        self._results.put((generation, idx, path, img))
+
+    def _drain_results(self):
+        if not self.winfo_exists():
+            return
+        for _ in range(64):
+            try:
+                generation, idx, path, img = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self._generation:
+                continue
+            self._pending.pop(idx, None)
+            if img is None:
+                self.failed.add(path)
+            else:
+                self.photos.put(path, ImageTk.PhotoImage(img))
+            if idx in self._drawn:
+                self._redraw(idx)
+        self.after(50, self._drain_results)
+
+    # ------------------ 绘制 ------------------
+    def _redraw(self, idx):
+        self.canvas.delete(f"cell{idx}")
+        self._draw_cell(idx)
+
+    def _draw_cell(self, idx):
+        tag = f"cell{idx}"
+        path = self.paths[idx]
+        included = self.included[idx]
+        x = idx * self.CELL_W
+        c = self.canvas
+        c.create_rectangle(x + 4, 2, x + self.CELL_W - 4, self.CELL_H - 2,
+                           outline="#1976D2" if included else "#bbb", fill="white" if included else "#eee",
+                           tags=tag)
+        cx, cy = x + self.CELL_W // 2, 8 + self.THUMB[1] // 2
+        photo = self.photos.get(path) if path in self.photos else None
+        if photo is not None:
+            c.create_image(cx, cy, image=photo, tags=tag)
+        else:
+            c.create_text(cx, cy, text="无法解码" if path in self.failed else "…", fill="#999", tags=tag)
+        name = os.path.basename(path)
+        c.create_text(cx, self.CELL_H - 14, text=name if len(name) <= 14 else name[:12] + "…",
+                      font=("Arial", 8), fill="#333" if included else "#999", tags=tag)
+        # 勾选框
+        b = self.CHECK_BOX
+        c.create_rectangle(x + 8, 6, x + 8 + b, 6 + b, outline="#555", fill="white", tags=tag)
+        if included:
+            c.create_text(x + 8 + b // 2, 6 + b // 2, text="✓", fill="#2e7d32", font=("Arial", 11, "bold"), tags=tag)
+
+    def _on_click(self, event):
+        if not self.paths:
+            return
+        cx = self.canvas.canvasx(event.x)
+        idx = int(cx // self.CELL_W)
+        if not 0 <= idx < len(self.paths):
+            return
+        local_x = cx - idx * self.CELL_W
+        if 6 <= local_x <= 10 + self.CHECK_BOX and 4 <= event.y <= 8 + self.CHECK_BOX:
+            self.included[idx] = not self.included[idx]
+            self._redraw(idx)
+            self._notify_change()
+        elif self.on_preview:
+            self.on_preview(self.paths[idx])
+
+
+# ================================================================
+#                      GUI 主界面（左右布局 + 折叠查看面板）
+# ================================================================
+class ImageManager(tk.Tk):
+    def __init__(self):
+        super().__init__()
+        self._startup_t0 = time.perf_counter()
+        self.title("图片管理系统")
+        self.geometry("1000x720")
+
+        # 导入相关
+        self.selected_files = []
+        # 记忆每个维度被勾选的子标签集合（导入页） {parent: set(tag1, tag2)}
+        self.selected_tags_by_dim = {}
+
+        # 查看页相关属性：提前初始化，避免在导入页面刷新时访问未创建的 UI 引发 AttributeError
+        self.view_accordion_frames = {}  # parent -> {'header_btn': btn, 'content': frame, 'open': bool, 'built': bool}
+        self.view_tag_tree = OrderedDict()  # 当前标签树 {维度: [子标签]}
+        self.view_tag_vars = {}  # parent -> {tag: BooleanVar}
+        self.view_selected_tags_by_dim = {}  # parent -> set(tag)
+        # UI 容器占位（实际在 setup_view_tab 创建）
+        self.left_inner = None
+        self.thumb_inner = None
+
+        # 查看页缩略图：解码结果缓存（跨搜索复用）+ 当前结果集的缩略图控件
+        self.thumb_cache = ImageLRUCache()
+        self.thumb_frames = []  # 与 search_results 一一对应的缩略图 frame
+        self.thumb_cols = 0  # 当前布局列数，列数不变时无需重新摆放
+        self.search_file_ids = {}  # abs_path -> file_id
+        self.last_search_query = None  # (sql, params)，最近一次标签搜索
+        self.viewer = None  # 大图查看窗口（单实例复用）
+        # 挂载的图库（第一个为本库），以及联合搜索结果中来自其他图库的图片 abs_path -> (Library, file_id)
+        self.libraries = load_libraries()
+        self.search_foreign = {}
+
+        # 预览设置
+        self.preview_size = (300, 300)
+        self.preview_photo = None  # 保持引用防止被 GC
+        self.preview_name_var = tk.StringVar(value="")
+
+        # 后台任务：导入、导出、删除标签、搜索等在工作线程中执行，结果回到界面线程
+        self.jobs = JobManager()
+        self._search_job = None  # 最近一次搜索任务，新搜索提交时取消旧的
+
+        self.setup_menu()
+
+        # 底部状态栏：显示后台任务，点击打开任务面板
+        self.job_status_var = tk.StringVar(value="")
+        job_status = tk.Label(self, textvariable=self.job_status_var, anchor="w", fg="#555", cursor="hand2")
+        job_status.pack(side=tk.BOTTOM, fill="x", padx=8)
+        job_status.bind("<Button-1>", lambda e: self.jobs_window())
+
+        # 使用 Notebook（导入 / 查看）
+        self.tab_control = ttk.Notebook(self)
+        self.tab_import = ttk.Frame(self.tab_control)
+        self.tab_view = ttk.Frame(self.tab_control)
+        self.tab_control.add(self.tab_import, text="导入图片")
+        self.tab_control.add(self.tab_view, text="查看图片")
+        self.tab_control.pack(expand=1, fill="both")
+
+        # 注意：先创建查看页的控件（保证 left_inner/thumb_inner 存在），然后再创建导入页
+        # 这样即便导入页 refresh 调用 view 刷新也不会出现未创建属性的访问
+        self.setup_view_tab()
+        self.setup_import_tab()
+        perf.record("startup.build_widgets", time.perf_counter() - self._startup_t0)
+
+        # 启动分阶段：窗口先显示（不访问数据库），再在后台线程打开数据库、读取标签树，完成后填充面板
+        self.db_ready = False
+        self._first_mapped = False
+        self.bind("<Map>", self._on_first_map, add="+")
+        self.after(self.JOB_POLL_MS, self._poll_jobs)
+
+    # ================================================================
+    #                      启动：首屏之后再加载数据库
+    # ================================================================
+    def _on_first_map(self, event):
+        if event.widget is not self or self._first_mapped:
+            return
+        self._first_mapped = True
+        perf.record("startup.first_paint", time.perf_counter() - self._startup_t0)
+
+        def load(job):
+            open_database()
+            with perf.timer("startup.tag_tree"):
+                return get_tag_tree()
+
+        # 让出一次事件循环，保证首屏先绘制出来
+        self.after(10, lambda: self.jobs.submit(
+            "打开数据库", load, JOB_PRIORITY_HIGH, kind="open_database", on_done=self._on_database_ready,
+            on_error=lambda e: messagebox.showerror("错误", f"无法打开数据库：{e}")))
+
+    def _on_database_ready(self, tag_tree):
+        self.db_ready = True
+        self.refresh_dimension_list(tag_tree)
+        self._refresh_saved_search_list()
+        perf.record("startup.ready", time.perf_counter() - self._startup_t0)
+        if not tag_cooccurrence_ready():
+            # 首次统计标签共现（之后由触发器增量维护），完成后导入页即可显示建议标签
+            self._submit_job("统计标签共现", lambda job: rebuild_tag_cooccurrence(job.progress, job.cancelled),
+                             JOB_PRIORITY_LOW, kind="tag_cooccur", on_done=lambda _: self._refresh_tag_suggestions())
+
+    def _require_db(self):
+        """数据库仍在后台打开时，提示稍候并返回 False"""
+        if not self.db_ready:
+            messagebox.showinfo("提示", "正在打开数据库，请稍候")
+        return self.db_ready
+
+    # ================================================================
+    #                      菜单栏（诊断工具）
+    # ================================================================
+    IMPORT_SHARD_DATE = "按日期分片"
+    IMPORT_SHARD_HASH = "按内容哈希分片"
+
+    PROFILE_ACTIONS = [
+        ("搜索", "search"),
+        ("渲染缩略图", "render_thumbnails"),
+        ("保存图片和标签", "save_files"),
+        ("下载 ZIP", "download_zip"),
+        ("查看大图", "show_full_image"),
+        ("刷新标签面板", "refresh_view_tags"),
+        ("删除大维度", "delete_dimension"),
+    ]
+
+    def setup_menu(self):
+        menubar = tk.Menu(self)
+
+        diag_menu = tk.Menu(menubar, tearoff=0)
+        self.perf_enabled_var = tk.BooleanVar(value=perf.enabled)
+        diag_menu.add_checkbutton(label="启用性能统计", variable=self.perf_enabled_var,
+                                  command=lambda: setattr(perf, "enabled", self.perf_enabled_var.get()))
+        diag_menu.add_command(label="性能统计…", command=self.diagnostics_window)
+
+        profile_menu = tk.Menu(diag_menu, tearoff=0)
+        for label, action in self.PROFILE_ACTIONS:
+            profile_menu.add_command(label=label, command=lambda a=action, l=label: self._arm_profile(a, l))
+        diag_menu.add_cascade(label="分析下一次操作（cProfile）", menu=profile_menu)
+        menubar.add_cascade(label="诊断", menu=diag_menu)
+
+        lib_menu = tk.Menu(menubar, tearoff=0)
+        lib_menu.add_command(label="挂载图库目录…", command=self.mount_library)
+        lib_menu.add_command(label="卸载图库…", command=self.unmount_library)
+        lib_menu.add_command(label="已挂载的图库", command=self.show_libraries)
+        lib_menu.add_separator()
+        lib_menu.add_command(label="存储布局…", command=self.storage_layout_window)
+        lib_menu.add_command(label="转码策略…", command=self.transcode_window)
+        lib_menu.add_separator()
+        lib_menu.add_command(label="增量备份到…", command=self.backup_window)
+        lib_menu.add_separator()
+        lib_menu.add_command(label="完整性校验（可续传）", command=self.verify_integrity)
+        lib_menu.add_command(label="显示有问题的图片", command=self.show_integrity_problems)
+        lib_menu.add_command(label="从备份修复…", command=self.repair_integrity)
+        lib_menu.add_separator()
+        lib_menu.add_command(label="标签共现统计…", command=self.tag_stats_window)
+        menubar.add_cascade(label="图库", menu=lib_menu)
+
+        job_menu = tk.Menu(menubar, tearoff=0)
+        job_menu.add_command(label="任务列表…", command=self.jobs_window)
+        menubar.add_cascade(label="任务", menu=job_menu)
+
+        self.config(menu=menubar)
+
+    # ---------- 多图库 ----------
+    def mount_library(self):
+        if not self._require_db():
+            return
+        root = filedialog.askdirectory(title="选择图库根目录（含 images.db 与 files/，不存在则新建）")
+        if not root:
+            return
+        # 同一目录挂载两次（或挂载本库自己）会让联合搜索重复计数、分片导入写进同一个库
+        key = library_root_key(root)
+        mounted = next((lib for lib in self.libraries if library_root_key(lib.root) == key), None)
+        if mounted is not None:
+            messagebox.showwarning("提示", "这是本库的根目录，无需挂载" if mounted.is_primary
+                                   else f"该目录已作为图库「{mounted.name}」挂载")
+            return
+        name = simpledialog.askstring("挂载图库", "图库名称：", parent=self)
+        if not name or not name.strip():
+            return
+        name = name.strip()
+        if any(lib.name == name for lib in self.libraries):
+            messagebox.showwarning("提示", f"图库「{name}」已存在")
+            return
+        shard_from = simpledialog.askstring(
+            "挂载图库", "按日期分片导入时的起始日期（YYYY-MM-DD，可留空）：", parent=self) or None
+        library = Library(name, root, shard_from.strip() if shard_from else None)
+        try:
+            with library.lock:
+                library.connection()
+        except Exception as e:
+            messagebox.showerror("错误", f"无法打开图库：{e}")
+            return
+        self.libraries.append(library)
+        save_libraries(self.libraries)
+        self._refresh_library_choices()
+
+    def unmount_library(self):
+        names = [lib.name for lib in self.libraries if not lib.is_primary]
+        if not names:
+            messagebox.showinfo("提示", "没有挂载其他图库")
+            return
+        name = simpledialog.askstring("卸载图库", "要卸载的图库名称（文件不会删除）：\n" + "、".join(names), parent=self)
+        library = next((lib for lib in self.libraries if lib.name == (name or "").strip() and not lib.is_primary), None)
+        if library is None:
+            return
+        library.close()
+        self.libraries.remove(library)
+        save_libraries(self.libraries)
+        self._refresh_library_choices()
+
+    def show_libraries(self):
+        lines = [f"{lib.name}：{lib.root}" + (f"（分片起始 {lib.shard_from}）" if lib.shard_from else "")
+                 for lib in self.libraries]
+        messagebox.showinfo("已挂载的图库", "\n".join(lines))
+
+    def storage_layout_window(self):
+        """切换存储布局并在后台迁移现有文件，迁移期间可继续使用，可停止后续传"""
+        if not self._require_db():
+            return
+        win = tk.Toplevel(self)
+        win.title("存储布局")
+        win.transient(self)
+        layout_var = tk.StringVar(value=get_storage_layout())
+        labels = {"flat": "单目录 files/", "date": "按导入年月 files/年/月/", "hash": "按哈希 files/ab/cd/"}
+        for layout in STORAGE_LAYOUTS:
+            tk.Radiobutton(win, text=labels[layout], variable=layout_var, value=layout).pack(anchor="w", padx=12)
+        status_var = tk.StringVar(value="")
+        if get_setting("layout_migration"):
+            status_var.set("上次迁移未完成，开始后从断点继续")
+        tk.Label(win, textvariable=status_var, fg="#666").pack(padx=12, pady=(6, 0))
+        bar = ttk.Progressbar(win, length=320, mode="determinate")
+        bar.pack(padx=12, pady=6)
+
+        stop_event = threading.Event()
+        updates = queue.Queue()
+
+        def run(layout):
+            try:
+                moved = migrate_storage_layout(layout, progress=lambda d, t: updates.put(("progress", d, t)),
+                                               should_stop=stop_event.is_set, pause=0.05)
+                updates.put(("done", moved, None))
+            except Exception as e:
+                updates.put(("error", str(e), None))
+
+        def poll():
+            try:
+                while True:
+                    kind, a, b = updates.get_nowait()
+                    if kind == "progress":
+                        bar.config(maximum=max(b, 1), value=a)
+                        status_var.set(f"{a}/{b}")
+                    else:
+                        start_btn.config(state="normal")
+                        stop_btn.config(state="disabled")
+                        if kind == "error":
+                            status_var.set(f"迁移失败：{a}")
+                        else:
+                            status_var.set(("已停止" if stop_event.is_set() else "迁移完成") + f"，移动 {a} 个文件")
+                        return
+            except queue.Empty:
+                pass
+            if win.winfo_exists():
+                win.after(200, poll)
+
+        def start():
+            stop_event.clear()
+            start_btn.config(state="disabled")
+            stop_btn.config(state="normal")
+            status_var.set("迁移中…")
+            threading.Thread(target=run, args=(layout_var.get(),), daemon=True).start()
+            poll()
+
+        btns = tk.Frame(win)
+        btns.pack(pady=(0, 10))
+        start_btn = tk.Button(btns, text="应用并迁移", command=start)
+        start_btn.pack(side=tk.LEFT, padx=6)
+        stop_btn = tk.Button(btns, text="停止", state="disabled", command=stop_event.set)
+        stop_btn.pack(side=tk.LEFT, padx=6)
+
+    def transcode_window(self):
+        """编辑本库的转码策略、后台转码现有文件、清理过期原图"""
+        if not self._require_db():
+            return
+        policy = get_transcode_policy()
+        win = tk.Toplevel(self)
+        win.title("转码策略（本库）")
+        win.transient(self)
+        enabled_var = tk.BooleanVar(value=policy["enabled"])
+        on_import_var = tk.BooleanVar(value=policy["on_import"])
+        format_var = tk.StringVar(value=policy["format"])
+        quality_var = tk.IntVar(value=policy["quality"])
+        keep_var = tk.IntVar(value=int(policy["keep_days"]))
+        source_vars = {f: tk.BooleanVar(value=f in policy["sources"]) for f in ("BMP", "PNG", "TIFF")}
+
+        tk.Checkbutton(win, text="启用转码", variable=enabled_var).grid(row=0, column=0, columnspan=4, sticky="w", padx=10)
+        tk.Checkbutton(win, text="导入后立即转码", variable=on_import_var).grid(row=1, column=0, columnspan=4,
+                                                                          sticky="w", padx=10)
+        tk.Label(win, text="原格式：").grid(row=2, column=0, sticky="e", padx=(10, 2))
+        for i, (fmt, var) in enumerate(source_vars.items()):
+            tk.Checkbutton(win, text=fmt, variable=var).grid(row=2, column=1 + i, sticky="w")
+        tk.Label(win, text="目标格式：").grid(row=3, column=0, sticky="e", padx=(10, 2))
+        tk.Radiobutton(win, text="WebP", variable=format_var, value="webp").grid(row=3, column=1, sticky="w")
+        tk.Radiobutton(win, text="JPEG", variable=format_var, value="jpeg").grid(row=3, column=2, sticky="w")
+        tk.Label(win, text="质量：").grid(row=4, column=0, sticky="e", padx=(10, 2))
+        tk.Spinbox(win, from_=50, to=100, textvariable=quality_var, width=6).grid(row=4, column=1, sticky="w")
+        tk.Label(win, text="原图保留天数：").grid(row=5, column=0, sticky="e", padx=(10, 2))
+        tk.Spinbox(win, from_=0, to=3650, textvariable=keep_var, width=6).grid(row=5, column=1, sticky="w")
+
+        status_var = tk.StringVar()
+        tk.Label(win, textvariable=status_var, fg="#666", justify="left").grid(row=6, column=0, columnspan=4,
+                                                                               sticky="w", padx=10, pady=6)
+        bar = ttk.Progressbar(win, length=320, mode="determinate")
+        bar.grid(row=7, column=0, columnspan=4, padx=10)
+
+        def show_stats():
+            st = transcode_stats()
+            status_var.set(f"已转码 {st['files']} 张，节省 {format_bytes(st['saved_bytes'])}，"
+                           f"保留期内原图 {st['retained_originals']} 张")
+
+        def current_policy():
+            return {"enabled": enabled_var.get(), "on_import": on_import_var.get(), "format": format_var.get(),
+                    "quality": max(1, min(100, quality_var.get())), "keep_days": max(0, keep_var.get()),
+                    "sources": [f for f, v in source_vars.items() if v.get()]}
+
+        def save(then=None):
+            policy = current_policy()
+
+            def write():
+                with conn:
+                    set_transcode_policy(policy)
+
+            self._submit_write("保存转码策略", write, on_done=lambda _: (show_stats(), then and then()))
+
+        updates = queue.Queue()
+        stop_event = threading.Event()
+
+        def run(p):
+            try:
+                n, b, a = transcode_files(policy=p, progress=lambda d, t: updates.put(("progress", d, t)),
+                                          should_stop=stop_event.is_set)
+                updates.put(("done", n, b - a))
+            except Exception as e:
+                updates.put(("error", str(e), None))
+
+        def poll():
+            try:
+                while True:
+                    kind, a, b = updates.get_nowait()
+                    if kind == "progress":
+                        bar.config(maximum=max(b, 1), value=a)
+                    else:
+                        run_btn.config(state="normal")
+                        if kind == "error":
+                            messagebox.showerror("错误", f"转码失败：{a}", parent=win)
+                        else:
+                            messagebox.showinfo("完成", f"转码 {a} 张，节省 {format_bytes(b)}", parent=win)
+                        show_stats()
+                        return
+            except queue.Empty:
+                pass
+            if win.winfo_exists():
+                win.after(200, poll)
+            else:
+                stop_event.set()
 
+        def run_now():
+            run_btn.config(state="disabled")
 
-# ================================================================
-#                      GUI 主界面（左右布局 + 折叠查看面板）
-# ================================================================
-class ImageManager(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title("图片管理系统")
-        self.geometry("1000x720")
+            def start():
+                threading.Thread(target=run, args=(current_policy(),), daemon=True).start()
+                poll()
 
-        # 导入相关
-        self.selected_files = []
-        # 记忆每个维度被勾选的子标签集合（导入页） {parent: set(tag1, tag2)}
-        self.selected_tags_by_dim = {}
+            save(then=start)
 
-        # 查看页相关属性：提前初始化，避免在导入页面刷新时访问未创建的 UI 引发 AttributeError
-        self.view_accordion_frames = {}  # parent -> {'header_btn': btn, 'content': frame, 'open': bool}
-        self.view_tag_vars = {}  # parent -> {tag: BooleanVar}
-        self.view_selected_tags_by_dim = {}  # parent -> set(tag)
-        # UI 容器占位（实际在 setup_view_tab 创建）
-        self.left_inner = None
-        self.thumb_inner = None
+        def purge():
+            keep_days = max(0, keep_var.get())
 
-        # 预览设置
-        self.preview_size = (300, 300)
-        self.preview_photo = None  # 保持引用防止被 GC
-        self.preview_name_var = tk.StringVar(value="")
+            def done(result):
+                count, freed = result
+                messagebox.showinfo("完成", f"删除过期原图 {count} 张，释放 {format_bytes(freed)}",
+                                    parent=win if win.winfo_exists() else self)
+                show_stats()
 
-        # 使用 Notebook（导入 / 查看）
-        self.tab_control = ttk.Notebook(self)
-        self.tab_import = ttk.Frame(self.tab_control)
-        self.tab_view = ttk.Frame(self.tab_control)
-        self.tab_control.add(self.tab_import, text="导入图片")
-        self.tab_control.add(self.tab_view, text="查看图片")
-        self.tab_control.pack(expand=1, fill="both")
+            save(then=lambda: self._submit_write("清理过期原图",
+                                                 lambda: purge_transcoded_originals(keep_days=keep_days), done))
 
-        # 注意：先创建查看页的控件（保证 left_inner/thumb_inner 存在），然后再创建导入页
-        # 这样即便导入页 refresh 调用 view 刷新也不会出现未创建属性的访问
-        self.setup_view_tab()
-        self.setup_import_tab()
+        btns = tk.Frame(win)
+        btns.grid(row=8, column=0, columnspan=4, pady=8)
+        tk.Button(btns, text="保存", command=save).pack(side=tk.LEFT, padx=4)
+        run_btn = tk.Button(btns, text="立即转码现有文件", command=run_now)
+        run_btn.pack(side=tk.LEFT, padx=4)
+        tk.Button(btns, text="清理过期原图", command=purge).pack(side=tk.LEFT, padx=4)
+        show_stats()
+
+    # ---------- 完整性校验 ----------
+    def verify_integrity(self):
+        """后台校验本库全部图片（限速，可在任务面板取消，下次从断点继续）"""
+        if not self._require_db():
+            return
+
+        def run(job):
+            return verify_library(max_mb_per_sec=INTEGRITY_GUI_MB_PER_SEC, progress=job.progress,
+                                  should_stop=job.cancelled)
+
+        def done(counts):
+            problems = counts["missing"] + counts["corrupt"] + counts["changed"]
+            summary = (f"本次校验 {sum(counts[k] for k in ('ok', 'missing', 'corrupt', 'changed', 'too_large'))} 张："
+                       f"正常 {counts['ok']}，文件缺失 {counts['missing']}，无法解码 {counts['corrupt']}，"
+                       f"内容被改动 {counts['changed']}")
+            if counts["too_large"]:
+                summary += f"\n另有 {counts['too_large']} 张超过像素上限，未解码校验"
+            if problems and messagebox.askyesno("完整性校验", summary + "\n\n是否显示有问题的图片？"):
+                self.show_integrity_problems()
+            elif not problems:
+                messagebox.showinfo("完整性校验", summary)
+
+        self._submit_job("完整性校验", run, JOB_PRIORITY_LOW, kind="verify", on_done=done,
+                         on_cancel=lambda _: messagebox.showinfo("完整性校验", "校验已停止，下次校验从断点继续"))
+
+    def show_integrity_problems(self):
+        """把最近一次校验有问题的图片作为结果集显示（带红色标记）"""
+        if not self._require_db():
+            return
+        problems = get_integrity_problems()
+        if not problems:
+            messagebox.showinfo("提示", "没有校验出问题的图片（或尚未校验）")
+            return
+        self.last_search_spec = None
+        self._set_saved_page(None)
+        self.last_search_query = None
+        self.tab_control.select(self.tab_view)
+        self._show_search_rows([(file_id, resolve_path(file_path)) for file_id, file_path, _, _, _ in problems])
+
+    def repair_integrity(self):
+        """用增量备份中的副本替换有问题的图片"""
+        if not self._require_db():
+            return
+        backup_dir = filedialog.askdirectory(title="选择增量备份目录（含 manifest.json）")
+        if not backup_dir:
+            return
+
+        def done(result):
+            repaired, failed = result
+            lines = [f"已修复 {repaired} 张"] + [f"{reason}：{rel}" for rel, reason in failed[:15]]
+            if len(failed) > 15:
+                lines.append(f"……共 {len(failed)} 张未修复")
+            messagebox.showinfo("从备份修复", "\n".join(lines))
+            if self.search_results:
+                self._render_thumbnails()
+
+        self._submit_job("从备份修复", lambda job: repair_from_backup(backup_dir, progress=job.progress),
+                         kind="repair", on_done=done)
+
+    # ---------- 标签共现统计 ----------
+    def tag_stats_window(self):
+        """常用标签及常一起出现的标签组合；选中左侧标签时右侧只列出与它搭配的标签"""
+        if not self._require_db():
+            return
+        win = tk.Toplevel(self)
+        win.title("标签共现统计")
+        win.geometry("980x480")
+        win.transient(self)
+
+        panes = tk.Frame(win)
+        panes.pack(fill="both", expand=True, padx=8, pady=(8, 4))
+        tag_tree = ttk.Treeview(panes, columns=("tag", "count"), show="headings", height=16)
+        tag_tree.heading("tag", text="标签")
+        tag_tree.heading("count", text="图片数")
+        tag_tree.column("tag", width=200, anchor="w")
+        tag_tree.column("count", width=70, anchor="e")
+        tag_tree.pack(side=tk.LEFT, fill="y")
+
+        columns = ("a", "b", "cnt", "b_given_a", "a_given_b", "lift")
+        headings = ("标签 A", "标签 B", "共现数", "P(B|A)", "P(A|B)", "提升度")
+        pair_tree = ttk.Treeview(panes, columns=columns, show="headings", height=16)
+        for col, text in zip(columns, headings):
+            pair_tree.heading(col, text=text)
+            pair_tree.column(col, width=180 if col in ("a", "b") else 70, anchor="w" if col in ("a", "b") else "e")
+        pair_tree.pack(side=tk.LEFT, fill="both", expand=True, padx=(8, 0))
+
+        info_var = tk.StringVar(value="统计中…")
+        tk.Label(win, textvariable=info_var, anchor="w", fg="#555").pack(fill="x", padx=8)
+
+        def show(stats, tag_id):
+            if not win.winfo_exists():
+                return
+            if tag_id is None:
+                tag_tree.delete(*tag_tree.get_children())
+                for t, parent, name, count in stats["tags"]:
+                    tag_tree.insert("", tk.END, iid=str(t), values=(f"{parent}:{name}", count))
+            pair_tree.delete(*pair_tree.get_children())
+            for pa, na, pb, nb, cnt, b_given_a, a_given_b, lift in stats["pairs"]:
+                pair_tree.insert("", tk.END, values=(f"{pa}:{na}", f"{pb}:{nb}", cnt, f"{b_given_a:.0%}",
+                                                     f"{a_given_b:.0%}", f"{lift:.2f}"))
+            updated = get_setting(TAG_COOCCUR_READY_KEY)
+            info_var.set(f"共 {stats['files']} 张图片；统计建立于 {updated}，之后随标签变更自动更新" if updated
+                         else "尚未统计，点击「重新统计」")
+
+        def load(tag_id=None):
+            self._submit_job("读取标签共现统计", lambda job: tag_cooccurrence_stats(tag_id), JOB_PRIORITY_HIGH,
+                             kind="tag_stats", on_done=lambda stats: show(stats, tag_id))
+
+        def on_select(event):
+            selection = tag_tree.selection()
+            load(int(selection[0]) if selection else None)
+
+        def show_all():
+            if tag_tree.selection():
+                tag_tree.selection_set(())  # 触发 on_select 重新读取
+            else:
+                load()
+
+        def rebuild():
+            self._submit_job("统计标签共现", lambda job: rebuild_tag_cooccurrence(job.progress, job.cancelled),
+                             kind="tag_cooccur", on_done=lambda _: load())
+
+        tag_tree.bind("<<TreeviewSelect>>", on_select)
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(fill="x", padx=8, pady=8)
+        tk.Button(btn_frame, text="关闭", command=win.destroy, width=10).pack(side=tk.RIGHT, padx=4)
+        tk.Button(btn_frame, text="重新统计", command=rebuild, width=10).pack(side=tk.RIGHT, padx=4)
+        tk.Button(btn_frame, text="全部组合", command=show_all, width=10).pack(side=tk.RIGHT, padx=4)
+        load()
+
+    def backup_window(self):
+        dest = filedialog.askdirectory(title="选择备份目录（已有备份时只复制有变化的文件）")
+        if not dest:
+            return
+        win = tk.Toplevel(self)
+        win.title("增量备份")
+        win.transient(self)
+        status_var = tk.StringVar(value=f"备份到 {dest}")
+        tk.Label(win, textvariable=status_var, justify="left").pack(padx=12, pady=(10, 4))
+        bar = ttk.Progressbar(win, length=320, mode="determinate")
+        bar.pack(padx=12, pady=4)
+        stop_event = threading.Event()
+        stop_btn = tk.Button(win, text="停止（下次从断点继续）", command=stop_event.set)
+        stop_btn.pack(pady=(4, 10))
+        updates = queue.Queue()
+
+        def run():
+            try:
+                stats = backup_library(dest, progress=lambda d, t: updates.put(("progress", d, t)),
+                                       should_stop=stop_event.is_set)
+                problems = verify_backup(dest) if stats["completed"] else []
+                updates.put(("done", stats, problems))
+            except Exception as e:
+                updates.put(("error", str(e), None))
+
+        def poll():
+            try:
+                while True:
+                    kind, a, b = updates.get_nowait()
+                    if kind == "progress":
+                        bar.config(maximum=max(b, 1), value=a)
+                        status_var.set(f"复制文件 {a}/{b}")
+                        continue
+                    stop_btn.config(state="disabled")
+                    if kind == "error":
+                        status_var.set(f"备份失败：{a}")
+                    elif not a["completed"]:
+                        status_var.set(f"已停止，已复制 {a['copied']} 个文件")
+                    else:
+                        status_var.set(f"备份完成：复制 {a['copied']} 个（{format_bytes(a['bytes'])}），"
+                                       f"未变化 {a['skipped']} 个，源文件缺失 {a['missing']} 个\n"
+                                       + ("校验通过" if not b else f"校验发现 {len(b)} 个问题"))
+                    return
+            except queue.Empty:
+                pass
+            if win.winfo_exists():
+                win.after(200, poll)
+
+        threading.Thread(target=run, daemon=True).start()
+        poll()
+
+    def _refresh_library_choices(self):
+        """挂载/卸载后更新导入目标下拉框和「搜索全部图库」开关"""
+        choices = [lib.name for lib in self.libraries]
+        if len(self.libraries) > 1:
+            choices += [self.IMPORT_SHARD_DATE, self.IMPORT_SHARD_HASH]
+        self.import_target_combo["values"] = choices
+        if self.import_target_var.get() not in choices:
+            self.import_target_var.set(PRIMARY_LIBRARY_NAME)
+        self.federated_check.config(state="normal" if len(self.libraries) > 1 else "disabled")
+        if len(self.libraries) <= 1:
+            self.federated_var.set(False)
+
+    def _arm_profile(self, action, label):
+        perf.arm_profile(action)
+        messagebox.showinfo("提示", f"下一次【{label}】将被采样，\n结果保存到 {perf.profile_dir}")
+
+    def diagnostics_window(self):
+        win = tk.Toplevel(self)
+        win.title("性能统计")
+        win.geometry("720x420")
+        win.transient(self)
+
+        columns = ("op", "count", "total", "p50", "p95", "max")
+        headings = ("操作", "次数", "总耗时(ms)", "p50(ms)", "p95(ms)", "最大(ms)")
+        tree = ttk.Treeview(win, columns=columns, show="headings", height=14)
+        for col, text in zip(columns, headings):
+            tree.heading(col, text=text)
+            tree.column(col, width=220 if col == "op" else 90, anchor="w" if col == "op" else "e")
+        tree.pack(fill="both", expand=True, padx=8, pady=(8, 4))
+
+        info_var = tk.StringVar()
+        tk.Label(win, textvariable=info_var, anchor="w", justify="left", fg="#555", wraplength=700).pack(
+            fill="x", padx=8)
+
+        def refresh():
+            if not win.winfo_exists():
+                return
+            rows, counters = perf.snapshot()
+            tree.delete(*tree.get_children())
+            for r in rows:
+                tree.insert("", tk.END, values=(r["op"], r["count"], f"{r['total_s'] * 1000:.1f}",
+                                                f"{r['p50_s'] * 1000:.2f}", f"{r['p95_s'] * 1000:.2f}",
+                                                f"{r['max_s'] * 1000:.2f}"))
+            st = self.thumb_cache.stats()
+            lines = [
+                "状态：" + ("已启用" if perf.enabled else "未启用（菜单 诊断 → 启用性能统计，或设置 IMAGES_PROFILE=1）"),
+                "计数：" + ("，".join(f"{k}={v}" for k, v in sorted(counters.items())) or "无"),
+                f"缩略图缓存：命中 {st['hits']}，未命中 {st['misses']}，淘汰 {st['evictions']}",
+            ]
+            if perf.last_profile_path:
+                lines.append(f"最近一次 cProfile：{perf.last_profile_path}")
+            info_var.set("\n".join(lines))
+            win.after(1000, refresh)
+
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(fill="x", padx=8, pady=8)
+        tk.Button(btn_frame, text="清空", command=perf.reset, width=10).pack(side=tk.RIGHT, padx=4)
+        refresh()
+
+    # ---------- 后台任务 ----------
+    JOB_POLL_MS = 100
+
+    def _poll_jobs(self):
+        """定时在界面线程中执行已结束任务的回调，并刷新状态栏"""
+        try:
+            self.jobs.dispatch()
+        finally:
+            active = self.jobs.active()
+            running = [j for j in active if j.status == Job.RUNNING]
+            if active:
+                head = running[0] if running else active[0]
+                text = f"后台任务：{len(running)} 个运行中，{len(active) - len(running)} 个排队 — {head.name} {head.progress_text()}"
+            else:
+                text = ""
+            if self.job_status_var.get() != text:
+                self.job_status_var.set(text)
+            self.after(self.JOB_POLL_MS, self._poll_jobs)
+
+    def _submit_job(self, name, func, priority=JOB_PRIORITY_NORMAL, kind="task", on_done=None, on_cancel=None,
+                    action=None):
+        """提交任务；失败时统一弹窗报告。action 见 JobManager.submit"""
+        return self.jobs.submit(name, func, priority, kind, on_done=on_done, on_cancel=on_cancel,
+                                on_error=lambda e: messagebox.showerror("错误", f"{name}失败：{e}"), action=action)
+
+    def _submit_write(self, name, func, on_done=None):
+        """
+        界面上的写操作（新增/重命名标签、批量打标签、保存搜索等）交给工作线程执行：
+        导入等任务正在写库时只是排队，不会让界面线程卡在数据库锁上
+        """
+        return self._submit_job(name, lambda job: func(), JOB_PRIORITY_HIGH, kind="write", on_done=on_done)
+
+    def jobs_window(self):
+        """任务面板：查看后台任务的状态和进度，取消排队中或运行中的任务"""
+        if getattr(self, "_jobs_win", None) is not None and self._jobs_win.winfo_exists():
+            self._jobs_win.lift()
+            return
+        win = self._jobs_win = tk.Toplevel(self)
+        win.title("后台任务")
+        win.geometry("640x320")
+        win.transient(self)
+
+        columns = ("name", "status", "progress", "elapsed")
+        headings = ("任务", "状态", "进度", "耗时(s)")
+        tree = ttk.Treeview(win, columns=columns, show="headings", height=10)
+        for col, text in zip(columns, headings):
+            tree.heading(col, text=text)
+            tree.column(col, width=240 if col in ("name", "progress") else 70,
+                        anchor="e" if col == "elapsed" else "w")
+        tree.pack(fill="both", expand=True, padx=8, pady=(8, 4))
+
+        def refresh():
+            if not win.winfo_exists():
+                return
+            jobs = list(self.jobs.jobs.values())
+            existing = set(tree.get_children())
+            for job in jobs:
+                iid = str(job.id)
+                values = (job.name, job.status, job.progress_text(), f"{job.elapsed():.1f}")
+                if iid in existing:
+                    tree.item(iid, values=values)
+                else:
+                    tree.insert("", 0, iid=iid, values=values)
+            for iid in existing - {str(j.id) for j in jobs}:
+                tree.delete(iid)
+            win.after(300, refresh)
+
+        def cancel_selected():
+            for iid in tree.selection():
+                self.jobs.cancel(int(iid))
+
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(fill="x", padx=8, pady=8)
+        tk.Button(btn_frame, text="关闭", command=win.destroy, width=10).pack(side=tk.RIGHT, padx=4)
+        tk.Button(btn_frame, text="清除已结束", command=self.jobs.clear_finished, width=10).pack(side=tk.RIGHT, padx=4)
+        tk.Button(btn_frame, text="取消所选", command=cancel_selected, width=10).pack(side=tk.RIGHT, padx=4)
+        refresh()
 
     # ================================================================
     #                      导入图片 TAB（左右布局）
     # ================================================================
     def setup_import_tab(self):
+        # 底部：本次选择的全部图片（可取消勾选不导入的图片）
+        gallery_frame = tk.Frame(self.tab_import)
+        gallery_frame.pack(side=tk.BOTTOM, fill="x", padx=10, pady=(0, 10))
+        gallery_bar = tk.Frame(gallery_frame)
+        gallery_bar.pack(fill="x")
+        self.gallery_count_var = tk.StringVar(value="未选择图片")
+        tk.Label(gallery_bar, textvariable=self.gallery_count_var, anchor="w").pack(side=tk.LEFT)
+        self.import_gallery = ImportGallery(gallery_frame, on_preview=self._on_gallery_preview,
+                                            on_change=self._on_gallery_change)
+        tk.Button(gallery_bar, text="全不选", command=lambda: self.import_gallery.set_all(False)).pack(
+            side=tk.RIGHT, padx=4)
+        tk.Button(gallery_bar, text="全选", command=lambda: self.import_gallery.set_all(True)).pack(
+            side=tk.RIGHT, padx=4)
+        self.import_gallery.pack(fill="x", pady=(4, 0))
+
         container = tk.Frame(self.tab_import)
         container.pack(fill="both", expand=True, padx=10, pady=10)
 
@@ -193,6 +5106,10 @@ class ImageManager(tk.Tk):
         tk.Button(btn_tag_frame, text="编辑子标签", command=self.edit_tag_window).pack(side=tk.LEFT, padx=4)
         tk.Button(btn_tag_frame, text="删除子标签", command=self.delete_tag).pack(side=tk.LEFT, padx=4)
 
+        # 按已勾选标签的共现统计推荐常一起使用的标签，点击即加入勾选
+        self.suggest_frame = tk.Frame(left_frame)
+        self.suggest_frame.grid(row=12, column=0, columnspan=2, sticky="w", pady=(0, 4))
+
         left_frame.grid_columnconfigure(0, weight=0)
         left_frame.grid_columnconfigure(1, weight=1)
         left_frame.grid_rowconfigure(1, weight=1)
@@ -212,9 +5129,12 @@ class ImageManager(tk.Tk):
         op_frame.pack(pady=12)
         tk.Button(op_frame, text="选择图片", command=self.select_files).pack(side=tk.LEFT, padx=6)
         tk.Button(op_frame, text="保存图片和标签", command=self.save_files).pack(side=tk.LEFT, padx=6)
-
-        # refresh dims (safe: refresh_view_tags checks left_inner existence)
-        self.refresh_dimension_list()
+        tk.Label(op_frame, text="导入到：").pack(side=tk.LEFT, padx=(12, 2))
+        self.import_target_var = tk.StringVar(value=PRIMARY_LIBRARY_NAME)
+        self.import_target_combo = ttk.Combobox(op_frame, textvariable=self.import_target_var,
+                                                state="readonly", width=14)
+        self.import_target_combo.pack(side=tk.LEFT)
+        self._refresh_library_choices()
 
     # ------------------ 选择图片 ------------------
     def select_files(self):
@@ -223,10 +5143,18 @@ class ImageManager(tk.Tk):
             filetypes=[("图片文件", "*.jpg *.png *.jpeg *.bmp")])
         if files:
             self.selected_files = files
-            first = files[0]
-            self.show_preview(first)
-            self.preview_name_var.set(os.path.basename(first))
-            messagebox.showinfo("提示", f"已选择 {len(files)} 张图片（仅预览第一张）")
+            self.import_gallery.set_paths(files)
+            self._on_gallery_preview(files[0])
+
+    def _on_gallery_preview(self, path):
+        self.show_preview(path)
+        self.preview_name_var.set(os.path.basename(path))
+
+    def _on_gallery_change(self, included, total):
+        if total:
+            self.gallery_count_var.set(f"已选择 {total} 张图片，将导入 {included} 张（点击左上角勾选框可排除）")
+        else:
+            self.gallery_count_var.set("未选择图片")
 
     def show_preview(self, image_path):
         try:
@@ -244,18 +5172,22 @@ class ImageManager(tk.Tk):
             self.preview_name_var.set("")
 
     # ------------------ 刷新维度列表 ------------------
-    def refresh_dimension_list(self):
+    def refresh_dimension_list(self, tag_tree=None):
+        """tag_tree 为 get_tag_tree() 的结果，已有时（如启动时后台读取的）直接使用"""
+        if tag_tree is None:
+            tag_tree = get_tag_tree()
         self.dim_listbox.delete(0, tk.END)
-        for dim in get_all_dimensions():
+        for dim in tag_tree:
             self.dim_listbox.insert(tk.END, dim)
         self.update_tag_checkboxes(None)
         # refresh view tags (safe: function checks existence of left_inner)
-        self.refresh_view_tags()
+        self.refresh_view_tags(tag_tree)
 
     # ------------------ 更新子标签勾选状态（导入页） ------------------
     def update_tag_checkboxes(self, event):
         for w in self.tag_check_frame.winfo_children():
             w.destroy()
+        self._refresh_tag_suggestions()
 
         selection = self.dim_listbox.curselection()
         if not selection:
@@ -283,9 +5215,35 @@ class ImageManager(tk.Tk):
             self.selected_tags_by_dim[parent].add(tag)
         else:
             self.selected_tags_by_dim[parent].discard(tag)
+        self._refresh_tag_suggestions()
+
+    def _refresh_tag_suggestions(self):
+        """按导入页已勾选的标签刷新建议标签按钮"""
+        for w in self.suggest_frame.winfo_children():
+            w.destroy()
+        if not self.db_ready:
+            return
+        tag_ids = [t for t in (get_tag_id(parent, tag) for parent, tags in self.selected_tags_by_dim.items()
+                               for tag in tags) if t is not None]
+        suggestions = suggest_tags(tag_ids)
+        if not suggestions:
+            return
+        tk.Label(self.suggest_frame, text="常一起使用：", fg="#555").pack(side=tk.LEFT)
+        for _, parent, name, score in suggestions:
+            tk.Button(self.suggest_frame, text=f"+ {parent}:{name} ({score:.0%})", relief="groove",
+                      command=lambda p=parent, t=name: self._add_suggested_tag(p, t)).pack(side=tk.LEFT, padx=2)
+
+    def _add_suggested_tag(self, parent, tag):
+        self.selected_tags_by_dim.setdefault(parent, set()).add(tag)
+        selection = self.dim_listbox.curselection()
+        if selection and self.dim_listbox.get(selection[0]) == parent and tag in self.tag_vars:
+            self.tag_vars[tag].set(True)
+        self._refresh_tag_suggestions()
 
     # ------------------ 新增/编辑/删除 维度/子标签（导入页操作会刷新查看页标签） ------------------
     def add_dimension_window(self):
+        if not self._require_db():
+            return
         win = tk.Toplevel(self)
         win.title("新增大维度")
         win.geometry("400x180")
@@ -310,9 +5268,9 @@ class ImageManager(tk.Tk):
         def save_dim():
             val = dim_var.get().strip()
             if val:
-                insert_dimension(val)
-                self.refresh_dimension_list()
                 win.destroy()
+                self._submit_write(f"新增维度【{val}】", lambda: insert_dimension(val),
+                                   on_done=lambda _: self.refresh_dimension_list())
             else:
                 messagebox.showwarning("警告", "请输入维度名称", parent=win)
 
@@ -360,11 +5318,16 @@ class ImageManager(tk.Tk):
                 messagebox.showwarning("警告", "请输入维度名称", parent=win)
                 return
             if new_name != old_name:
-                cursor.execute("UPDATE t_tags SET parent=? WHERE parent=?", (new_name, old_name))
-                conn.commit()
-                if old_name in self.selected_tags_by_dim:
-                    self.selected_tags_by_dim[new_name] = self.selected_tags_by_dim.pop(old_name)
-                self.refresh_dimension_list()
+                if new_name in get_all_dimensions() and not messagebox.askyesno(
+                        "确认", f"维度【{new_name}】已存在，是否合并？\n同名子标签将合并为一个。", parent=win):
+                    return
+                def done(_):
+                    if old_name in self.selected_tags_by_dim:
+                        merged = self.selected_tags_by_dim.pop(old_name)
+                        self.selected_tags_by_dim.setdefault(new_name, set()).update(merged)
+                    self.refresh_dimension_list()
+
+                self._submit_write(f"重命名维度【{old_name}】", lambda: rename_dimension(old_name, new_name), done)
             win.destroy()
 
         btn_frame = tk.Frame(frame)
@@ -382,16 +5345,32 @@ class ImageManager(tk.Tk):
             return
         dim_name = self.dim_listbox.get(selection[0])
         if messagebox.askyesno("确认", f"确定删除维度【{dim_name}】及其所有子标签吗？"):
-            cursor.execute("SELECT tag_id FROM t_tags WHERE parent=?", (dim_name,))
-            tag_ids = [r[0] for r in cursor.fetchall()]
-            if tag_ids:
-                cursor.execute(f"DELETE FROM t_files_tags WHERE tag_id IN ({','.join(['?'] * len(tag_ids))})", tag_ids)
-            cursor.execute("DELETE FROM t_tags WHERE parent=?", (dim_name,))
-            conn.commit()
-            self.selected_tags_by_dim.pop(dim_name, None)
-            self.refresh_dimension_list()
+            def done(_):
+                self.selected_tags_by_dim.pop(dim_name, None)
+                self.refresh_dimension_list()
+
+            self._delete_tags_job(f"删除维度【{dim_name}】", get_dimension_tag_ids(dim_name), done,
+                                  action="delete_dimension")
+
+    def _delete_tags_job(self, name, tag_ids, on_done, action=None):
+        """
+        在后台任务中删除标签：关联较多时分批删除并报告进度，可在批次之间取消
+        （已删除的关联不恢复，标签保留）；完成或取消后都在界面线程调用 on_done 刷新面板
+        """
+        def run(job):
+            total = count_tag_links(tag_ids)
+            if total <= TAG_DELETE_CHUNK_THRESHOLD:
+                return delete_tags(tag_ids)
+            job.progress(0, total, "条关联")
+            return delete_tags(tag_ids, chunk_size=TAG_DELETE_CHUNK_SIZE,
+                               progress=lambda n: job.progress(n), should_stop=job.cancelled)
+
+        self._submit_job(name, run, JOB_PRIORITY_LOW, kind="delete_tags", on_done=on_done, on_cancel=on_done,
+                         action=action)
 
     def add_tag_window(self):
+        if not self._require_db():
+            return
         selection = self.dim_listbox.curselection()
         if not selection:
             messagebox.showwarning("警告", "请先选择大维度")
@@ -422,12 +5401,14 @@ class ImageManager(tk.Tk):
         def save_tag():
             name = tag_var.get().strip()
             if name:
-                insert_tag(parent, name)
-                self.selected_tags_by_dim.setdefault(parent, set())
-                self.selected_tags_by_dim[parent].discard(name)
-                self.update_tag_checkboxes(None)
-                self.refresh_view_tags()
+                def done(_):
+                    self.selected_tags_by_dim.setdefault(parent, set())
+                    self.selected_tags_by_dim[parent].discard(name)
+                    self.update_tag_checkboxes(None)
+                    self.refresh_view_tags()
+
                 win.destroy()
+                self._submit_write(f"新增子标签【{parent}:{name}】", lambda: insert_tag(parent, name), done)
             else:
                 messagebox.showwarning("警告", "请输入子标签名称", parent=win)
 
@@ -485,13 +5466,18 @@ class ImageManager(tk.Tk):
                 messagebox.showwarning("警告", "请输入新标签名称", parent=win)
                 return
             if new_name != old_name:
-                cursor.execute("UPDATE t_tags SET name=? WHERE parent=? AND name=?", (new_name, parent, old_name))
-                conn.commit()
-                if parent in self.selected_tags_by_dim and old_name in self.selected_tags_by_dim[parent]:
-                    self.selected_tags_by_dim[parent].remove(old_name)
-                    self.selected_tags_by_dim[parent].add(new_name)
-                self.update_tag_checkboxes(None)
-                self.refresh_view_tags()
+                if new_name in get_tags_by_dimension(parent) and not messagebox.askyesno(
+                        "确认", f"子标签【{new_name}】已存在，是否将【{old_name}】合并进去？", parent=win):
+                    return
+                def done(_):
+                    if parent in self.selected_tags_by_dim and old_name in self.selected_tags_by_dim[parent]:
+                        self.selected_tags_by_dim[parent].remove(old_name)
+                        self.selected_tags_by_dim[parent].add(new_name)
+                    self.update_tag_checkboxes(None)
+                    self.refresh_view_tags()
+
+                self._submit_write(f"重命名子标签【{parent}:{old_name}】",
+                                   lambda: rename_tag(get_tag_id(parent, old_name), new_name), done)
             win.destroy()
 
         btn_frame = tk.Frame(frame)
@@ -540,18 +5526,19 @@ class ImageManager(tk.Tk):
         def confirm_delete():
             tname = tag_var.get()
             if tname and messagebox.askyesno("确认删除", f"确定删除子标签【{tname}】吗？\n此操作无法撤销！", parent=win):
-                cursor.execute("SELECT tag_id FROM t_tags WHERE parent=? AND name=?", (parent, tname))
-                r = cursor.fetchone()
-                if r:
-                    tag_id = r[0]
-                    cursor.execute("DELETE FROM t_files_tags WHERE tag_id=?", (tag_id,))
-                    cursor.execute("DELETE FROM t_tags WHERE tag_id=?", (tag_id,))
-                    conn.commit()
+                tag_id = get_tag_id(parent, tname)
+                win.destroy()
+
+                def done(_):
                     if parent in self.selected_tags_by_dim:
                         self.selected_tags_by_dim[parent].discard(tname)
-                self.update_tag_checkboxes(None)
-                self.refresh_view_tags()
-                win.destroy()
+                    self.update_tag_checkboxes(None)
+                    self.refresh_view_tags()
+
+                if tag_id is None:
+                    done(None)
+                else:
+                    self._delete_tags_job(f"删除子标签【{parent}:{tname}】", [tag_id], done)
 
         btn_frame = tk.Frame(frame)
         btn_frame.pack(pady=20)
@@ -561,9 +5548,15 @@ class ImageManager(tk.Tk):
 
     # ------------------ 保存图片 + 标签（导入页，保存相对路径） ------------------
     def save_files(self):
+        if not self._require_db():
+            return
         if not self.selected_files:
             messagebox.showwarning("警告", "请先选择图片")
             return
+        files = self.import_gallery.included_paths()
+        if not files:
+            messagebox.showwarning("警告", "所有图片都已取消勾选")
+            return
 
         chosen_tags = []
         for parent, tags in self.selected_tags_by_dim.items():
@@ -573,32 +5566,52 @@ class ImageManager(tk.Tk):
             messagebox.showwarning("警告", "请至少选择一个维度或子标签")
             return
 
-        for f in self.selected_files:
-            file_name = os.path.basename(f)
-            timestamp = datetime.datetime.now().timestamp()
-            new_filename = f"{timestamp}_{file_name}"
-            dest_abs = os.path.join(FILES_DIR, new_filename)
-            shutil.copy(f, dest_abs)
-
-            rel_path = os.path.relpath(dest_abs, BASE_DIR)
-            cursor.execute("INSERT INTO t_files (file_name, file_path) VALUES (?, ?)", (file_name, rel_path))
-            file_id = cursor.lastrowid
+        target = self.import_target_var.get()
+        libraries = list(self.libraries)
+        selection = self.selected_files
 
-            for parent, tag in chosen_tags:
-                cursor.execute("SELECT tag_id FROM t_tags WHERE parent=? AND name=?", (parent, tag))
-                r = cursor.fetchone()
-                if r:
-                    tag_id = r[0]
-                    cursor.execute("INSERT INTO t_files_tags (file_id, tag_id) VALUES (?, ?)", (file_id, tag_id))
+        def run(job):
+            job.progress(0, len(files), "张")
+            if target in (self.IMPORT_SHARD_DATE, self.IMPORT_SHARD_HASH):
+                by = "date" if target == self.IMPORT_SHARD_DATE else "hash"
+                imported = import_files_sharded(files, chosen_tags, libraries, by, job.progress, job.cancelled)
+                detail = "\n".join(f"{name}：{len(ids)} 张" for name, ids in imported.items())
+            else:
+                library = next((lib for lib in libraries if lib.name == target), libraries[0])
+                imported = {library.name: library.import_files(files, chosen_tags, job.progress, job.cancelled)}
+                detail = ""
+            # 按各图库的转码策略在导入后立即转码（取消后不再转码，已导入的图片保持原样）
+            before = after = 0
+            for library in libraries:
+                if imported.get(library.name) and not job.cancelled():
+                    job.progress(job.done, message="张，转码中")
+                    _, b, a = transcode_files(None if library.is_primary else library,
+                                              file_ids=imported[library.name], on_import=True)
+                    before, after = before + b, after + a
+            if before:
+                detail += f"\n转码节省 {format_bytes(before - after)}"
+            return sum(len(ids) for ids in imported.values()), detail
+
+        def finish(result, cancelled=False):
+            count, detail = result or (0, "")
+            if cancelled:
+                messagebox.showinfo("已取消", f"导入已取消，已保存 {count}/{len(files)} 张图片" +
+                                    (f"\n{detail.strip()}" if detail else ""))
+            else:
+                messagebox.showinfo("成功", f"{count} 张图片和标签保存成功！" + (f"\n{detail.strip()}" if detail else ""))
+            # 导入期间用户已重新选择了图片时保留新的选择
+            if self.selected_files is not selection:
+                return
+            self.selected_files = []
+            self.import_gallery.clear()
+            self.selected_tags_by_dim = {}
+            self.update_tag_checkboxes(None)
+            self.preview_label.config(image="", text="未选择图片")
+            self.preview_photo = None
+            self.preview_name_var.set("")
 
-        conn.commit()
-        messagebox.showinfo("成功", "图片和标签保存成功！")
-        self.selected_files = []
-        self.selected_tags_by_dim = {}
-        self.update_tag_checkboxes(None)
-        self.preview_label.config(image="", text="未选择图片")
-        self.preview_photo = None
-        self.preview_name_var.set("")
+        self._submit_job(f"导入 {len(files)} 张图片", run, kind="import", on_done=finish,
+                         on_cancel=lambda result: finish(result, cancelled=True), action="save_files")
 
     # ================================================================
     #                      查看图片 TAB（折叠维度面板 + AND/OR）
@@ -614,9 +5627,46 @@ class ImageManager(tk.Tk):
         tk.Radiobutton(top_frame, text="AND（全部）", variable=self.search_mode_var, value="AND").pack(side=tk.LEFT,
                                                                                                      padx=4)
 
+        self.federated_var = tk.BooleanVar(value=False)
+        self.federated_check = tk.Checkbutton(top_frame, text="搜索全部图库", variable=self.federated_var,
+                                              state="normal" if len(self.libraries) > 1 else "disabled")
+        self.federated_check.pack(side=tk.LEFT, padx=(12, 4))
+
         tk.Button(top_frame, text="搜索", command=self.search_images_by_selected).pack(side=tk.RIGHT, padx=6)
         tk.Button(top_frame, text="清除选择", command=self.clear_view_selections).pack(side=tk.RIGHT, padx=6)
 
+        # 关键词：匹配文件名、维度/子标签名和图片元数据，可与左侧勾选的标签组合
+        self.search_text_var = tk.StringVar()
+        search_entry = tk.Entry(top_frame, textvariable=self.search_text_var, width=28)
+        search_entry.pack(side=tk.RIGHT, padx=4)
+        search_entry.bind("<Return>", lambda e: self.search_images_by_selected())
+        tk.Label(top_frame, text="关键词：").pack(side=tk.RIGHT)
+
+        # 保存的搜索：一键重跑常用标签组合，物化的结果按页读取
+        saved_frame = tk.Frame(self.tab_view)
+        saved_frame.pack(fill="x", padx=6)
+        tk.Label(saved_frame, text="保存的搜索：").pack(side=tk.LEFT, padx=(2, 6))
+        self.saved_search_var = tk.StringVar()
+        self.saved_search_combo = ttk.Combobox(saved_frame, textvariable=self.saved_search_var,
+                                               state="readonly", width=24)
+        self.saved_search_combo.pack(side=tk.LEFT, padx=4)
+        self.saved_search_combo.bind("<<ComboboxSelected>>", lambda e: self.open_saved_search())
+        tk.Button(saved_frame, text="保存当前搜索", command=self.save_current_search).pack(side=tk.LEFT, padx=4)
+        tk.Button(saved_frame, text="删除", command=self.delete_current_saved_search).pack(side=tk.LEFT, padx=4)
+        tk.Button(saved_frame, text="按导入时间浏览…", command=self.timeline_window).pack(side=tk.LEFT, padx=(12, 4))
+        self.page_next_btn = tk.Button(saved_frame, text="下一页", state="disabled",
+                                       command=lambda: self._step_saved_page(1))
+        self.page_next_btn.pack(side=tk.RIGHT, padx=4)
+        self.page_label_var = tk.StringVar(value="")
+        tk.Label(saved_frame, textvariable=self.page_label_var).pack(side=tk.RIGHT, padx=4)
+        self.page_prev_btn = tk.Button(saved_frame, text="上一页", state="disabled",
+                                       command=lambda: self._step_saved_page(-1))
+        self.page_prev_btn.pack(side=tk.RIGHT, padx=4)
+        self.saved_search_ids = {}
+        self.last_search_spec = None  # 最近一次标签搜索的 (tag_ids, mode)，供「保存当前搜索」使用
+        # 当前分页状态：{"search_id" 或 "timeline": (起, 止, 名称), "starts": 每页起始 after_file_id, "index", "more"}
+        self.saved_page = None
+
         # main view area: left accordion tags, right thumbnails
         main = tk.Frame(self.tab_view)
         main.pack(fill="both", expand=True, padx=6, pady=6)
@@ -670,10 +5720,15 @@ class ImageManager(tk.Tk):
         # download button below
         bottom_frame = tk.Frame(self.tab_view)
         bottom_frame.pack(fill="x", pady=(4, 8))
-        tk.Button(bottom_frame, text="下载选中结果为ZIP", command=self.download_zip).pack(side=tk.RIGHT, padx=10)
+        tk.Button(bottom_frame, text="浏览器下载（流式）", command=self.stream_download).pack(side=tk.RIGHT, padx=(4, 10))
+        tk.Button(bottom_frame, text="下载选中结果为ZIP", command=self.download_zip).pack(side=tk.RIGHT, padx=4)
+        tk.Button(bottom_frame, text="撤销批量标签操作", command=self.undo_bulk_tag_op).pack(side=tk.RIGHT, padx=4)
+        tk.Button(bottom_frame, text="批量标签操作", command=self.bulk_tag_window).pack(side=tk.RIGHT, padx=4)
+        self.cache_stats_var = tk.StringVar(value="")
+        tk.Label(bottom_frame, textvariable=self.cache_stats_var, fg="#666").pack(side=tk.LEFT, padx=10)
 
-        # initial build of accordion
-        self.refresh_view_tags()
+        # 标签面板在数据库打开后由 _on_database_ready 填充
+        tk.Label(self.left_inner, text="正在加载标签…").pack(anchor="w", padx=6, pady=6)
 
         # search results list (absolute paths)
         self.search_results = []
@@ -705,22 +5760,31 @@ class ImageManager(tk.Tk):
         canvas.bind("<Enter>", bind_wheel)
         canvas.bind("<Leave>", unbind_wheel)
 
-    def refresh_view_tags(self):
+    @profiled_action("refresh_view_tags")
+    def refresh_view_tags(self, tag_tree=None):
         """
         (Re)build the accordion left panel based on current t_tags.
         Keeps previous checked state when possible.
 
+        只创建各维度的标题按钮，子标签勾选框在第一次展开该维度时才创建（维度和标签很多时启动和刷新更快），
+        勾选状态以 view_selected_tags_by_dim 为准。
+
         This function is safe to call even before the view UI is constructed:
         - if left_inner is None (view not initialized), just return early.
         """
         # If view panel not yet created, skip
         if self.left_inner is None:
             return
+        if tag_tree is None:
+            tag_tree = get_tag_tree()
 
-        # save previous selected states
-        prev = {}
-        for parent, tagmap in self.view_tag_vars.items():
-            prev[parent] = {t: v.get() for t, v in tagmap.items()}
+        # 保留仍然存在的已选标签
+        self.view_selected_tags_by_dim = {
+            parent: set(t for t in tags if t in tag_tree.get(parent, ()))
+            for parent, tags in self.view_selected_tags_by_dim.items()
+            if parent in tag_tree
+        }
+        self.view_tag_tree = tag_tree
 
         # clear existing widgets
         for w in self.left_inner.winfo_children():
@@ -728,12 +5792,11 @@ class ImageManager(tk.Tk):
         self.view_accordion_frames.clear()
         self.view_tag_vars.clear()
 
-        dims = get_all_dimensions()
-        if not dims:
+        if not tag_tree:
             tk.Label(self.left_inner, text="暂无维度/标签，先到导入页新增标签").pack(anchor="w", padx=6, pady=6)
             return
 
-        for parent in dims:
+        for parent in tag_tree:
             # 创建一个容器，包含 header 和 content，确保它们紧邻
             container = tk.Frame(self.left_inner)
             container.pack(fill="x", pady=(2, 2))
@@ -741,71 +5804,67 @@ class ImageManager(tk.Tk):
             # header (acts as toggle)
             header_frame = tk.Frame(container)
             header_frame.pack(fill="x")
-            btn = tk.Button(header_frame, text=f"▸  {parent}", anchor="w", relief="flat", bg="#f0f0f0")
+            btn = tk.Button(header_frame, text=f"▸  {parent}", anchor="w", relief="flat", bg="#f0f0f0",
+                            command=lambda p=parent: self._toggle_view_dimension(p))
             btn.pack(fill="x")
 
-            # content frame with checkboxes (initially hidden)
+            # content frame with checkboxes (initially hidden, built on first expand)
             content = tk.Frame(container, relief="groove", bd=1, bg="#fafafa")
-            # 不在这里 pack，等待 toggle 时再 pack
-
-            # build tag checkboxes
-            tags = get_tags_by_dimension(parent)
-            tag_vars = {}
-            for idx, tag in enumerate(tags):
-                var = tk.BooleanVar(value=prev.get(parent, {}).get(tag, False))
-                cb = tk.Checkbutton(content, text=tag, variable=var, bg="#fafafa",
-                                    command=lambda p=parent, t=tag, v=var: self._on_view_tag_toggle(p, t, v))
-                cb.grid(row=idx, column=0, sticky="w", padx=6, pady=2)
-                tag_vars[tag] = var
 
             self.view_accordion_frames[parent] = {
                 'header_btn': btn,
                 'content': content,
                 'container': container,
-                'open': False
+                'open': False,
+                'built': False,
             }
-            self.view_tag_vars[parent] = tag_vars
-
-            # toggle action - 手风琴效果（互斥展开）
-            def make_toggle(p=parent):
-                def toggle():
-                    item = self.view_accordion_frames[p]
-
-                    # 如果当前面板是打开的，则关闭它
-                    if item['open']:
-                        item['content'].pack_forget()
-                        item['header_btn'].config(text=f"▸  {p}")
-                        item['open'] = False
-                    else:
-                        # 先关闭所有其他面板（手风琴互斥效果）
-                        for other_parent, other_item in self.view_accordion_frames.items():
-                            if other_item['open']:
-                                other_item['content'].pack_forget()
-                                other_item['header_btn'].config(text=f"▸  {other_parent}")
-                                other_item['open'] = False
-
-                        # 打开当前面板（紧跟在 header 下方）
-                        item['content'].pack(fill="x", padx=8, pady=(2, 4))
-                        item['header_btn'].config(text=f"▾  {p}")
-                        item['open'] = True
-
-                    # 更新滚动区域（展开/折叠后高度变化）
-                    self.left_inner.update_idletasks()
-                    self.left_canvas.configure(scrollregion=self.left_canvas.bbox("all"))
-
-                return toggle
-
-            btn.config(command=make_toggle(parent))
-
-        # rebuild view_selected_tags_by_dim
-        self.view_selected_tags_by_dim = {}
-        for parent, tagmap in self.view_tag_vars.items():
-            self.view_selected_tags_by_dim[parent] = set(t for t, v in tagmap.items() if v.get())
 
         # 更新左侧滚动区域
         self.left_inner.update_idletasks()
         self.left_canvas.configure(scrollregion=self.left_canvas.bbox("all"))
 
+    def _build_view_dimension(self, parent):
+        """第一次展开维度时创建子标签勾选框"""
+        item = self.view_accordion_frames[parent]
+        selected = self.view_selected_tags_by_dim.get(parent, set())
+        tag_vars = {}
+        for idx, tag in enumerate(self.view_tag_tree.get(parent, [])):
+            var = tk.BooleanVar(value=tag in selected)
+            cb = tk.Checkbutton(item['content'], text=tag, variable=var, bg="#fafafa",
+                                command=lambda p=parent, t=tag, v=var: self._on_view_tag_toggle(p, t, v))
+            cb.grid(row=idx, column=0, sticky="w", padx=6, pady=2)
+            tag_vars[tag] = var
+        self.view_tag_vars[parent] = tag_vars
+        item['built'] = True
+
+    def _toggle_view_dimension(self, p):
+        """手风琴效果（互斥展开）"""
+        item = self.view_accordion_frames[p]
+
+        # 如果当前面板是打开的，则关闭它
+        if item['open']:
+            item['content'].pack_forget()
+            item['header_btn'].config(text=f"▸  {p}")
+            item['open'] = False
+        else:
+            # 先关闭所有其他面板（手风琴互斥效果）
+            for other_parent, other_item in self.view_accordion_frames.items():
+                if other_item['open']:
+                    other_item['content'].pack_forget()
+                    other_item['header_btn'].config(text=f"▸  {other_parent}")
+                    other_item['open'] = False
+
+            if not item['built']:
+                self._build_view_dimension(p)
+            # 打开当前面板（紧跟在 header 下方）
+            item['content'].pack(fill="x", padx=8, pady=(2, 4))
+            item['header_btn'].config(text=f"▾  {p}")
+            item['open'] = True
+
+        # 更新滚动区域（展开/折叠后高度变化）
+        self.left_inner.update_idletasks()
+        self.left_canvas.configure(scrollregion=self.left_canvas.bbox("all"))
+
     def _on_view_tag_toggle(self, parent, tag, var):
         if var.get():
             self.view_selected_tags_by_dim.setdefault(parent, set()).add(tag)
@@ -818,73 +5877,122 @@ class ImageManager(tk.Tk):
             for tag, var in tagmap.items():
                 var.set(False)
         self.view_selected_tags_by_dim = {}
+        self.search_text_var.set("")
+        self.last_search_spec = None
+        self._set_saved_page(None)
         # clear thumbnails
         if self.thumb_inner:
-            for w in self.thumb_inner.winfo_children():
-                w.destroy()
+            self._clear_thumbnails()
         self.search_results = []
+        self.search_file_ids = {}
+        self.search_foreign = {}
+        self.last_search_query = None
 
     # ================================================================
     # 更新 search_images_by_selected，让缩略图可选中并动态布局
     # ================================================================
     def search_images_by_selected(self):
-        # collect selected tags across all dims
+        if not self._require_db():
+            return
+        # collect selected tags across all dims（未展开过的维度没有勾选框，以记录的勾选状态为准）
         selected = []
-        for parent, tagvars in self.view_tag_vars.items():
-            for tag, var in tagvars.items():
-                if var.get():
-                    selected.append((parent, tag))
+        for parent, tags in self.view_selected_tags_by_dim.items():
+            for tag in sorted(tags):
+                selected.append((parent, tag))
 
-        if not selected:
-            messagebox.showwarning("提示", "请在左侧选择至少一个子标签再搜索")
+        text = self.search_text_var.get().strip()
+        if not selected and not text:
+            messagebox.showwarning("提示", "请输入关键词，或在左侧选择至少一个子标签再搜索")
             return
 
         # map selected tags to tag_ids
         tag_ids = []
         for parent, tag in selected:
-            cursor.execute("SELECT tag_id FROM t_tags WHERE parent=? AND name=?", (parent, tag))
-            r = cursor.fetchone()
-            if r:
-                tag_ids.append(r[0])
+            tag_id = get_tag_id(parent, tag)
+            if tag_id is not None:
+                tag_ids.append(tag_id)
 
-        if not tag_ids:
+        if selected and not tag_ids:
             messagebox.showinfo("提示", "所选标签未在数据库中找到（已被删除？）")
             return
 
         mode = self.search_mode_var.get()
-        placeholder = ",".join("?" * len(tag_ids))
-        if mode == "OR":
-            sql = f"""
-                SELECT DISTINCT f.file_id, f.file_path
-                FROM t_files f
-                JOIN t_files_tags ft ON f.file_id = ft.file_id
-                WHERE ft.tag_id IN ({placeholder})
-            """
-        else:
-            sql = f"""
-                SELECT f.file_id, f.file_path
-                FROM t_files f
-                JOIN t_files_tags ft ON f.file_id = ft.file_id
-                WHERE ft.tag_id IN ({placeholder})
-                GROUP BY f.file_id
-                HAVING COUNT(DISTINCT ft.tag_id) = {len(tag_ids)}
-            """
-        cursor.execute(sql, tag_ids)
-        rows = cursor.fetchall()
+        if self.federated_var.get() and len(self.libraries) > 1:
+            self._federated_search(selected, mode, text)
+            return
+
+        def run(job):
+            if text:
+                return search_files_by_text(text, tag_ids, mode)
+            return search_files_by_tags(tag_ids, mode), build_tag_search_sql(tag_ids, mode)
+
+        def done(result):
+            rows, query = result
+            self.last_search_spec = (tag_ids, mode, text)
+            self._set_saved_page(None)
+            # 记住本次查询，批量标签操作可直接作用于整个结果集而无需加载
+            self.last_search_query = query
+            self._show_search_rows(rows)
+
+        self._submit_search_job(run, done, action="search")
+
+    def _submit_search_job(self, run, on_done, action=None):
+        """搜索在后台执行；新的搜索会取消尚未完成的旧搜索，旧搜索的结果不再显示"""
+        if self._search_job is not None:
+            self._search_job.cancel()
+
+        def done(result):
+            # 回调总在界面线程中、submit 返回之后执行，此时 self._search_job 已指向最新的搜索
+            if job is self._search_job:
+                self._search_job = None
+                on_done(result)
+
+        job = self._search_job = self._submit_job("搜索", run, JOB_PRIORITY_HIGH, kind="search", on_done=done,
+                                                  action=action)
 
+    def _federated_search(self, selected, mode, text):
+        """
+        在所有挂载的图库中并行搜索（标签按名称匹配，关键词匹配文件名）。
+        其他图库的结果只用于浏览和导出，批量标签操作只作用于其中属于本库的图片。
+        """
+        libraries = list(self.libraries)
+        self._submit_search_job(lambda job: federated_search(libraries, list(selected), mode, text),
+                                self._show_federated_results, action="search")
+
+    def _show_federated_results(self, result):
+        results, errors = result
+        if errors:
+            messagebox.showwarning("提示", "部分图库搜索失败：\n" +
+                                   "\n".join(f"{name}：{err}" for name, err in errors.items()))
+        self.last_search_spec = None
+        self._set_saved_page(None)
+        self.last_search_query = None
+        rows = [(file_id, abs_p) for _, file_id, abs_p in results]
+        foreign = {abs_p: (lib, file_id) for lib, file_id, abs_p in results if not lib.is_primary}
+        self._show_search_rows(rows, foreign)
+
+    def _show_search_rows(self, rows, foreign=None):
+        """
+        把 [(file_id, 绝对路径)] 显示为缩略图结果。
+        foreign 为联合搜索中来自其他图库的图片 {abs_path: (Library, file_id)}，
+        这些图片不进入 search_file_ids（file_id 属于各自的库），缩略图缓存按路径区分。
+        """
+        self.search_foreign = foreign or {}
         # resolve and filter existing paths
-        abs_paths = [resolve_path(r[1]) for r in rows if r[1] and os.path.exists(resolve_path(r[1]))]
+        file_ids = {abs_p: file_id for file_id, abs_p in rows if abs_p not in self.search_foreign}
+        abs_paths = list(OrderedDict.fromkeys(abs_p for _, abs_p in rows))
 
         if not abs_paths:
             # clear previous thumbnails
-            for w in self.thumb_inner.winfo_children():
-                w.destroy()
+            self._clear_thumbnails()
             messagebox.showinfo("提示", "未找到匹配且存在的图片文件")
             self.search_results = []
+            self.search_file_ids = {}
             self.thumb_selected_vars = {}
             return
 
         self.search_results = abs_paths
+        self.search_file_ids = file_ids
         self.thumb_selected_vars = {}  # 保存每个缩略图选中状态
 
         # 强制更新画布尺寸，确保获取到正确的宽度
@@ -898,19 +6006,286 @@ class ImageManager(tk.Tk):
             self.thumb_canvas.bind("<Configure>", lambda e: self._on_canvas_resize())
             self._resize_bound = True
 
-    def _render_thumbnails(self):
-        """根据当前容器宽度渲染缩略图网格"""
-        # clear previous thumbnails
+    # ---------- 保存的搜索 ----------
+    def _refresh_saved_search_list(self):
+        self.saved_search_ids = {}
+        for search_id, name, mode, materialized in list_saved_searches():
+            label = f"{name}（{mode}{'，已物化' if materialized else ''}）"
+            self.saved_search_ids[label] = search_id
+        self.saved_search_combo["values"] = list(self.saved_search_ids)
+
+    def save_current_search(self):
+        if not self._require_db():
+            return
+        if not self.last_search_spec or not self.last_search_spec[0]:
+            messagebox.showwarning("提示", "请先按标签搜索一次，再保存")
+            return
+        tag_ids, mode, text = self.last_search_spec
+        if text and not messagebox.askyesno("提示", "保存的搜索只记录标签条件，关键词不会保存。是否继续？"):
+            return
+        name = simpledialog.askstring("保存搜索", "名称：", parent=self)
+        if not name or not name.strip():
+            return
+        materialize = messagebox.askyesno(
+            "保存搜索", "是否物化结果集？\n物化后打开只读取一页结果，导入和标签修改时自动增量更新。")
+
+        def done(search_id):
+            self._refresh_saved_search_list()
+            for label, sid in self.saved_search_ids.items():
+                if sid == search_id:
+                    self.saved_search_var.set(label)
+
+        self._submit_write("保存搜索", lambda: save_search(name.strip(), tag_ids, mode, materialize), done)
+
+    def delete_current_saved_search(self):
+        search_id = self.saved_search_ids.get(self.saved_search_var.get())
+        if search_id is None:
+            return
+        if not messagebox.askyesno("确认", f"删除保存的搜索「{self.saved_search_var.get()}」？"):
+            return
+
+        def done(_):
+            self.saved_search_var.set("")
+            self._refresh_saved_search_list()
+            if self.saved_page and self.saved_page.get("search_id") == search_id:
+                self._set_saved_page(None)
+
+        self._submit_write("删除保存的搜索", lambda: delete_saved_search(search_id), done)
+
+    @profiled_action("saved_search")
+    def open_saved_search(self):
+        search_id = self.saved_search_ids.get(self.saved_search_var.get())
+        if search_id is None:
+            return
+        self.last_search_query = saved_search_query(search_id)
+        self.last_search_spec = None
+        self._set_saved_page({"search_id": search_id, "starts": [0], "index": 0, "more": False})
+        self._load_saved_page()
+
+    # ---------- 时间线 ----------
+    def timeline_window(self):
+        """按导入日期 / 小时列出图片数，点击某一天或某个小时在浏览页按页显示该时间段的图片"""
+        if not self._require_db():
+            return
+        if getattr(self, "_timeline_win", None) is not None and self._timeline_win.winfo_exists():
+            self._timeline_win.lift()
+            return
+        win = self._timeline_win = tk.Toplevel(self)
+        win.title("按导入时间浏览")
+        win.geometry("460x520")
+        win.transient(self)
+
+        tree = ttk.Treeview(win, columns=("count", "bar"), height=20)
+        tree.heading("#0", text="导入时间")
+        tree.heading("count", text="图片数")
+        tree.heading("bar", text="")
+        tree.column("#0", width=140, anchor="w")
+        tree.column("count", width=70, anchor="e")
+        tree.column("bar", width=200, anchor="w")
+        vsb = tk.Scrollbar(win, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set)
+        vsb.pack(side=tk.RIGHT, fill="y", pady=8)
+        tree.pack(fill="both", expand=True, padx=(8, 0), pady=8)
+
+        buckets = {}  # iid -> (起, 止, 名称)
+        hours_of = {}  # 日期节点 iid -> 该日的小时桶，第一次展开时才插入
+        peak = {"day": 1, "hour": 1}
+
+        def bar(count, scale):
+            return "█" * max(1, round(20 * count / scale))
+
+        def show(timeline):
+            if not win.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            buckets.clear()
+            hours_of.clear()
+            if not timeline:
+                tree.insert("", tk.END, text="（暂无图片）")
+                return
+            peak["day"] = max(count for _, _, _, count, _ in timeline)
+            peak["hour"] = max(h[3] for *_, hours in timeline for h in hours)
+            for date, start, end, count, hours in timeline:
+                iid = tree.insert("", tk.END, text=date, values=(count, bar(count, peak["day"])))
+                buckets[iid] = (start, end, date)
+                hours_of[iid] = hours
+                tree.insert(iid, tk.END)  # 占位，使节点可展开
+
+        def on_open(event):
+            iid = tree.focus()
+            hours = hours_of.pop(iid, None)
+            if hours is None:
+                return
+            tree.delete(*tree.get_children(iid))
+            date = buckets[iid][2]
+            for label, start, end, count in hours:
+                child = tree.insert(iid, tk.END, text=label, values=(count, bar(count, peak["hour"])))
+                buckets[child] = (start, end, f"{date} {label}")
+
+        def on_select(event):
+            selection = tree.selection()
+            if selection and selection[0] in buckets:
+                self._open_timeline_bucket(*buckets[selection[0]])
+
+        def load():
+            self._submit_job("读取时间线", lambda job: get_timeline(), JOB_PRIORITY_HIGH, kind="timeline",
+                             on_done=show)
+
+        tree.bind("<<TreeviewOpen>>", on_open)
+        tree.bind("<<TreeviewSelect>>", on_select)
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(fill="x", padx=8, pady=(0, 8))
+        tk.Button(btn_frame, text="关闭", command=win.destroy, width=10).pack(side=tk.RIGHT, padx=4)
+        tk.Button(btn_frame, text="刷新", command=load, width=10).pack(side=tk.RIGHT, padx=4)
+        load()
+
+    @profiled_action("timeline")
+    def _open_timeline_bucket(self, start, end, label):
+        """在浏览页按页显示 [start, end) 内导入的图片，批量标签操作作用于整个时间段"""
+        self.last_search_query = timeline_query(start, end)
+        self.last_search_spec = None
+        self.tab_control.select(self.tab_view)
+        self._set_saved_page({"timeline": (start, end, label), "starts": [0], "index": 0, "more": False})
+        self._load_saved_page()
+
+    def _set_saved_page(self, state):
+        self.saved_page = state
+        if state is None:
+            self.page_label_var.set("")
+            self.page_prev_btn.config(state="disabled")
+            self.page_next_btn.config(state="disabled")
+
+    def _step_saved_page(self, delta):
+        state = self.saved_page
+        if not state:
+            return
+        index = state["index"] + delta
+        if index < 0 or (delta > 0 and not state["more"]):
+            return
+        state["index"] = index
+        self._load_saved_page()
+
+    def _load_saved_page(self):
+        """按键集分页读取当前页（多取一条判断是否还有下一页）"""
+        state = self.saved_page
+        after = state["starts"][state["index"]]
+        if "timeline" in state:
+            start, end, label = state["timeline"]
+            rows = get_timeline_page(start, end, after, SAVED_SEARCH_PAGE_SIZE + 1)
+        else:
+            label = ""
+            rows = get_saved_search_page(state["search_id"], after, SAVED_SEARCH_PAGE_SIZE + 1)
+        state["more"] = len(rows) > SAVED_SEARCH_PAGE_SIZE
+        rows = rows[:SAVED_SEARCH_PAGE_SIZE]
+        if state["more"]:
+            del state["starts"][state["index"] + 1:]
+            state["starts"].append(rows[-1][0])
+        self.page_label_var.set(f"{label} 第 {state['index'] + 1} 页".strip())
+        self.page_prev_btn.config(state="normal" if state["index"] > 0 else "disabled")
+        self.page_next_btn.config(state="normal" if state["more"] else "disabled")
+        self._show_search_rows([(file_id, abs_p) for file_id, abs_p in rows
+                                if abs_p and os.path.exists(abs_p)])
+
+    def _clear_thumbnails(self):
         for w in self.thumb_inner.winfo_children():
             w.destroy()
+        self.thumb_frames = []
+        self.thumb_cols = 0
+
+    def _get_thumbnail_photo(self, path):
+        """取缩略图 PhotoImage：优先命中缓存，未命中才解码原图"""
+        key = (self.search_file_ids.get(path, path), THUMB_SIZE)
+        photo = self.thumb_cache.get(key)
+        if photo is None:
+            img = load_thumbnail(path)
+            with perf.timer("ui.photoimage"):
+                photo = ImageTk.PhotoImage(img)
+            self.thumb_cache.put(key, photo)
+        return photo
 
-        # 清理之前的列配置
-        for col in self.thumb_inner.grid_slaves():
-            col.grid_forget()
+    @profiled_action("render_thumbnails")
+    def _render_thumbnails(self):
+        """为当前结果集创建缩略图控件，并按容器宽度排成网格"""
+        # clear previous thumbnails
+        self._clear_thumbnails()
 
         if not self.search_results:
             return
 
+        # 完整性校验发现问题的图片加红框标记
+        try:
+            flags = get_integrity_flags(self.search_file_ids.values()) if self.db_ready else {}
+        except sqlite3.Error:
+            flags = {}
+
+        # populate thumbnail frames in thumb_inner（位置由 _layout_thumbnails 决定）
+        for path in self.search_results:
+            flag = flags.get(self.search_file_ids.get(path))
+            try:
+                photo = self._get_thumbnail_photo(path)
+            except Exception:
+                # 无法解码或已丢失的图片显示为占位项，不再从结果中消失
+                photo = None
+                if flag is None:
+                    flag = ("corrupt" if os.path.exists(path) else "missing", None)
+
+            frame = tk.Frame(self.thumb_inner, bd=1, relief="solid", bg="white",
+                             highlightthickness=2 if flag else 0, highlightbackground="#f44336")
+
+            if photo is not None:
+                lbl = tk.Label(frame, image=photo, bg="white")
+                lbl.image = photo
+                lbl.pack()
+                lbl.bind("<Double-Button-1>", lambda e, p=path: self.show_full_image(p))
+            else:
+                placeholder = tk.Frame(frame, width=THUMB_SIZE[0], height=THUMB_SIZE[1], bg="#ffebee")
+                placeholder.pack_propagate(False)
+                placeholder.pack()
+                tk.Label(placeholder, text="⚠\n无法显示", bg="#ffebee", fg="#c62828").pack(expand=True)
+            if flag:
+                tk.Label(frame, text="⚠ " + INTEGRITY_STATUS_TEXT.get(flag[0], flag[0]), bg="white", fg="#c62828",
+                         font=("Arial", 8), anchor="w").pack(fill="x", padx=2)
+
+            # 勾选框，默认选中（文件已丢失的不选，避免导出失败）
+            var = tk.BooleanVar(value=not (flag and flag[0] == "missing"))
+            filename = os.path.basename(path)
+            # 文件名过长时截断显示
+            display_name = filename if len(filename) <= 20 else filename[:17] + "..."
+            chk = tk.Checkbutton(frame, text=display_name, variable=var,
+                                 anchor="w", justify="left", bg="white", wraplength=110)
+            chk.pack(fill="x", padx=2)
+            self.thumb_selected_vars[path] = var
+
+            # 显示该图片的标签信息
+            tags_info = self._get_image_tags(path)
+            if tags_info:
+                tags_frame = tk.Frame(frame, bg="white")
+                tags_frame.pack(fill="x", padx=2, pady=(2, 2))
+
+                for tag_text in tags_info[:3]:  # 最多显示3个标签
+                    tag_label = tk.Label(tags_frame, text=tag_text,
+                                         bg="#e3f2fd", fg="#1976d2",
+                                         font=("Arial", 7),
+                                         padx=3, pady=1, relief="solid", bd=1)
+                    tag_label.pack(side=tk.LEFT, padx=1)
+
+                if len(tags_info) > 3:
+                    more_label = tk.Label(tags_frame, text=f"+{len(tags_info) - 3}",
+                                          bg="#f5f5f5", fg="#666",
+                                          font=("Arial", 7),
+                                          padx=2, pady=1)
+                    more_label.pack(side=tk.LEFT, padx=1)
+
+            self.thumb_frames.append(frame)
+
+        self._layout_thumbnails()
+        self._update_cache_stats()
+
+    def _layout_thumbnails(self):
+        """只根据当前画布宽度重新摆放已有缩略图，不重新创建控件或解码图片"""
+        if not self.thumb_frames:
+            return
+
         # 确保获取最新的画布宽度
         self.thumb_canvas.update_idletasks()
         canvas_width = self.thumb_canvas.winfo_width()
@@ -919,63 +6294,24 @@ class ImageManager(tk.Tk):
         if canvas_width <= 1:
             canvas_width = 600  # 默认宽度
 
-        thumb_width = 120  # 缩略图宽度
+        thumb_width = THUMB_SIZE[0]  # 缩略图宽度
         frame_padding = 12  # 每个 frame 的 padx (6*2)
         item_width = thumb_width + frame_padding + 10  # 额外空间
 
         # 至少1列，最多根据宽度计算
         cols = max(1, (canvas_width - 20) // item_width)  # 20是额外边距
+        if cols == self.thumb_cols:
+            return
+        self.thumb_cols = cols
 
-        # 配置 thumb_inner 的列权重，确保不超出宽度
-        for col in range(cols):
-            self.thumb_inner.grid_columnconfigure(col, weight=0, minsize=0)
-
-        # populate thumbnail grid in thumb_inner
-        for idx, path in enumerate(self.search_results):
-            try:
-                img = Image.open(path)
-                img.thumbnail((120, 120))
-                photo = ImageTk.PhotoImage(img)
-
-                frame = tk.Frame(self.thumb_inner, bd=1, relief="solid", bg="white")
-                frame.grid(row=idx // cols, column=idx % cols, padx=6, pady=6, sticky="n")
-
-                lbl = tk.Label(frame, image=photo, bg="white")
-                lbl.image = photo
-                lbl.pack()
-                lbl.bind("<Double-Button-1>", lambda e, p=path: self.show_full_image(p))
+        for idx, frame in enumerate(self.thumb_frames):
+            frame.grid(row=idx // cols, column=idx % cols, padx=6, pady=6, sticky="n")
 
-                # 勾选框，默认选中
-                var = tk.BooleanVar(value=True)
-                filename = os.path.basename(path)
-                # 文件名过长时截断显示
-                display_name = filename if len(filename) <= 20 else filename[:17] + "..."
-                chk = tk.Checkbutton(frame, text=display_name, variable=var,
-                                     anchor="w", justify="left", bg="white", wraplength=110)
-                chk.pack(fill="x", padx=2)
-                self.thumb_selected_vars[path] = var
-
-                # 显示该图片的标签信息
-                tags_info = self._get_image_tags(path)
-                if tags_info:
-                    tags_frame = tk.Frame(frame, bg="white")
-                    tags_frame.pack(fill="x", padx=2, pady=(2, 2))
-
-                    for tag_text in tags_info[:3]:  # 最多显示3个标签
-                        tag_label = tk.Label(tags_frame, text=tag_text,
-                                             bg="#e3f2fd", fg="#1976d2",
-                                             font=("Arial", 7),
-                                             padx=3, pady=1, relief="solid", bd=1)
-                        tag_label.pack(side=tk.LEFT, padx=1)
-
-                    if len(tags_info) > 3:
-                        more_label = tk.Label(tags_frame, text=f"+{len(tags_info) - 3}",
-                                              bg="#f5f5f5", fg="#666",
-                                              font=("Arial", 7),
-                                              padx=2, pady=1)
-                        more_label.pack(side=tk.LEFT, padx=1)
-            except Exception:
-                continue
+    def _update_cache_stats(self):
+        st = self.thumb_cache.stats()
+        self.cache_stats_var.set(
+            f"缩略图缓存：{st['items']} 张 / {st['bytes'] / 1024 / 1024:.1f} MB，"
+            f"命中 {st['hits']}，未命中 {st['misses']}（命中率 {st['hit_rate']:.0%}）")
 
     def _on_canvas_resize(self):
         """窗口大小改变时重新布局缩略图"""
@@ -983,55 +6319,166 @@ class ImageManager(tk.Tk):
             # 使用 after 避免频繁重绘
             if hasattr(self, '_resize_after_id'):
                 self.after_cancel(self._resize_after_id)
-            self._resize_after_id = self.after(200, self._render_thumbnails)
+            self._resize_after_id = self.after(200, self._layout_thumbnails)
 
     def _get_image_tags(self, abs_path):
-        """
-        获取指定图片的所有标签
-        返回格式: ["维度:标签", "维度:标签", ...]
-        """
+        """获取指定图片的所有标签，返回格式: ["维度:标签", ...]"""
         try:
-            # 从绝对路径转换回相对路径（用于数据库查询）
-            rel_path = os.path.relpath(abs_path, BASE_DIR)
+            if abs_path in self.search_foreign:
+                library, file_id = self.search_foreign[abs_path]
+                return library.get_file_tags(file_id)
+            file_id = self.search_file_ids.get(abs_path)
+            if file_id is None:
+                # 不在当前结果集中：从绝对路径转换回相对路径（用于数据库查询）
+                cursor.execute("SELECT file_id FROM t_files WHERE file_path=?", (os.path.relpath(abs_path, BASE_DIR),))
+                row = cursor.fetchone()
+                if not row:
+                    return []
+                file_id = row[0]
+            return get_file_tags(file_id)
+        except Exception:
+            return []
 
-            # 查询该文件的 file_id
-            cursor.execute("SELECT file_id FROM t_files WHERE file_path=?", (rel_path,))
-            row = cursor.fetchone()
-            if not row:
-                return []
+    # ================================================================
+    # 批量标签操作：作用于勾选的缩略图，或整个搜索结果（按查询，不加载）
+    # ================================================================
+    def _make_tag_picker(self, parent_frame, row, label):
+        """在对话框中放一组「维度 + 子标签」下拉框，返回 (dim_var, tag_var)"""
+        dims = [d for d in get_all_dimensions() if get_tags_by_dimension(d)]
+        dim_var = tk.StringVar(value=dims[0] if dims else "")
+        tag_var = tk.StringVar()
 
-            file_id = row[0]
+        tk.Label(parent_frame, text=label, font=("Arial", 10)).grid(row=row, column=0, sticky="w", pady=4)
+        dim_menu = tk.OptionMenu(parent_frame, dim_var, *(dims or [""]))
+        dim_menu.config(width=12)
+        dim_menu.grid(row=row, column=1, sticky="w", padx=4)
+        tag_menu = tk.OptionMenu(parent_frame, tag_var, "")
+        tag_menu.config(width=14)
+        tag_menu.grid(row=row, column=2, sticky="w", padx=4)
+
+        def refresh_tags(*_):
+            tags = get_tags_by_dimension(dim_var.get()) if dim_var.get() else []
+            menu = tag_menu["menu"]
+            menu.delete(0, tk.END)
+            for t in tags:
+                menu.add_command(label=t, command=lambda v=t: tag_var.set(v))
+            tag_var.set(tags[0] if tags else "")
+
+        dim_var.trace_add("write", refresh_tags)
+        refresh_tags()
+        return dim_var, tag_var
+
+    def bulk_tag_window(self):
+        if not self._require_db():
+            return
+        checked_ids = [self.search_file_ids[p] for p, var in getattr(self, "thumb_selected_vars", {}).items()
+                       if var.get() and p in self.search_file_ids]
+        if not checked_ids and self.last_search_query is None:
+            messagebox.showwarning("警告", "请先搜索图片")
+            return
+        if not get_all_dimensions():
+            messagebox.showwarning("警告", "暂无标签，请先到导入页新增标签")
+            return
 
-            # 查询该文件的所有标签
-            sql = """
-                SELECT t.parent, t.name
-                FROM t_tags t
-                JOIN t_files_tags ft ON t.tag_id = ft.tag_id
-                WHERE ft.file_id = ?
-                ORDER BY t.parent, t.name
-            """
-            cursor.execute(sql, (file_id,))
-            tags = cursor.fetchall()
+        win = tk.Toplevel(self)
+        win.title("批量标签操作")
+        win.geometry("460x300")
+        win.resizable(False, False)
+        win.transient(self)
 
-            return [f"{parent}:{name}" for parent, name in tags if name]
-        except Exception:
-            return []
+        # 居中显示
+        win.update_idletasks()
+        x = self.winfo_x() + (self.winfo_width() - 460) // 2
+        y = self.winfo_y() + (self.winfo_height() - 300) // 2
+        win.geometry(f"+{x}+{y}")
+
+        frame = tk.Frame(win, padx=20, pady=15)
+        frame.pack(fill="both", expand=True)
+
+        tk.Label(frame, text="作用范围:", font=("Arial", 10)).grid(row=0, column=0, sticky="w", pady=4)
+        scope_var = tk.StringVar(value="checked" if checked_ids else "query")
+        scope_frame = tk.Frame(frame)
+        scope_frame.grid(row=0, column=1, columnspan=2, sticky="w")
+        tk.Radiobutton(scope_frame, text=f"勾选的图片（{len(checked_ids)} 张）", variable=scope_var, value="checked",
+                       state=tk.NORMAL if checked_ids else tk.DISABLED).pack(anchor="w")
+        tk.Radiobutton(scope_frame, text="全部搜索结果", variable=scope_var, value="query",
+                       state=tk.NORMAL if self.last_search_query else tk.DISABLED).pack(anchor="w")
+
+        tk.Label(frame, text="操作:", font=("Arial", 10)).grid(row=1, column=0, sticky="w", pady=4)
+        action_var = tk.StringVar(value="add")
+        action_frame = tk.Frame(frame)
+        action_frame.grid(row=1, column=1, columnspan=2, sticky="w")
+        for text, value in (("添加", "add"), ("移除", "remove"), ("移动", "move")):
+            tk.Radiobutton(action_frame, text=text, variable=action_var, value=value).pack(side=tk.LEFT, padx=4)
+
+        dim_var, tag_var = self._make_tag_picker(frame, 2, "目标标签:")
+        from_dim_var, from_tag_var = self._make_tag_picker(frame, 3, "源标签(移动):")
+
+        def execute():
+            action = action_var.get()
+            tag_id = get_tag_id(dim_var.get(), tag_var.get())
+            from_tag_id = get_tag_id(from_dim_var.get(), from_tag_var.get()) if action == "move" else None
+            if tag_id is None or (action == "move" and from_tag_id is None):
+                messagebox.showwarning("警告", "请选择标签", parent=win)
+                return
+            if action == "move" and from_tag_id == tag_id:
+                messagebox.showwarning("警告", "源标签与目标标签不能相同", parent=win)
+                return
+            names = {"add": "添加", "remove": "移除", "move": "移动"}
+            desc = f"{names[action]} {dim_var.get()}:{tag_var.get()}"
+            if action == "move":
+                desc = f"移动 {from_dim_var.get()}:{from_tag_var.get()} → {dim_var.get()}:{tag_var.get()}"
+            if scope_var.get() == "checked":
+                scope = {"file_ids": checked_ids}
+            else:
+                scope = {"query": self.last_search_query}
+
+            def done(result):
+                _, added, removed = result
+                self._refresh_thumbnail_tags()
+                messagebox.showinfo("成功", f"{desc}\n新增关联 {added} 条，移除关联 {removed} 条")
+
+            win.destroy()
+            self._submit_write(desc, lambda: bulk_tag_files(action, tag_id, from_tag_id=from_tag_id,
+                                                            description=desc, **scope), done)
+
+        btn_frame = tk.Frame(frame)
+        btn_frame.grid(row=4, column=0, columnspan=3, pady=15)
+        tk.Button(btn_frame, text="执行", command=execute, width=10, bg="#4CAF50", fg="white").pack(side=tk.LEFT,
+                                                                                                  padx=5)
+        tk.Button(btn_frame, text="取消", command=win.destroy, width=10).pack(side=tk.LEFT, padx=5)
+
+    def undo_bulk_tag_op(self):
+        last = get_last_tag_op()
+        if not last:
+            messagebox.showinfo("提示", "没有可撤销的批量标签操作")
+            return
+        op_id, desc = last
+        if messagebox.askyesno("确认", f"撤销批量操作【{desc}】吗？"):
+            self._submit_write(f"撤销【{desc}】", lambda: undo_tag_op(op_id),
+                               on_done=lambda _: self._refresh_thumbnail_tags())
+
+    def _refresh_thumbnail_tags(self):
+        """标签变化后重建当前结果的缩略图（图片来自缓存，只重建控件），保留勾选状态"""
+        if not self.search_results:
+            return
+        checked = {p: var.get() for p, var in self.thumb_selected_vars.items()}
+        self._render_thumbnails()
+        for p, var in self.thumb_selected_vars.items():
+            var.set(checked.get(p, True))
 
+    @profiled_action("show_full_image")
     def show_full_image(self, path):
         abs_p = resolve_path(path) if not os.path.isabs(path) else path
         try:
-            win = tk.Toplevel(self)
-            win.title("查看图片")
-            img = Image.open(abs_p)
-            # scale large image to reasonable window if necessary
-            w, h = img.size
-            max_w, max_h = 1000, 800
-            if w > max_w or h > max_h:
-                img.thumbnail((max_w, max_h))
-            photo = ImageTk.PhotoImage(img)
-            lbl = tk.Label(win, image=photo)
-            lbl.image = photo
-            lbl.pack()
+            # 复用同一个查看窗口，可用 ←/→ 在当前结果中翻页
+            if self.viewer is not None and self.viewer.winfo_exists():
+                self.viewer.show(abs_p, self.search_results)
+                self.viewer.deiconify()
+                self.viewer.lift()
+                self.viewer.focus_set()
+            else:
+                self.viewer = ImageViewer(self, abs_p, self.search_results)
         except Exception:
             messagebox.showerror("错误", "打开图片失败（文件可能不存在）")
 
@@ -1053,12 +6500,271 @@ class ImageManager(tk.Tk):
             filetypes=[("Zip文件", "*.zip")]
         )
         if zip_path:
-            with zipfile.ZipFile(zip_path, "w") as zf:
-                for p in selected_paths:
-                    zf.write(p, os.path.basename(p))
-            messagebox.showinfo("成功", "压缩包已生成！")
+            def run(job):
+                job.progress(0, len(selected_paths), "张")
+                return export_zip(selected_paths, zip_path, job.progress, job.cancelled)
+
+            self._submit_job(f"导出 ZIP：{os.path.basename(zip_path)}", run, kind="export_zip",
+                             on_done=lambda _: messagebox.showinfo("成功", "压缩包已生成！"), action="download_zip")
+
+    def stream_download(self):
+        """
+        通过本机 HTTP 服务下载选中的图片：浏览器立即开始接收，ZIP 边读图片边生成，
+        不在本机写临时压缩包，支持断点续传。下载地址在程序运行期间有效。
+        """
+        selected_paths = [p for p, var in getattr(self, "thumb_selected_vars", {}).items() if var.get()]
+        if not selected_paths:
+            messagebox.showwarning("警告", "没有选中图片")
+            return
+        if getattr(self, "zip_server", None) is None:
+            self.zip_server = ZipExportServer()
+        name = datetime.datetime.now().strftime("images_%Y%m%d_%H%M%S")
+
+        def done(url):
+            webbrowser.open(url)
+            win = tk.Toplevel(self)
+            win.title("浏览器下载")
+            win.transient(self)
+            tk.Label(win, text=f"已在浏览器中开始下载 {len(selected_paths)} 张图片；\n"
+                               "也可以复制地址用 curl / wget 下载（程序运行期间有效，支持续传）：",
+                     justify="left").pack(padx=12, pady=(10, 4), anchor="w")
+            entry = tk.Entry(win, width=70)
+            entry.insert(0, url)
+            entry.pack(padx=12, pady=4)
+            entry.select_range(0, tk.END)
+            tk.Button(win, text="关闭", command=win.destroy, width=10).pack(pady=(4, 10))
+
+        # 只统计文件大小，不读取内容；丢失的文件不放进压缩包
+        self._submit_job("准备流式下载", lambda job: self.zip_server.add(
+            [p for p in selected_paths if os.path.exists(p)], name), JOB_PRIORITY_HIGH, kind="stream_zip",
+            on_done=done)
+
+
+# ================================================================
+#                      命令行维护工具（不带参数时启动界面）
+# ================================================================
+def _cli_progress(done, total):
+    print(f"\r{done}/{total}", end="", flush=True)
+
+
+def _cmd_migrate_layout(args):
+    print(f"迁移存储布局 → {args.layout}（Ctrl+C 可中断，再次运行从断点继续）")
+    try:
+        moved = migrate_storage_layout(args.layout, args.batch, progress=_cli_progress, pause=args.pause)
+    except KeyboardInterrupt:
+        print("\n已中断，进度已保存")
+        return 1
+    print(f"\n完成，移动 {moved} 个文件")
+    return 0
+
+
+def _find_library(name):
+    if not name:
+        return None
+    for library in load_libraries():
+        if library.name == name:
+            return None if library.is_primary else library
+    raise SystemExit(f"未找到图库：{name}")
+
+
+def _cmd_transcode(args):
+    library = _find_library(args.library)
+    policy = None
+    if args.format or args.quality:
+        db = library.connection() if library else conn
+        policy = get_transcode_policy(db.cursor())
+        policy.update({k: v for k, v in (("format", args.format), ("quality", args.quality)) if v})
+    processed, before, after = transcode_files(library, policy=policy, workers=args.workers,
+                                               progress=_cli_progress)
+    print(f"\n转码 {processed} 张：{format_bytes(before)} → {format_bytes(after)}，节省 {format_bytes(before - after)}")
+    if args.purge:
+        count, freed = purge_transcoded_originals(library)
+        print(f"删除过期原图 {count} 张，释放 {format_bytes(freed)}")
+    return 0
+
+
+def _cmd_backup(args):
+    stats = backup_library(args.dest, _find_library(args.library), progress=_cli_progress, prune=args.prune)
+    print(f"\n复制 {stats['copied']} 个文件（{format_bytes(stats['bytes'])}），未变化 {stats['skipped']} 个，"
+          f"源文件缺失 {stats['missing']} 个" + (f"，清理 {stats['pruned']} 个" if args.prune else ""))
+    if args.verify:
+        return _cmd_verify_backup(args)
+    return 0
+
+
+def _cmd_verify_backup(args):
+    problems = verify_backup(args.dest, progress=_cli_progress)
+    print()
+    for rel, reason in problems:
+        print(f"{reason}：{rel}")
+    print("校验通过" if not problems else f"发现 {len(problems)} 个问题")
+    return 1 if problems else 0
+
+
+def _cmd_restore(args):
+    problems = restore_backup(args.backup, args.target, progress=_cli_progress)
+    print()
+    for rel, reason in problems:
+        print(f"{reason}：{rel}")
+    print(f"已恢复到 {args.target}" + (f"，{len(problems)} 个文件有问题" if problems else ""))
+    return 1 if problems else 0
+
+
+def _cmd_verify(args):
+    library = _find_library(args.library)
+    print("校验图片（Ctrl+C 可中断，再次运行从断点继续）")
+    try:
+        counts = verify_library(library, workers=args.workers, batch_size=args.batch, max_mb_per_sec=args.rate,
+                                restart=args.restart, progress=_cli_progress)
+    except KeyboardInterrupt:
+        print("\n已中断，进度已保存")
+        return 1
+    print(f"\n正常 {counts['ok']}，文件缺失 {counts['missing']}，无法解码 {counts['corrupt']}，"
+          f"内容被改动 {counts['changed']}，超过像素上限（未解码）{counts['too_large']}")
+    if args.repair_from:
+        repaired, failed = repair_from_backup(args.repair_from, library)
+        print(f"从备份修复 {repaired} 个文件" + (f"，{len(failed)} 个无法修复" if failed else ""))
+    if library:
+        with library.lock:
+            problems = get_integrity_problems(library.connection().cursor())
+    else:
+        problems = get_integrity_problems()
+    for _, file_path, status, error, _ in problems:
+        print(f"{INTEGRITY_STATUS_TEXT.get(status, status)}：{file_path}" + (f"（{error}）" if error else ""))
+    return 1 if problems else 0
+
+
+def _cmd_export_zip(args):
+    tag_ids = []
+    for spec in args.tag:
+        parent, _, name = spec.partition(":")
+        tag_id = get_tag_id(parent, name)
+        if tag_id is None:
+            raise SystemExit(f"未找到标签：{spec}")
+        tag_ids.append(tag_id)
+    if args.text:
+        rows, _ = search_files_by_text(args.text, tag_ids, args.mode)
+    elif tag_ids:
+        rows = search_files_by_tags(tag_ids, args.mode)
+    else:
+        raise SystemExit("请用 --tag 或 --text 指定要导出的图片")
+    paths = list(OrderedDict.fromkeys(p for _, p in rows if p and os.path.exists(p)))
+    if args.serve:
+        server = ZipExportServer(port=args.port)
+        name = args.output[:-4] if args.output.lower().endswith(".zip") else args.output
+        print(f"{len(paths)} 张图片，下载地址（Ctrl+C 结束）：\n{server.add(paths, name)}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.close()
+        return 0
+    if args.output == "-":
+        # 写到标准输出，可直接接管道（如 | ssh host "cat > images.zip"）
+        export_zip_stream(paths, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        return 0
+    with open(args.output, "wb") as f:
+        written = export_zip_stream(paths, f, progress=lambda d, t: print(f"\r{d * 100 // max(t, 1)}%", end="",
+                                                                           file=sys.stderr, flush=True))
+    print(f"\n已导出 {len(paths)} 张图片（{format_bytes(written)}）到 {args.output}", file=sys.stderr)
+    return 0
+
+
+def _cmd_export_catalog(args):
+    count = export_catalog(args.output, _find_library(args.library), absolute=args.absolute,
+                           progress=_cli_progress)
+    print(f"\n已导出 {count} 个文件记录到 {args.output}")
+    return 0
+
+
+def _cmd_import_catalog(args):
+    stats = import_catalog(args.input, _find_library(args.library), chunk_size=args.chunk,
+                           progress=lambda d, t: print(f"\r{d}", end="", flush=True), root=args.root)
+    print(f"\n新增文件 {stats['files']} 个，补充标签的已有文件 {stats['merged']} 个，"
+          f"新建标签 {stats['tags']} 个，新增关联 {stats['links']} 条")
+    if stats["unresolved"]:
+        hint = "" if args.root else "（相对路径按本库根目录解析，来自其他图库的目录请用 --root 指定导出方的图库根目录）"
+        print(f"其中 {stats['unresolved']} 条记录在本机找不到图片{hint}", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图片管理系统（不带参数时启动界面）")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("migrate-layout", help="把 files/ 中的现有图片迁移到新的存储布局（可续传）")
+    p.add_argument("--layout", choices=STORAGE_LAYOUTS, required=True)
+    p.add_argument("--batch", type=int, default=LAYOUT_MIGRATION_BATCH, help="每批文件数")
+    p.add_argument("--pause", type=float, default=0.0, help="每批之间休眠秒数")
+    p.set_defaults(func=_cmd_migrate_layout)
+
+    p = sub.add_parser("transcode", help="按转码策略转码尚未处理的图片（未启用策略时需指定 --format）")
+    p.add_argument("--library", help="图库名称（默认本库）")
+    p.add_argument("--format", choices=sorted(TRANSCODE_EXTENSIONS))
+    p.add_argument("--quality", type=int)
+    p.add_argument("--workers", type=int, help="编码进程数")
+    p.add_argument("--purge", action="store_true", help="转码后删除超过保留期的原图")
+    p.set_defaults(func=_cmd_transcode)
+
+    p = sub.add_parser("backup", help="增量备份数据库快照和图片到 DEST（可中断续传）")
+    p.add_argument("dest")
+    p.add_argument("--library", help="图库名称（默认本库）")
+    p.add_argument("--prune", action="store_true", help="删除备份中已不再引用的文件")
+    p.add_argument("--verify", action="store_true", help="备份后按清单校验全部文件")
+    p.set_defaults(func=_cmd_backup)
+
+    p = sub.add_parser("verify-backup", help="按清单校验备份中的文件和数据库")
+    p.add_argument("dest")
+    p.set_defaults(func=_cmd_verify_backup)
+
+    p = sub.add_parser("restore", help="把备份恢复到新的目录（作为新的 BASE_DIR）")
+    p.add_argument("backup")
+    p.add_argument("target")
+    p.set_defaults(func=_cmd_restore)
+
+    p = sub.add_parser("verify", help="并行校验图片的 sha256 和可解码性（可续传），结果记录在 t_integrity")
+    p.add_argument("--library", help="图库名称（默认本库）")
+    p.add_argument("--workers", type=int, help="校验进程数")
+    p.add_argument("--batch", type=int, default=INTEGRITY_BATCH, help="每批文件数")
+    p.add_argument("--rate", type=float, default=0, help="平均读取速度上限 MB/s（0 为不限）")
+    p.add_argument("--restart", action="store_true", help="忽略上次中断的进度，从头校验")
+    p.add_argument("--repair-from", metavar="BACKUP", help="校验后用该增量备份中的副本修复有问题的文件")
+    p.set_defaults(func=_cmd_verify)
+
+    p = sub.add_parser("export-zip", help="按标签 / 关键词把图片流式打包为 ZIP（- 为标准输出，--serve 为本机 HTTP 下载）")
+    p.add_argument("output", help="输出文件；- 写到标准输出；配合 --serve 时为下载文件名")
+    p.add_argument("--tag", action="append", default=[], metavar="维度:子标签")
+    p.add_argument("--mode", choices=("OR", "AND"), default="OR")
+    p.add_argument("--text", help="关键词")
+    p.add_argument("--serve", action="store_true", help="启动本机 HTTP 服务提供下载（支持 Range 续传）")
+    p.add_argument("--port", type=int, default=0, help="--serve 的端口（默认随机）")
+    p.set_defaults(func=_cmd_export_zip)
+
+    p = sub.add_parser("export-catalog", help="导出文件与标签目录（.jsonl / .jsonl.gz / .parquet）")
+    p.add_argument("output")
+    p.add_argument("--library", help="图库名称（默认本库）")
+    p.add_argument("--absolute", action="store_true", help="file_path 写为绝对路径")
+    p.set_defaults(func=_cmd_export_catalog)
+
+    p = sub.add_parser("import-catalog", help="导入 export-catalog 的输出（只导入记录，不复制图片）")
+    p.add_argument("input")
+    p.add_argument("--library", help="图库名称（默认本库）")
+    p.add_argument("--chunk", type=int, default=CATALOG_CHUNK, help="每个事务的文件数")
+    p.add_argument("--root", help="导出方的图库根目录：目录中的相对路径按它改写（不指定时按本库根目录解析）")
+    p.set_defaults(func=_cmd_import_catalog)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # 界面自己在首屏显示后打开数据库
+        app = ImageManager()
+        app.mainloop()
+        return 0
+    open_database()
+    return args.func(args)
 
 
 if __name__ == "__main__":
-    app = ImageManager()
-    app.mainloop()
+    # 打包为 exe 后转码/校验进程池的子进程从这里分流
+    multiprocessing.freeze_support()
+    sys.exit(main())